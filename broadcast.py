@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Admin broadcasts for BoostX.
+
+Broadcaster sends one text to every user as a background task:
+- a shared token bucket keeps the send rate under Telegram's ~30 msg/s limit and a
+  semaphore caps concurrent requests
+- RetryAfter pauses the whole bucket for the requested time and the message is retried
+- users that blocked the bot (Forbidden) are marked in storage and skipped from then on
+- recipients are walked in user-id order; the last id of every finished chunk is
+  checkpointed to broadcast.json, so a restart resumes after it instead of re-sending
+- the admin's status message is edited in place with the running counters
+"""
+from __future__ import annotations
+import asyncio, time
+from pathlib import Path
+
+from telegram import Bot
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from storage import Storage, read_json, write_json
+
+
+class TokenBucket:
+    """`rate` tokens per second, bursts up to `capacity`; pause() empties it for a while."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+def _seconds(value) -> float:
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class Broadcaster:
+    """One broadcast job at a time, persisted in `path` until it finishes."""
+
+    def __init__(self, path: Path, storage: Storage, rate: float = 25, concurrency: int = 8,
+                 chunk: int = 100, progress_every: float = 3.0):
+        self.path = path
+        self.storage = storage
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chunk = chunk
+        self.progress_every = progress_every
+        self.job: dict | None = None
+        self._task: asyncio.Task | None = None
+        self._reported = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot: Bot, text: str, admin_chat: int, progress_message_id: int | None = None) -> dict:
+        self.job = {
+            "text": text,
+            "after": 0,
+            "total": len(self.storage.broadcast_user_ids()),
+            "sent": 0, "failed": 0, "blocked": 0,
+            "admin_chat": admin_chat,
+            "progress_message_id": progress_message_id,
+            "status": "running",
+            "started_at": int(time.time()),
+        }
+        self._save()
+        self._task = asyncio.create_task(self._run(bot))
+        return self.job
+
+    def resume(self, bot: Bot) -> bool:
+        """Continue a job interrupted by a restart; False if there is none."""
+        job = read_json(self.path, None)
+        if not isinstance(job, dict) or job.get("status") != "running":
+            return False
+        self.job = job
+        self._task = asyncio.create_task(self._run(bot))
+        return True
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _save(self):
+        write_json(self.path, self.job)
+
+    async def _run(self, bot: Bot):
+        job = self.job
+        sem = asyncio.Semaphore(self.concurrency)
+        targets = [uid for uid in self.storage.broadcast_user_ids() if uid > int(job["after"])]
+        job["total"] = job["sent"] + job["failed"] + job["blocked"] + len(targets)
+        try:
+            for i in range(0, len(targets), self.chunk):
+                chunk = targets[i:i + self.chunk]
+                await asyncio.gather(*(self._send(bot, sem, uid) for uid in chunk))
+                job["after"] = chunk[-1]
+                self._save()
+                await self._report(bot)
+            job["status"] = "done"
+            job["finished_at"] = int(time.time())
+            self._save()
+            await self._report(bot, final=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Broadcast error: {e}")
+
+    async def _send(self, bot: Bot, sem: asyncio.Semaphore, chat_id: int):
+        job = self.job
+        async with sem:
+            while True:
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=job["text"], parse_mode=ParseMode.HTML,
+                                           disable_web_page_preview=True)
+                    job["sent"] += 1
+                except RetryAfter as e:
+                    self.bucket.pause(_seconds(e.retry_after) + 0.5)
+                    continue
+                except Forbidden:
+                    self.storage.mark_blocked(chat_id)
+                    job["blocked"] += 1
+                except TelegramError:
+                    job["failed"] += 1
+                return
+
+    def progress_text(self) -> str:
+        job = self.job or {}
+        done = job.get("sent", 0) + job.get("failed", 0) + job.get("blocked", 0)
+        head = "✅ Рассылка завершена." if job.get("status") == "done" else "📣 Идёт рассылка…"
+        return (f"{head}\n\n"
+                f"Обработано: <b>{done}</b> из <b>{job.get('total', 0)}</b>\n"
+                f"Отправлено: <b>{job.get('sent', 0)}</b>\n"
+                f"Заблокировали бота: <b>{job.get('blocked', 0)}</b>\n"
+                f"Ошибки: <b>{job.get('failed', 0)}</b>")
+
+    async def _report(self, bot: Bot, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self._reported < self.progress_every:
+            return
+        self._reported = now
+        job = self.job
+        try:
+            if job.get("progress_message_id"):
+                await bot.edit_message_text(chat_id=job["admin_chat"], message_id=job["progress_message_id"],
+                                            text=self.progress_text(), parse_mode=ParseMode.HTML)
+                return
+        except BadRequest:
+            pass  # "message is not modified" or the message is gone
+        except TelegramError:
+            return
+        if final:
+            try:
+                await bot.send_message(chat_id=job["admin_chat"], text=self.progress_text(), parse_mode=ParseMode.HTML)
+            except TelegramError:
+                pass
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Compact callback_data codec and table-lookup router for inline buttons.
+
+callback_data is `action[:arg[:arg...]]`:
+- action is a short id ("k", "api", ...) registered in a routing table
+- args are ints packed in base 36, so "item 1234 of category 56" costs 6 bytes ("1k:ya")
+- a trailing "+" is a display flag read by the caller (see NEW_SCREEN in shop_bot.py);
+  it is not part of the action or the args
+- encode() refuses payloads over Telegram's 64-byte limit instead of letting the API reject the keyboard
+
+RouteHandler is one CallbackQueryHandler for a set of actions: matching is a dict lookup
+instead of walking a list of regex handlers, and the decoded args arrive in `context.args`.
+"""
+from __future__ import annotations
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler
+
+SEP = ":"
+FLAG = "+"
+MAX_BYTES = 64
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+Callback = Callable[..., Awaitable[object]]
+
+
+def _b36(n: int) -> str:
+    if n < 0:
+        return "-" + _b36(-n)
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _DIGITS[r] + out
+        if not n:
+            return out
+
+
+def encode(action: str, *args: int) -> str:
+    data = SEP.join([action, *(_b36(int(a)) for a in args)])
+    if len(data.encode("utf-8")) > MAX_BYTES - len(FLAG):
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+
+def decode(data: str) -> Tuple[str, List[int]] | None:
+    """(action, args) or None if `data` is not in codec form."""
+    if data.endswith(FLAG):
+        data = data[:-len(FLAG)]
+    action, *raw = data.split(SEP)
+    try:
+        return action, [int(a, 36) for a in raw]
+    except ValueError:
+        return None
+
+
+class RouteHandler(CallbackQueryHandler):
+    """Dispatches a callback query by its action id; `routes` maps action -> callback."""
+
+    def __init__(self, routes: Dict[str, Callback], **kwargs):
+        self.routes = dict(routes)
+        super().__init__(self._dispatch, **kwargs)
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return None
+        decoded = decode(data)
+        if decoded is None or decoded[0] not in self.routes:
+            return None
+        return decoded
+
+    def collect_additional_context(self, context, update, application, check_result):
+        # the data was decoded once in check_update; _dispatch reads the action from here
+        context.route, context.args = check_result
+
+    async def _dispatch(self, update, context):
+        return await self.routes[context.route](update, context)
+
+
+class Router:
+    """Action table shared by several handlers: ROUTER.handler("a", "ax") routes those two actions."""
+
+    def __init__(self, table: Dict[str, Callback] | None = None):
+        self.table: Dict[str, Callback] = {}
+        for action, callback in (table or {}).items():
+            self.add(action, callback)
+
+    def add(self, action: str, callback: Callback):
+        if action in self.table:
+            raise ValueError(f"callback action {action!r} is already routed")
+        self.table[action] = callback
+
+    def handler(self, *actions: str, **kwargs) -> RouteHandler:
+        return RouteHandler({a: self.table[a] for a in actions}, **kwargs)
@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""LooksMM supplier helpers for BoostX.
+
+LooksMMClient is the asyncio API client:
+- one shared keep-alive aiohttp session (created lazily on the bot's loop)
+- a semaphore caps in-flight supplier calls; every call has its own timeout
+- responses are parsed into AddResult / Service / OrderStatus; API errors raise LooksMMError
+- run_sync() lets blocking code (worker threads, scripts) reuse the same client
+- Submitter wraps order submission with retries and a circuit breaker
+
+StatusPoller follows orders that are still running at the supplier:
+- one multi-status call per 100 supplier ids
+- status, start_count and remains are stored on the order (or on each combo item)
+- each order is re-checked less often as it ages; a callback fires when it finishes
+
+ServicesCache keeps the supplier service list indexed by service id:
+- readers never wait for the download once something is cached (stale-while-revalidate):
+  a stale entry is served and a refresh is started in a background thread
+- the list is persisted (looksmm_services.json) so a cold start has limits right away
+- only a completely empty cache fetches inline
+"""
+from __future__ import annotations
+import asyncio, json, random, threading, time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List
+
+import aiohttp
+
+from metrics import LOOKSMM_CALLS, LOOKSMM_LATENCY
+from storage import ORDER_FINAL_STATUSES, Storage, order_is_open, read_json, supplier_slots, write_json
+
+
+LOOKSMM_API_URL = "https://looksmm.ru/api/v2"
+
+
+class LooksMMError(RuntimeError):
+    """HTTP failure or an {"error": ...} answer from the supplier.
+
+    transient: worth retrying (the supplier or the network is struggling)
+    ambiguous: the request may have been processed anyway (timeout, dropped response),
+               so a non-idempotent call like "add" must not be blindly repeated
+    """
+
+    def __init__(self, message: str, transient: bool = False, ambiguous: bool = False):
+        super().__init__(message)
+        self.transient = transient
+        self.ambiguous = ambiguous
+
+
+class CircuitOpen(LooksMMError):
+    """Raised without calling the supplier while the circuit breaker is open."""
+
+
+@dataclass(frozen=True)
+class Service:
+    service: int
+    name: str
+    category: str
+    type: str
+    rate: float
+    min: int
+    max: int
+
+    @classmethod
+    def parse(cls, row: dict) -> "Service":
+        return cls(service=int(row["service"]), name=str(row.get("name", "")), category=str(row.get("category", "")),
+                   type=str(row.get("type", "")), rate=float(row.get("rate") or 0),
+                   min=int(float(row.get("min") or 1)), max=int(float(row.get("max") or 1000000)))
+
+
+@dataclass(frozen=True)
+class AddResult:
+    order: int
+    raw: dict
+
+
+@dataclass(frozen=True)
+class OrderStatus:
+    status: str
+    start_count: int | None
+    remains: int | None
+    charge: float | None
+    error: str = ""
+
+    @classmethod
+    def parse(cls, row: Any) -> "OrderStatus":
+        if not isinstance(row, dict):
+            return cls(status="", start_count=None, remains=None, charge=None, error=str(row)[:200])
+        if row.get("error"):
+            return cls(status="", start_count=None, remains=None, charge=None, error=str(row["error"])[:200])
+        def num(v, kind):
+            try: return kind(float(v))
+            except (TypeError, ValueError): return None
+        return cls(status=str(row.get("status") or ""), start_count=num(row.get("start_count"), int),
+                   remains=num(row.get("remains"), int), charge=num(row.get("charge"), float))
+
+    @property
+    def final(self) -> bool:
+        return self.status.lower() in ORDER_FINAL_STATUSES
+
+
+class LooksMMClient:
+    STATUS_BATCH = 100
+
+    def __init__(self, key: str, url: str = LOOKSMM_API_URL, max_concurrency: int = 8, timeout: float = 30):
+        self.key = key
+        self.url = url
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._session: aiohttp.ClientSession | None = None
+        self._sem: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def request(self, params: Dict[str, Any], timeout: float | None = None) -> Any:
+        """One API call; returns the decoded JSON (or text when the body isn't JSON)."""
+        action = str(params.get("action", ""))
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            data = await self._request(params, timeout)
+            outcome = "ok"
+            return data
+        except LooksMMError as e:
+            outcome = "ambiguous" if e.ambiguous else ("transient" if e.transient else "error")
+            raise
+        finally:
+            LOOKSMM_CALLS.inc(action=action, outcome=outcome)
+            LOOKSMM_LATENCY.observe(time.perf_counter() - start, action=action)
+
+    async def _request(self, params: Dict[str, Any], timeout: float | None = None) -> Any:
+        if not self.key:
+            raise LooksMMError("LOOKSMM_KEY is not set")
+        session = self._ensure_session()
+        query = {k: str(v) for k, v in params.items()}
+        query["key"] = self.key
+        async with self._sem:
+            try:
+                async with session.get(self.url, params=query,
+                                       timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as r:
+                    if r.status >= 400:
+                        # 429/502/503: rejected before reaching the API; 500/504 may have been processed
+                        raise LooksMMError(f"HTTP {r.status}: {(await r.text())[:200]}",
+                                           transient=r.status in (429, 500, 502, 503, 504),
+                                           ambiguous=r.status in (500, 504))
+                    body = await r.text()
+            except asyncio.TimeoutError:
+                raise LooksMMError(f"timeout after {timeout or self.timeout:g}s ({params.get('action')})",
+                                   transient=True, ambiguous=True)
+            except aiohttp.ClientConnectorError as e:
+                raise LooksMMError(f"{type(e).__name__}: {e}", transient=True)
+            except aiohttp.ClientError as e:
+                raise LooksMMError(f"{type(e).__name__}: {e}", transient=True, ambiguous=True)
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return body
+        if isinstance(data, dict) and data.get("error"):
+            raise LooksMMError(str(data["error"]))
+        return data
+
+    async def services(self, timeout: float | None = 60) -> List[Service]:
+        rows = await self.request({"action": "services"}, timeout=timeout)
+        if not isinstance(rows, list):
+            raise LooksMMError(f"services response: {str(rows)[:200]}")
+        out = []
+        for row in rows:
+            try: out.append(Service.parse(row))
+            except Exception: continue
+        return out
+
+    async def add(self, service_id: int, link: str, quantity: int, timeout: float | None = None) -> AddResult:
+        data = await self.request({"action": "add", "service": int(service_id), "link": link,
+                                   "quantity": int(quantity)}, timeout=timeout)
+        try:
+            return AddResult(order=int(data["order"]), raw=data)
+        except Exception:
+            raise LooksMMError(f"LooksMM response: {data}")
+
+    async def statuses(self, order_ids: List[int], timeout: float | None = None) -> Dict[int, OrderStatus]:
+        """Multi-order status, at most STATUS_BATCH ids per call (callers batch)."""
+        if not order_ids:
+            return {}
+        data = await self.request({"action": "status", "orders": ",".join(str(int(i)) for i in order_ids)},
+                                  timeout=timeout)
+        if not isinstance(data, dict):
+            raise LooksMMError(f"status response: {str(data)[:200]}")
+        out: Dict[int, OrderStatus] = {}
+        for k, row in data.items():
+            try: out[int(k)] = OrderStatus.parse(row)
+            except ValueError: continue
+        return out
+
+    async def cancel(self, order_ids: List[int], timeout: float | None = None) -> Dict[int, bool]:
+        """Ask the supplier to cancel orders; {order_id: cancelled}. Never raises."""
+        if not order_ids:
+            return {}
+        out = {int(i): False for i in order_ids}
+        try:
+            data = await self.request({"action": "cancel", "orders": ",".join(str(int(i)) for i in order_ids)},
+                                      timeout=timeout)
+        except LooksMMError as e:
+            print(f"⚠️ LooksMM cancel error: {e}")
+            return out
+        for row in data if isinstance(data, list) else []:
+            try:
+                res = row.get("cancel")
+                out[int(row["order"])] = not (isinstance(res, dict) and res.get("error")) and bool(res)
+            except Exception:
+                continue
+        return out
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Bind to the bot's loop so run_sync() from worker threads reuses this client."""
+        self._loop = loop
+
+    def run_sync(self, call: Callable[["LooksMMClient"], Awaitable[Any]]) -> Any:
+        """Run call(client) to completion from blocking code.
+
+        From a worker thread it runs on the attached loop (same pooled session);
+        without a running loop a throwaway client is used and closed.
+        """
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                raise RuntimeError("blocking LooksMM call on the event loop; await the client instead")
+            return asyncio.run_coroutine_threadsafe(call(self), loop).result()
+
+        async def once():
+            tmp = LooksMMClient(self.key, self.url, self.max_concurrency, self.timeout)
+            try:
+                return await call(tmp)
+            finally:
+                await tmp.close()
+        return asyncio.run(once())
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class ServicesCache:
+    def __init__(self, fetch: Callable[[], List[dict]], path: Path, ttl: float = 900):
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.by_id: Dict[int, dict] = {}
+        self.fetched_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._cold_lock = threading.Lock()  # one inline download when nothing is cached
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0,
+                       "refresh_ms_last": 0.0, "refresh_ms_max": 0.0, "refresh_ms_total": 0.0}
+        self._load()
+
+    @staticmethod
+    def _index(services: List[dict]) -> Dict[int, dict]:
+        out: Dict[int, dict] = {}
+        for svc in services or []:
+            try:
+                out[int(svc.get("service"))] = svc
+            except Exception:
+                continue
+        return out
+
+    def _load(self):
+        snap = read_json(self.path, {}) or {}
+        self.by_id = self._index(snap.get("services") or [])
+        self.fetched_at = float(snap.get("fetched_at") or 0)
+
+    def stale(self) -> bool:
+        return time.time() - self.fetched_at >= self.ttl
+
+    def refresh(self) -> bool:
+        """Download the list now (blocking); keeps the old data on failure."""
+        t0 = time.perf_counter()
+        try:
+            services = self.fetch()
+            if not isinstance(services, list):
+                raise RuntimeError(f"LooksMM services response: {str(services)[:200]}")
+            by_id = self._index(services)
+            now = time.time()
+            with self._lock:
+                self.by_id, self.fetched_at = by_id, now
+            write_json(self.path, {"fetched_at": now, "services": services})
+            ok = True
+        except Exception as e:
+            print(f"⚠️ LooksMM services refresh error: {e}")
+            ok = False
+        ms = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            st = self._stats
+            st["refreshes" if ok else "refresh_errors"] += 1
+            st["refresh_ms_last"] = round(ms, 1)
+            st["refresh_ms_max"] = round(max(st["refresh_ms_max"], ms), 1)
+            st["refresh_ms_total"] += ms
+            self._refreshing = False
+        return ok
+
+    def refresh_in_background(self) -> bool:
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="looksmm-services", daemon=True).start()
+        return True
+
+    def get(self, service_id: int) -> dict | None:
+        if not self.by_id:
+            with self._cold_lock:
+                if not self.by_id:
+                    self.refresh()
+        elif self.stale():
+            self.refresh_in_background()
+        stale = self.stale()
+        svc = self.by_id.get(int(service_id))
+        with self._lock:
+            key = "misses" if svc is None else ("stale_hits" if stale else "hits")
+            self._stats[key] += 1
+        return svc
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            st = dict(self._stats)
+        done = st.pop("refresh_ms_total")
+        runs = st["refreshes"] + st["refresh_errors"]
+        st["refresh_ms_avg"] = round(done / runs, 1) if runs else 0.0
+        st["size"] = len(self.by_id)
+        st["age_s"] = round(time.time() - self.fetched_at, 1) if self.fetched_at else None
+        return st
+
+
+class CircuitBreaker:
+    """closed -> (threshold consecutive failures) -> open -> (cooldown) -> half-open: one probe call."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.cooldown else "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures, self.opened_at, self._probing = 0, None, False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def end_probe(self):
+        """Free the half-open probe slot whatever the call's outcome (e.g. it was cancelled)."""
+        self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures}
+
+
+class Submitter:
+    """Order submission with retries and a circuit breaker in front of LooksMMClient.add.
+
+    Only failures that can't have created an order (connect errors, 429/502/503) are retried,
+    with full-jitter exponential backoff. Ambiguous failures are raised at once for the caller
+    to reconcile; an open breaker raises CircuitOpen without touching the network.
+    """
+
+    def __init__(self, client: LooksMMClient, breaker: CircuitBreaker | None = None, retries: int = 3,
+                 base_delay: float = 0.5, max_delay: float = 8):
+        self.client = client
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    async def add(self, service_id: int, link: str, quantity: int) -> AddResult:
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpen("supplier is unavailable (circuit open)", transient=True)
+            try:
+                res = await self.client.add(service_id, link, quantity)
+            except LooksMMError as e:
+                if e.transient:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()  # the API answered; the order itself was rejected
+                if e.transient and not e.ambiguous and attempt < self.retries:
+                    await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                    attempt += 1
+                    continue
+                raise
+            except Exception:
+                self.breaker.failure()  # timeouts, parse errors: the supplier didn't give a usable answer
+                raise
+            finally:
+                self.breaker.end_probe()
+            self.breaker.success()
+            return res
+
+
+class StatusPoller:
+    def __init__(self, client: LooksMMClient, storage: Storage,
+                 on_finished: Callable[[dict], Awaitable[None]] | None = None, max_age: float = 30 * 86400):
+        self.client = client
+        self.storage = storage
+        self.on_finished = on_finished
+        self.max_age = max_age
+        self._next: Dict[str, float] = {}  # order_id -> earliest next check
+
+    @staticmethod
+    def interval(age: float) -> float:
+        """Seconds until the next check of an order that is `age` seconds old."""
+        if age < 3600: return 120
+        if age < 6 * 3600: return 600
+        if age < 86400: return 1800
+        return 3 * 3600
+
+    async def poll_once(self, now: float | None = None) -> int:
+        """Check every due open order; returns how many orders were updated."""
+        now = now or time.time()
+        due = []
+        for order in self.storage.open_orders():
+            oid = order.get("order_id")
+            age = now - float(order.get("created_at") or now)
+            if oid and age >= self.max_age:
+                self._expire(order)
+            elif oid and self._next.get(oid, 0) <= now:
+                due.append(order)
+        ids = sorted({int(slot["provider_order_id"]) for o in due for slot in supplier_slots(o)
+                      if str(slot.get("provider_order_id")).isdigit()})
+        batches = [ids[i:i + self.client.STATUS_BATCH] for i in range(0, len(ids), self.client.STATUS_BATCH)]
+        found: Dict[int, OrderStatus] = {}
+        for res in await asyncio.gather(*(self.client.statuses(b) for b in batches), return_exceptions=True):
+            if isinstance(res, Exception):
+                print(f"⚠️ LooksMM status error: {res}")
+            else:
+                found.update(res)
+
+        updated = 0
+        for order in due:
+            oid = order["order_id"]
+            self._next[oid] = now + self.interval(now - float(order.get("created_at") or now))
+            changed = False
+            for slot in supplier_slots(order):
+                st = found.get(int(slot["provider_order_id"])) if str(slot.get("provider_order_id")).isdigit() else None
+                if st is None or st.error:
+                    continue
+                fields = {"supplier_status": st.status, "start_count": st.start_count, "remains": st.remains}
+                if any(slot.get(k) != v for k, v in fields.items()):
+                    slot.update(fields)
+                    changed = True
+                slot["checked_at"] = int(now)
+            if not changed:
+                continue
+            changes = {"items": order["items"]} if order.get("type") == "combo" else {
+                k: order.get(k) for k in ("supplier_status", "start_count", "remains", "checked_at")}
+            saved = self.storage.update_order(oid, changes)
+            updated += 1
+            if saved is not None and not order_is_open(saved):
+                self._next.pop(oid, None)
+                if self.on_finished is not None:
+                    try:
+                        await self.on_finished(saved)
+                    except Exception as e:
+                        print(f"⚠️ Order {oid} notify error: {e}")
+        return updated
+
+    def _expire(self, order: dict):
+        """Stop polling an order older than max_age: its open slots get supplier_status "expired",
+        which is final, so the order leaves the storage's open set."""
+        for slot in supplier_slots(order):
+            if str(slot.get("supplier_status") or "").lower() not in ORDER_FINAL_STATUSES:
+                slot["supplier_status"] = "expired"
+        changes = {"items": order["items"]} if order.get("type") == "combo" else {"supplier_status": "expired"}
+        self.storage.update_order(order["order_id"], changes)
+        self._next.pop(order["order_id"], None)
+        print(f"⌛ Order {order['order_id']} stopped being polled after {self.max_age / 86400:g} days")
+
+    async def run(self, every: float = 30):
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                print(f"⚠️ Status poller error: {e}")
+            await asyncio.sleep(every)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Telegram file_id cache for the bot's static images.
+
+Telegram keeps every uploaded file and returns a file_id that can be sent again
+without re-uploading. AssetRegistry maps the sha256 of an image file to that id:
+- the first send of a file uploads it and stores the id in file_ids.json
+- later sends pass the id only (one small request instead of the full PNG)
+- a changed file has a new hash and is uploaded again; an id that Telegram rejects
+  is dropped and the file re-uploaded
+- hashes are recomputed only when the file's mtime or size changes
+"""
+from __future__ import annotations
+import asyncio, hashlib, os, threading, time
+from pathlib import Path
+from typing import Dict, Tuple
+
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+from storage import read_json, write_json
+
+
+class AssetRegistry:
+    def __init__(self, path: Path):
+        self.path = path
+        self._ids: Dict[str, dict] = read_json(path, {}) or {}
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}  # path -> (mtime_ns, size, sha256)
+        self._uploads: Dict[str, asyncio.Lock] = {}
+        self._lock = threading.RLock()
+
+    def digest(self, path: str | Path) -> str:
+        """sha256 of the file, cached by (mtime, size). FileNotFoundError if it is missing."""
+        key = str(path)
+        st = os.stat(key)
+        cached = self._hashes.get(key)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        with open(key, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._hashes[key] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def file_id(self, digest: str) -> str | None:
+        entry = self._ids.get(digest)
+        return entry.get("file_id") if isinstance(entry, dict) else None
+
+    def _remember(self, digest: str, path: str | Path, file_id: str | None):
+        with self._lock:
+            if file_id:
+                self._ids[digest] = {"file_id": file_id, "path": str(path), "saved_at": int(time.time())}
+            else:
+                self._ids.pop(digest, None)
+            write_json(self.path, dict(self._ids))
+
+    async def send_photo(self, bot: Bot, chat_id: int, path: str | Path, **kwargs) -> Message:
+        """Send an image file, by cached file_id when possible."""
+        digest = self.digest(path)
+        fid = self.file_id(digest)
+        if fid:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=fid, **kwargs)
+            except BadRequest as e:
+                if "file" not in str(e).lower():
+                    raise
+                self._remember(digest, path, None)  # id no longer valid for this bot
+
+        lock = self._uploads.setdefault(digest, asyncio.Lock())
+        async with lock:
+            fid = self.file_id(digest)  # a concurrent send may have uploaded it meanwhile
+            if fid:
+                return await bot.send_photo(chat_id=chat_id, photo=fid, **kwargs)
+            with open(path, "rb") as f:
+                msg = await bot.send_photo(chat_id=chat_id, photo=f, **kwargs)
+            if msg.photo:
+                self._remember(digest, path, msg.photo[-1].file_id)
+            return msg
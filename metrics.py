@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Minimal Prometheus metrics for BoostX (no client library needed).
+
+- Counter and Histogram keep one series per label combination in memory
+- REGISTRY.render() produces the Prometheus text exposition format (served at /metrics)
+- instrument() wraps a PTB handler callback with call / error counters and a latency histogram
+"""
+from __future__ import annotations
+import functools, threading, time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        parts = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return super().render() + [f"{self.name}{self._labels(k)} {_fmt(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            row = self._series.get(key)
+            if row is None:
+                row = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = super().render()
+        for key, row in items:
+            total = 0
+            for bound, n in zip(self.buckets, row):
+                total += n
+                le = 'le="' + _fmt(bound) + '"'
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {total}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {row[-2]!r}")
+            lines.append(f"{self.name}_count{self._labels(key)} {row[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_CALLS = REGISTRY.counter("boostx_handler_calls_total", "Handler invocations.", ("handler", "conversation", "state"))
+HANDLER_ERRORS = REGISTRY.counter("boostx_handler_errors_total", "Handler invocations that raised.", ("handler", "conversation", "state"))
+HANDLER_LATENCY = REGISTRY.histogram("boostx_handler_seconds", "Handler latency in seconds.", ("handler", "conversation", "state"))
+STORAGE_LATENCY = REGISTRY.histogram("boostx_storage_seconds", "JSON storage operation latency in seconds.", ("op",),
+                                     buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+LOOKSMM_CALLS = REGISTRY.counter("boostx_looksmm_requests_total", "LooksMM API calls by outcome.", ("action", "outcome"))
+LOOKSMM_LATENCY = REGISTRY.histogram("boostx_looksmm_seconds", "LooksMM API call latency in seconds.", ("action",),
+                                     buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+def instrument(callback, conversation: str = "", state: str = ""):
+    """Wrap an async handler callback; the wrapper returns whatever the callback returns."""
+    if getattr(callback, "__instrumented__", False):
+        return callback
+    labels = {"handler": getattr(callback, "__name__", "callback"), "conversation": conversation, "state": state}
+
+    @functools.wraps(callback)
+    async def wrapped(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(**labels)
+            raise
+        finally:
+            HANDLER_CALLS.inc(**labels)
+            HANDLER_LATENCY.observe(time.perf_counter() - start, **labels)
+
+    wrapped.__instrumented__ = True
+    return wrapped
+
+
+def instrument_application(app) -> int:
+    """Wrap every registered handler callback, including ConversationHandler entry points,
+    states and fallbacks. Call once after all handlers are added; returns how many were wrapped."""
+    from telegram.ext import ConversationHandler
+
+    count = 0
+
+    def wrap(handler, conversation: str = "", state: str = ""):
+        nonlocal count
+        if isinstance(handler, ConversationHandler):
+            name = handler.name or "conversation"
+            for h in handler.entry_points:
+                wrap(h, name, "entry")
+            for st, handlers in handler.states.items():
+                for h in handlers:
+                    wrap(h, name, str(st))
+            for h in handler.fallbacks:
+                wrap(h, name, "fallback")
+        elif isinstance(getattr(handler, "routes", None), dict):  # callbacks.RouteHandler
+            for action, cb in handler.routes.items():
+                if not getattr(cb, "__instrumented__", False):
+                    handler.routes[action] = instrument(cb, conversation, state)
+                    count += 1
+        elif callable(getattr(handler, "callback", None)) and not getattr(handler.callback, "__instrumented__", False):
+            handler.callback = instrument(handler.callback, conversation, state)
+            count += 1
+
+    for handlers in app.handlers.values():
+        for h in handlers:
+            wrap(h)
+    return count
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""SQLite-backed PTB persistence for user_data and ConversationHandler states.
+
+A redeploy keeps in-progress orders, applied promo codes and admin drafts:
+- user_data is stored one row per (user, key) as JSON; an update only writes the keys whose
+  JSON differs from what was last written, and deletes the keys that were removed
+- nothing is read for user_data at startup: a user's rows are loaded the first time one of
+  their updates is handled (refresh_user_data)
+- conversation states are small and are all loaded when the ConversationHandler starts
+- changes collected during one Application.update_persistence() run (every `update_interval`
+  seconds, and at stop) are committed in a single transaction
+- values that aren't JSON-serializable stay in memory only
+- bot_data / chat_data / callback_data are not stored (bot_data only holds background tasks)
+"""
+from __future__ import annotations
+import asyncio, json, sqlite3, threading
+from pathlib import Path
+from typing import Dict, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (user_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self, path: Path, update_interval: float = 5):
+        super().__init__(PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.path = path
+        self._db = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._loaded: Set[int] = set()
+        self._written: Dict[int, Dict[str, str]] = {}  # user_id -> key -> JSON as stored
+        self._pending_users: Dict[Tuple[int, str], str | None] = {}  # None = delete
+        self._pending_convs: Dict[Tuple[str, str], str | None] = {}
+        self._scheduled = False
+
+    # ----- batching -----
+    def _schedule_commit(self):
+        # update_persistence() runs all update_* calls as one gather; call_soon lands after all of them
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._commit)
+
+    def _commit(self):
+        self._scheduled = False
+        with self._lock:
+            users, convs = self._pending_users, self._pending_convs
+            if not users and not convs:
+                return
+            self._pending_users, self._pending_convs = {}, {}
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO user_data (user_id, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id, key) DO UPDATE SET value=excluded.value",
+                    [(uid, key, value) for (uid, key), value in users.items() if value is not None])
+                self._db.executemany("DELETE FROM user_data WHERE user_id=? AND key=?",
+                                     [k for k, value in users.items() if value is None])
+                self._db.executemany(
+                    "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name, key) DO UPDATE SET state=excluded.state",
+                    [(name, key, state) for (name, key), state in convs.items() if state is not None])
+                self._db.executemany("DELETE FROM conversations WHERE name=? AND key=?",
+                                     [k for k, state in convs.items() if state is None])
+                self._db.execute("COMMIT")
+            except Exception as e:
+                self._db.execute("ROLLBACK")
+                # keep the batch for the next run, unless a newer value was queued meanwhile
+                self._pending_users = {**users, **self._pending_users}
+                self._pending_convs = {**convs, **self._pending_convs}
+                print(f"⚠️ Persistence commit failed: {e}")
+
+    def _stored(self, user_id: int) -> Dict[str, str]:
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM user_data WHERE user_id=?", (user_id,)).fetchall()
+        return {key: value for key, value in rows}
+
+    # ----- user_data -----
+    async def get_user_data(self) -> Dict[int, dict]:
+        # a new Application starts with empty user_data; users are loaded again on first use
+        self._commit()
+        self._loaded.clear()
+        self._written.clear()
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        stored = self._written[user_id] = self._stored(user_id)
+        for key, value in stored.items():
+            user_data.setdefault(key, json.loads(value))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        written = self._written.get(user_id)
+        if written is None:
+            written = self._written[user_id] = self._stored(user_id)
+        for key, value in data.items():
+            if not isinstance(key, str):
+                continue
+            try:
+                text = _dumps(value)
+            except (TypeError, ValueError):
+                continue
+            if written.get(key) != text:
+                written[key] = text
+                self._pending_users[(user_id, key)] = text
+        if user_id in self._loaded:  # otherwise `data` may lack stored keys that were never loaded into it
+            for key in [k for k in written if k not in data]:
+                del written[key]
+                self._pending_users[(user_id, key)] = None
+        self._schedule_commit()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        for key in self._written.pop(user_id, None) or self._stored(user_id):
+            self._pending_users[(user_id, key)] = None
+        self._loaded.discard(user_id)
+        self._schedule_commit()
+
+    # ----- conversations -----
+    async def get_conversations(self, name: str) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT key, state FROM conversations WHERE name=?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._pending_convs[(name, _dumps(list(key)))] = None if new_state is None else _dumps(new_state)
+        self._schedule_commit()
+
+    async def flush(self) -> None:
+        self._commit()
+
+    def close(self):
+        self._commit()
+        with self._lock:
+            self._db.close()
+
+    # ----- not stored -----
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Promo-code engine for BoostX.
+
+config/promo_codes.json maps CODE -> settings:
+    {"SPRING10": {"percent": 10, "active": true, "min_total": 300, "no_combo": true,
+                  "max_uses": 100, "expires_at": "2026-06-01", "items": ["telegram_1273"],
+                  "categories": ["Telegram"]}}
+- percent (1..90) is required; everything else is optional
+- max_uses: global cap across all users; each user may use a code once
+- expires_at: "YYYY-MM-DD" (valid through that day), "YYYY-MM-DD HH:MM" or a unix timestamp
+- items / categories: the code only applies to these catalog item ids / category titles
+"""
+from __future__ import annotations
+import os, threading, time, uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Tuple
+
+from storage import Storage, read_json, write_json
+
+
+def _expiry_ts(value) -> float | None:
+    if value in (None, ""):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    for fmt, extra in (("%Y-%m-%d %H:%M", 0), ("%Y-%m-%dT%H:%M", 0), ("%Y-%m-%d", 86400)):
+        try:
+            return datetime.strptime(text, fmt).timestamp() + extra
+        except ValueError:
+            continue
+    return None
+
+
+class PromoEngine:
+    """Cached code table + usage checks with reserve -> commit / release.
+
+    reserve() validates and holds a code for one order under a lock, counting live
+    reservations against both the per-user and the global limit, so two concurrent
+    orders cannot both spend a single-use code. commit() persists the use as soon as
+    the order is paid for; release() (or the reservation TTL) gives back a reservation
+    that was never committed, refund() a committed use whose order failed.
+    """
+
+    def __init__(self, path: Path, storage: Storage, reservation_ttl: float = 600):
+        self.path = path
+        self.storage = storage
+        self.reservation_ttl = reservation_ttl
+        self._codes: Dict[str, dict] = {}
+        self._mtime: float | None = None
+        self._reservations: Dict[str, Tuple[int, str, float]] = {}  # token -> (user_id, code, expires)
+        self._lock = threading.RLock()
+
+    # code table
+
+    def codes(self) -> Dict[str, dict]:
+        """Code table, re-read only when the file's mtime changes."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime or mtime is None:
+                raw = read_json(self.path, {}) or {}
+                self._codes = {str(k).strip().upper(): v for k, v in raw.items() if isinstance(v, dict)}
+                self._mtime = mtime
+            return self._codes
+
+    def save(self, data: dict):
+        write_json(self.path, data)
+        with self._lock:
+            self._codes = {str(k).strip().upper(): v for k, v in data.items() if isinstance(v, dict)}
+            self._mtime = None  # pick up the real mtime on next read
+
+    def get(self, code: str) -> dict | None:
+        return self.codes().get((code or "").strip().upper())
+
+    # validation
+
+    def _live(self, now: float):
+        for token, (_, _, expires) in list(self._reservations.items()):
+            if expires <= now:
+                del self._reservations[token]
+
+    def _check(self, code_u: str, cfg: dict | None, user_id: int, base_cost: float | None,
+               item_id: str | None, category: str | None, is_combo: bool, now: float,
+               skip_token: str | None = None) -> Tuple[bool, str, int]:
+        if not cfg or not cfg.get("active", True):
+            return False, "Промокод не найден или не активен.", 0
+        percent = int(cfg.get("percent", 0) or 0)
+        if percent <= 0 or percent > 90:
+            return False, "Некорректная скидка у промокода.", 0
+        expires = _expiry_ts(cfg.get("expires_at"))
+        if expires is not None and now >= expires:
+            return False, "Срок действия промокода истёк.", 0
+        if is_combo and cfg.get("no_combo", True):
+            return False, "Промокод не применяется к комбо-наборам.", 0
+        items, cats = cfg.get("items"), cfg.get("categories")
+        if (items or cats) and (item_id is not None or category is not None):
+            if str(item_id or "") not in {str(i) for i in (items or [])} and (category or "") not in set(cats or []):
+                return False, "Промокод не действует для этой услуги.", 0
+        min_total = float(cfg.get("min_total", 0) or 0)
+        if base_cost is not None and min_total and float(base_cost) < min_total:
+            return False, f"Промокод действует от {min_total:.0f} ₽.", 0
+        held = [(uid, c) for t, (uid, c, _) in self._reservations.items() if c == code_u and t != skip_token]
+        if self.storage.promo_is_used(user_id, code_u) or any(uid == int(user_id) for uid, _ in held):
+            return False, "Этот промокод уже использован вами.", 0
+        max_uses = int(cfg.get("max_uses", 0) or 0)
+        if max_uses and self.storage.promo_use_count(code_u) + len(held) >= max_uses:
+            return False, "Лимит использований промокода исчерпан.", 0
+        return True, "", percent
+
+    def validate(self, code: str, user_id: int, base_cost: float | None = None, item_id: str | None = None,
+                 category: str | None = None, is_combo: bool = False) -> Tuple[bool, str, int]:
+        """(ok, message, percent) without holding anything."""
+        code_u = (code or "").strip().upper()
+        if not code_u:
+            return False, "Введите промокод.", 0
+        now = time.time()
+        with self._lock:
+            self._live(now)
+            return self._check(code_u, self.get(code_u), user_id, base_cost, item_id, category, is_combo, now)
+
+    # reserve -> commit / release
+
+    def reserve(self, code: str, user_id: int, base_cost: float | None = None, item_id: str | None = None,
+                category: str | None = None, is_combo: bool = False) -> Tuple[str | None, str, int]:
+        """(token, message, percent); token is None when the code can't be used."""
+        code_u = (code or "").strip().upper()
+        if not code_u:
+            return None, "Введите промокод.", 0
+        now = time.time()
+        with self._lock:
+            self._live(now)
+            ok, msg, percent = self._check(code_u, self.get(code_u), user_id, base_cost, item_id, category, is_combo, now)
+            if not ok:
+                return None, msg, 0
+            token = uuid.uuid4().hex
+            self._reservations[token] = (int(user_id), code_u, now + self.reservation_ttl)
+            return token, "", percent
+
+    def commit(self, token: str) -> bool:
+        with self._lock:
+            held = self._reservations.pop(token, None)
+            if held is None:
+                return False
+            user_id, code_u, _ = held
+            return self.storage.promo_mark_used(user_id, code_u)
+
+    def release(self, token: str | None):
+        if token:
+            with self._lock:
+                self._reservations.pop(token, None)
+
+    def refund(self, user_id: int, code: str) -> bool:
+        """Give back a committed use, e.g. when the order it was spent on failed and was refunded."""
+        with self._lock:
+            return self.storage.promo_unmark_used(user_id, (code or "").strip().upper())
@@ -1,21 +1,32 @@
 
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import os, json, asyncio, time, uuid, re
+import os, asyncio, time, uuid, re, atexit, copy, hashlib, hmac
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 
 from dotenv import load_dotenv
 from aiohttp import web
-import requests
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
-    ApplicationBuilder, Application, Defaults, CommandHandler, CallbackQueryHandler,
+    ApplicationBuilder, Application, BaseUpdateProcessor, Defaults, CommandHandler, CallbackQueryHandler,
     ConversationHandler, MessageHandler, ContextTypes, filters
 )
 
+from broadcast import Broadcaster
+from callbacks import Router, encode as cb
+from media import AssetRegistry
+from metrics import REGISTRY as METRICS, instrument_application
+from persistence import SqlitePersistence
+from looksmm import CircuitBreaker, CircuitOpen, LooksMMClient, LooksMMError, ServicesCache, StatusPoller, Submitter
+from promo import PromoEngine
+from storage import WRITER, JsonStorage, SqliteStorage, Storage, supplier_slots, read_json as _read_json, write_json as _write_json
+from supervisor import Supervisor
+
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN","").strip()
 ADMIN_ID = int(os.getenv("ADMIN_ID","0"))
@@ -26,29 +37,202 @@ CATALOG_PATH = Path("config/config.json")
 MAP_PATH = Path("config/service_map.json")
 
 BALANCES_FILE = Path("balances.json")
-ORDERS_FILE = Path("orders.json")
-INVOICES_FILE = Path("invoices.json")
+LEDGER_FILE = Path("ledger.jsonl")
+LEDGER_SNAPSHOT_FILE = Path("ledger.snapshot.json")
+ORDERS_FILE = Path("orders.json")  # legacy array, migrated once into ORDERS_LOG_FILE
+ORDERS_LOG_FILE = Path("orders.jsonl")
+ORDERS_INDEX_FILE = Path("orders.idx.json")
+INVOICES_FILE = Path("invoices.json")  # open invoices only
+INVOICES_ARCHIVE_FILE = Path("invoices_archive.jsonl")  # settled (paid / expired), append-only
 USERS_FILE = Path("users.json")
+USERS_LOG_FILE = Path("users.log")
 EXPENSES_FILE = Path("expenses.json")
+FINANCE_ROLLUP_FILE = Path("finance_rollup.json")
 
 PROMO_CODES_PATH = Path("config/promo_codes.json")
 PROMO_USES_FILE = Path("promo_uses.json")
+PROMO_USES_LOG_FILE = Path("promo_uses.log")
+LOOKSMM_SERVICES_FILE = Path("looksmm_services.json")
+BROADCAST_FILE = Path("broadcast.json")  # running broadcast job + checkpoint
+FILE_IDS_FILE = Path("file_ids.json")  # Telegram file_id per image sha256
+START_IMAGE_PATHS = ["assets/start.png", "assets/welcome.png", "Добро пожаловать.png", "welcome.png"]
+CATALOG_IMAGE_PATH = "assets/catalog.png"
+
+# Update delivery: "polling" (getUpdates) or "webhook" (Telegram POSTs updates to the HTTP server on PORT).
+# Webhook mode needs the public https base URL; the path and secret have stable defaults.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if WEBHOOK_URL else "polling").strip().lower()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+
+# Storage backend: "json" (default, files above) or "sqlite" (SQLITE_PATH, WAL mode)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", "boostx.db"))
+# Stores keep state in memory; pending changes are written every N seconds and at shutdown
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "2"))
+# user_data and conversation states survive restarts: changed keys are committed to STATE_DB_PATH every N seconds
+STATE_DB_PATH = Path(os.getenv("STATE_DB_PATH", "state.db"))
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "500"))
+# Pending invoices older than this (seconds) are expired; settled ones are archived every sweep
+INVOICE_PENDING_TTL = int(os.getenv("INVOICE_PENDING_TTL", str(72*3600)))
+INVOICE_SWEEP_INTERVAL = float(os.getenv("INVOICE_SWEEP_INTERVAL", "600"))
+# Supplier service list (min/max limits) is refreshed in the background after this many seconds
+LOOKSMM_SERVICES_TTL = float(os.getenv("LOOKSMM_SERVICES_TTL", "900"))
+# Supplier API: pooled keep-alive connections, at most N calls in flight, per-call timeout (seconds)
+LOOKSMM_MAX_CONCURRENCY = int(os.getenv("LOOKSMM_MAX_CONCURRENCY", "8"))
+LOOKSMM_TIMEOUT = float(os.getenv("LOOKSMM_TIMEOUT", "30"))
+# Combo packages: components are submitted in parallel (cap below). If some fail, the placed ones are
+# cancelled at the supplier ("cancel") or kept ("refund_failed"); the user gets back the share of what isn't running
+COMBO_DISPATCH_CONCURRENCY = int(os.getenv("COMBO_DISPATCH_CONCURRENCY", "4"))
+COMBO_PARTIAL_POLICY = os.getenv("COMBO_PARTIAL_POLICY", "cancel").strip().lower()
+LOOKSMM = LooksMMClient(LOOKSMM_KEY, max_concurrency=LOOKSMM_MAX_CONCURRENCY, timeout=LOOKSMM_TIMEOUT)
+# Supplier order statuses are checked every N seconds (each order less often as it ages)
+ORDER_STATUS_POLL_INTERVAL = float(os.getenv("ORDER_STATUS_POLL_INTERVAL", "30"))
+# Order submission: retries for failures that can't have created an order; after N consecutive supplier
+# failures the breaker opens for COOLDOWN seconds and new orders are stored as "queued" instead of waiting
+LOOKSMM_SUBMIT_RETRIES = int(os.getenv("LOOKSMM_SUBMIT_RETRIES", "3"))
+LOOKSMM_BREAKER_THRESHOLD = int(os.getenv("LOOKSMM_BREAKER_THRESHOLD", "5"))
+LOOKSMM_BREAKER_COOLDOWN = float(os.getenv("LOOKSMM_BREAKER_COOLDOWN", "30"))
+QUEUED_RETRY_INTERVAL = float(os.getenv("QUEUED_RETRY_INTERVAL", "15"))
+# Order outbox: confirmed orders are queued on disk and sent to the supplier by this many workers
+ORDER_WORKERS = int(os.getenv("ORDER_WORKERS", "8"))
+# Broadcasts: messages per second (Telegram allows ~30) and concurrent sends
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+SUBMITTER = Submitter(LOOKSMM, CircuitBreaker(LOOKSMM_BREAKER_THRESHOLD, LOOKSMM_BREAKER_COOLDOWN),
+                      retries=LOOKSMM_SUBMIT_RETRIES)
+# json writes to the same file within this window (seconds) are committed once
+WRITER.window = float(os.getenv("JSON_WRITE_WINDOW", "0.05"))
+
+def _open_storage() -> Storage:
+    def json_storage() -> JsonStorage:
+        return JsonStorage(
+            balances_path=BALANCES_FILE, ledger_path=LEDGER_FILE, ledger_snapshot_path=LEDGER_SNAPSHOT_FILE,
+            orders_log_path=ORDERS_LOG_FILE, orders_index_path=ORDERS_INDEX_FILE, orders_legacy_path=ORDERS_FILE,
+            invoices_path=INVOICES_FILE, invoices_archive_path=INVOICES_ARCHIVE_FILE, users_path=USERS_FILE, users_log_path=USERS_LOG_FILE, expenses_path=EXPENSES_FILE,
+            promo_uses_path=PROMO_USES_FILE, promo_uses_log_path=PROMO_USES_LOG_FILE, finance_path=FINANCE_ROLLUP_FILE, ledger_snapshot_every=LEDGER_SNAPSHOT_EVERY,
+        )
+    if STORAGE_BACKEND == "sqlite":
+        fresh = not SQLITE_PATH.exists()
+        db = SqliteStorage(SQLITE_PATH)
+        if fresh:
+            db.import_from(json_storage())
+            print(f"📦 SQLite storage created at {SQLITE_PATH} (imported json state)")
+        return db
+    return json_storage()
+
+STORAGE = _open_storage()
+atexit.register(STORAGE.close)
+PERSISTENCE = SqlitePersistence(STATE_DB_PATH, update_interval=PERSISTENCE_INTERVAL)
+atexit.register(PERSISTENCE.close)
+PROMOS = PromoEngine(PROMO_CODES_PATH, STORAGE)
+ASSETS = AssetRegistry(FILE_IDS_FILE)
+SUPERVISOR = Supervisor()
+BOT_APP: Application | None = None  # running Application, set by run_bot()
+BROADCASTER = Broadcaster(BROADCAST_FILE, STORAGE, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+
+# Callback actions for catalog and admin buttons: callback_data is cb(action, *int_args), e.g. cb(CB_ITEM, 3, 12) == "i:3:c".
+# Each action has one entry in ROUTER (see build_application); handlers read their args from context.args.
+CB_CATALOG, CB_CATEGORY, CB_ITEM = "catalog", "k", "i"
+A_MENU, A_CANCEL = "a", "ax"
+A_PRICE, A_PRICE_CAT, A_PRICE_ITEM = "ap", "apc", "api"
+A_ADD_CAT, A_ADD_ITEM, A_ADD_ITEM_CAT, A_ADD_ITEM_SUPPLIER = "aac", "aai", "aaic", "aais"
+A_DELETE, A_DEL_CAT, A_DEL_CAT_PICK, A_DEL_ITEM, A_DEL_ITEM_CAT, A_DEL_ITEM_PICK, A_DEL_CONFIRM = "ad", "adc", "adcp", "adi", "adic", "adip", "ady"
+A_BROADCAST, A_STATS, A_EXP_ADD = "ab", "as", "ae"
+A_DESC, A_DESC_CAT, A_DESC_CAT_PICK, A_DESC_ITEM, A_DESC_ITEM_CAT, A_DESC_ITEM_PICK, A_DESC_EDIT, A_DESC_DELETE = "ds", "dsc", "dscp", "dsi", "dsic", "dsip", "dse", "dsx"
 
-def _read_json(path: Path, default):
-    try:
-        if not path.exists(): return default
-        return json.loads(path.read_text(encoding="utf-8"))
-    except Exception:
-        return default
+# --------------------
+# Catalog cache
+# - config.json is parsed again only when its mtime changes or save_catalog() bumps the version
+# - keyboards for the catalog root and for each category are built once, prices already formatted
+# - on any change only the keyboards whose category (or the category title list) differs are dropped
+# - the cached dict is shared: handlers that edit it take load_catalog(for_edit=True), a private copy
+# --------------------
 
-def _write_json(path: Path, data):
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+class CatalogCache:
+    def __init__(self, path: Path):
+        self.path = path
+        self.version = 0
+        self._data: Dict[str, Any] | None = None
+        self._mtime: float | None = None
+        self._root_kb: InlineKeyboardMarkup | None = None
+        self._cat_views: Dict[int, Tuple[str, InlineKeyboardMarkup]] = {}
 
-def load_catalog() -> Dict[str, Any]:
-    data = _read_json(CATALOG_PATH, {"pricing_multiplier":1.0, "categories":[]})
-    data.setdefault("pricing_multiplier", 1.0)
-    data.setdefault("categories", [])
-    return data
+    def _stat(self) -> float | None:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _replace(self, data: Dict[str, Any]):
+        data.setdefault("pricing_multiplier", 1.0)
+        data.setdefault("categories", [])
+        old = self._data
+        if old is None or old.get("pricing_multiplier") != data.get("pricing_multiplier"):
+            self._root_kb = None; self._cat_views = {}
+        else:
+            old_cats, new_cats = old.get("categories", []), data.get("categories", [])
+            if [c.get("title") for c in old_cats] != [c.get("title") for c in new_cats]:
+                self._root_kb = None
+            for i in list(self._cat_views):
+                if i >= len(new_cats) or i >= len(old_cats) or old_cats[i] != new_cats[i]:
+                    del self._cat_views[i]
+        self._data = data
+        self.version += 1
+
+    def data(self) -> Dict[str, Any]:
+        mtime = self._stat()
+        if self._data is None or mtime != self._mtime:
+            self._replace(_read_json(self.path, {"pricing_multiplier":1.0, "categories":[]}))
+            self._mtime = mtime
+        return self._data
+
+    def save(self, data: Dict[str, Any]):
+        _write_json(self.path, data)
+        WRITER.flush(self.path)  # commit now so the new mtime is ours, not an external edit
+        self._replace(data)
+        self._mtime = self._stat()
+
+    def root_keyboard(self) -> InlineKeyboardMarkup:
+        cats = self.data().get("categories", [])
+        if self._root_kb is None:
+            self._root_kb = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(c.get("title","Категория"), callback_data=cb(CB_CATEGORY, i))] for i,c in enumerate(cats)]
+            )
+        return self._root_kb
+
+    def category_view(self, idx: int) -> Tuple[str, InlineKeyboardMarkup] | None:
+        """(header html, keyboard) for category idx, or None if it doesn't exist."""
+        data = self.data(); cats = data.get("categories", [])
+        if idx < 0 or idx >= len(cats):
+            return None
+        view = self._cat_views.get(idx)
+        if view is None:
+            cat = cats[idx]
+            unit = cat.get("unit","per_1000")
+            mult = float(data.get("pricing_multiplier", 1.0))
+            rows = []
+            for i, item in enumerate(cat.get("items", [])):
+                item_unit = item.get("unit", unit)
+                label = f"{item.get('title','Услуга')} — {price_str(item.get('price',0), item_unit, mult)}"
+                rows.append([InlineKeyboardButton(label[:64], callback_data=cb(CB_ITEM, idx, i))])
+            rows.append([InlineKeyboardButton("⬅️ Назад к категориям", callback_data=cb(CB_CATALOG))])
+            desc = (cat.get('description') or '').strip()
+            header = f"<b>{cat.get('title','Категория')}</b>" + (f"\n\n{desc}" if desc else '')
+            view = self._cat_views[idx] = (header, InlineKeyboardMarkup(rows))
+        return view
+
+
+CATALOG = CatalogCache(CATALOG_PATH)
+
+def load_catalog(for_edit: bool = False) -> Dict[str, Any]:
+    """Parsed config.json; shared and read-only unless for_edit (then a copy to pass to save_catalog)."""
+    data = CATALOG.data()
+    return copy.deepcopy(data) if for_edit else data
+
+def save_catalog(data: Dict[str, Any]):
+    CATALOG.save(data)
 
 def load_map() -> Dict[str, int]:
     raw = _read_json(MAP_PATH, {})
@@ -77,23 +261,76 @@ def load_map() -> Dict[str, int]:
     return mapping
 
 def get_balance(user_id: int) -> float:
-    rows = _read_json(BALANCES_FILE, [])
-    for r in rows:
-        if r.get("user_id")==user_id:
-            return float(r.get("balance",0))
-    return 0.0
+    return STORAGE.get_balance(user_id)
 
 def set_balance(user_id: int, value: float) -> float:
-    rows = _read_json(BALANCES_FILE, [])
-    for r in rows:
-        if r.get("user_id")==user_id:
-            r["balance"] = float(value); _write_json(BALANCES_FILE, rows); return float(value)
-    rows.append({"user_id": user_id, "balance": float(value)})
-    _write_json(BALANCES_FILE, rows)
-    return float(value)
+    return STORAGE.set_balance(user_id, value)
+
+def add_balance(user_id: int, delta: float, kind: str = "adjust", ref: str | None = None, note: str = "") -> float:
+    """Post a ledger movement. kind: topup / debit / refund / grant / adjust."""
+    return STORAGE.add_balance(user_id, delta, kind, ref, note)
+
+def debit_if_sufficient(user_id: int, amount: float, ref: str | None = None, note: str = "") -> Tuple[bool, float]:
+    """Atomic check-and-debit. Returns (ok, balance)."""
+    return STORAGE.debit_if_sufficient(user_id, amount, ref, note)
 
-def add_balance(user_id: int, delta: float) -> float:
-    return set_balance(user_id, get_balance(user_id)+float(delta))
+def credit(user_id: int, amount: float, kind: str = "refund", ref: str | None = None, note: str = "") -> float:
+    return STORAGE.credit(user_id, amount, kind, ref, note)
+
+
+# --------------------
+# Concurrency
+# Updates of different users are processed concurrently; updates of one user are
+# serialized by a per-user lock, so conversation state and the order path never
+# interleave for the same user. Balance changes additionally go through the atomic
+# debit_if_sufficient/credit primitives, which also covers admin credits to other users.
+# --------------------
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+
+class UserLocks:
+    """asyncio.Lock per user_id; a lock is dropped once nobody holds or waits for it."""
+
+    def __init__(self):
+        self._locks: Dict[int, list] = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        uid = int(user_id)
+        entry = self._locks.get(uid)
+        if entry is None:
+            entry = self._locks[uid] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(uid, None)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+USER_LOCKS = UserLocks()
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await coroutine
+            return
+        async with USER_LOCKS.hold(user.id):
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 def create_invoice(user_id: int, amount: float, note: str="") -> dict:
     inv = {
@@ -105,24 +342,10 @@ def create_invoice(user_id: int, amount: float, note: str="") -> dict:
         "created_at": int(time.time()),
         "paid_at": None
     }
-    data = _read_json(INVOICES_FILE, []); data.append(inv); _write_json(INVOICES_FILE, data)
-    return inv
+    return STORAGE.create_invoice(inv)
 
 def confirm_invoice(invoice_id: str) -> dict|None:
-    data = _read_json(INVOICES_FILE, [])
-    for inv in data:
-        if inv.get("invoice_id")==invoice_id and inv.get("status")!="paid":
-            inv["status"]="paid"; inv["paid_at"]=int(time.time())
-            _write_json(INVOICES_FILE, data)
-            add_balance(inv["user_id"], inv["amount"])
-            return inv
-    return None
-
-def _load_users() -> dict:
-    return _read_json(USERS_FILE, {"users": []})
-
-def _save_users(data: dict):
-    _write_json(USERS_FILE, data)
+    return STORAGE.confirm_invoice(invoice_id)
 
 def remember_user(user_id: int):
     """Store user_id for broadcasts/stats. Safe to call often."""
@@ -130,93 +353,84 @@ def remember_user(user_id: int):
         uid = int(user_id)
     except Exception:
         return
-    data = _load_users()
-    lst = data.setdefault("users", [])
-    if uid not in lst:
-        lst.append(uid)
-        _save_users(data)
+    STORAGE.remember_user(uid)
 
 def get_all_user_ids() -> List[int]:
-    """Best-effort list of known users (users.json + balances/orders/invoices)."""
-    ids = set()
-    try:
-        for uid in (_load_users().get("users") or []):
-            try: ids.add(int(uid))
-            except Exception: pass
-    except Exception:
-        pass
-
-    for row in (_read_json(BALANCES_FILE, []) or []):
-        if isinstance(row, dict) and "user_id" in row:
-            try: ids.add(int(row["user_id"]))
-            except Exception: pass
-
-    for inv in (_read_json(INVOICES_FILE, []) or []):
-        if isinstance(inv, dict) and "user_id" in inv:
-            try: ids.add(int(inv["user_id"]))
-            except Exception: pass
+    """Known users (users + balances/orders/invoices); the registry is maintained on write."""
+    return [uid for uid in STORAGE.user_ids() if uid]
 
-    for o in (_read_json(ORDERS_FILE, []) or []):
-        if isinstance(o, dict) and "user_id" in o:
-            try: ids.add(int(o["user_id"]))
-            except Exception: pass
-
-    ids.discard(0)
-    return sorted(ids)
+def get_broadcast_user_ids() -> List[int]:
+    """Known users minus those who blocked the bot."""
+    return STORAGE.broadcast_user_ids()
 
 
 
 
 def _load_promo_codes() -> dict:
-    return _read_json(PROMO_CODES_PATH, {})
+    return PROMOS.codes()
 
 def _save_promo_codes(data: dict):
-    _write_json(PROMO_CODES_PATH, data)
+    PROMOS.save(data)
 
-def _load_promo_uses() -> dict:
-    return _read_json(PROMO_USES_FILE, {"users": {}})
+def promo_is_used(user_id: int, code: str) -> bool:
+    return STORAGE.promo_is_used(user_id, code)
 
-def _save_promo_uses(data: dict):
-    _write_json(PROMO_USES_FILE, data)
+def promo_mark_used(user_id: int, code: str) -> bool:
+    return STORAGE.promo_mark_used(user_id, code)
 
-def promo_is_used(user_id: int, code: str) -> bool:
-    data = _load_promo_uses()
-    return code.upper() in set(data.get("users", {}).get(str(user_id), []))
-
-def promo_mark_used(user_id: int, code: str):
-    data = _load_promo_uses()
-    users = data.setdefault("users", {})
-    lst = users.setdefault(str(user_id), [])
-    code_u = code.upper()
-    if code_u not in lst:
-        lst.append(code_u)
-    _save_promo_uses(data)
-
-def promo_validate(code: str, base_cost: float, user_id: int, allow_for_combo: bool=False) -> tuple[bool, str, int]:
-    code_u = (code or "").strip().upper()
-    if not code_u:
-        return False, "Введите промокод.", 0
-    promos = _load_promo_codes()
-    cfg = promos.get(code_u)
-    if not cfg or not cfg.get("active", True):
-        return False, "Промокод не найден или не активен.", 0
-    percent = int(cfg.get("percent", 0) or 0)
-    if percent <= 0 or percent > 90:
-        return False, "Некорректная скидка у промокода.", 0
-    min_total = float(cfg.get("min_total", 0) or 0)
-    if min_total and float(base_cost) < min_total:
-        return False, f"Промокод действует от {min_total:.0f} ₽.", 0
-    if promo_is_used(user_id, code_u):
-        return False, "Этот промокод уже использован вами.", 0
-    if not allow_for_combo and cfg.get("no_combo", True):
-        # запрещаем для комбо по умолчанию
-        return True, "", percent
-    return True, "", percent
+def promo_validate(code: str, base_cost: float, user_id: int, allow_for_combo: bool=False,
+                   item_id: str|None=None, category: str|None=None) -> tuple[bool, str, int]:
+    # allow_for_combo=True: the order is a combo, so the code's no_combo flag (default on) decides
+    return PROMOS.validate(code, user_id, base_cost=base_cost, item_id=item_id, category=category,
+                           is_combo=allow_for_combo)
 
 def apply_discount(cost: float, percent: int) -> float:
     return max(0.0, float(cost) * (1.0 - (float(percent)/100.0)))
 
 
+# --------------------
+# Navigation
+# - menu screens replace the message whose button was pressed (edit_message_text), so the
+#   chat keeps one live menu instead of a trail of stale keyboards
+# - nothing is sent when the text and keyboard are already on screen; a keyboard-only change
+#   uses edit_message_reply_markup
+# - a new message is sent only when the origin can't be edited (commands, photos, deleted messages)
+#   or the button is marked with NEW_SCREEN (receipts and notices that must stay in the chat)
+# --------------------
+
+NEW_SCREEN = "+"  # callback_data suffix: open the screen below instead of replacing this message
+
+async def edit_screen(update: Update, text: str, reply_markup: InlineKeyboardMarkup | None = None) -> Message | None:
+    """Show the screen in the pressed message; None if that message can't be edited."""
+    q = update.callback_query
+    msg = q.message if q else None
+    if not isinstance(msg, Message) or msg.text is None or (q.data or "").endswith(NEW_SCREEN):
+        return None
+    same_text = msg.text_html == text
+    if same_text and msg.reply_markup == reply_markup:
+        return msg
+    try:
+        if same_text:
+            await msg.edit_reply_markup(reply_markup=reply_markup)
+        else:
+            await msg.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup,
+                                disable_web_page_preview=True)
+        return msg
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return msg
+    except TelegramError:
+        pass
+    return None
+
+async def show_screen(update: Update, text: str, reply_markup: InlineKeyboardMarkup | None = None) -> Message:
+    """Edit the pressed message in place, or send the screen as a new message."""
+    edited = await edit_screen(update, text, reply_markup)
+    if edited is not None:
+        return edited
+    return await update.effective_message.reply_html(text, reply_markup=reply_markup, disable_web_page_preview=True)
+
+
 # --------------------
 # Admin panel
 # - Edit base price for one item (client price = base * pricing_multiplier)
@@ -250,31 +464,31 @@ def _new_item_id(cat_title: str, item_title: str) -> str:
 
 def _admin_kb_main() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton('💲 Изменить цену товара', callback_data='admin_price')],
-        [InlineKeyboardButton('➕ Добавить категорию', callback_data='admin_add_cat')],
-        [InlineKeyboardButton('➕ Добавить товар', callback_data='admin_add_item')],
-        [InlineKeyboardButton('🗑 Удаление', callback_data='admin_delete')],
-        [InlineKeyboardButton('📣 Рассылка', callback_data='admin_broadcast')],
-        [InlineKeyboardButton('📊 Финансы', callback_data='admin_stats')],
-        [InlineKeyboardButton('📝 Описания', callback_data='admin_desc')],
-        [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
+        [InlineKeyboardButton('💲 Изменить цену товара', callback_data=cb(A_PRICE))],
+        [InlineKeyboardButton('➕ Добавить категорию', callback_data=cb(A_ADD_CAT))],
+        [InlineKeyboardButton('➕ Добавить товар', callback_data=cb(A_ADD_ITEM))],
+        [InlineKeyboardButton('🗑 Удаление', callback_data=cb(A_DELETE))],
+        [InlineKeyboardButton('📣 Рассылка', callback_data=cb(A_BROADCAST))],
+        [InlineKeyboardButton('📊 Финансы', callback_data=cb(A_STATS))],
+        [InlineKeyboardButton('📝 Описания', callback_data=cb(A_DESC))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
     ])
 
 
-def _cat_buttons(cats, prefix: str, back_cb: str = 'admin'):
+def _cat_buttons(cats, action: str, back_cb: str):
     rows = []
     for i, c in enumerate(cats):
-        rows.append([InlineKeyboardButton(c.get('title', f'Категория {i+1}'), callback_data=f"{prefix}{i}")])
+        rows.append([InlineKeyboardButton(c.get('title', f'Категория {i+1}'), callback_data=cb(action, i))])
     rows.append([InlineKeyboardButton('⬅️ Назад', callback_data=back_cb)])
     return InlineKeyboardMarkup(rows)
 
 
-def _item_buttons(cat, cidx: int, prefix: str, back_cb: str):
+def _item_buttons(cat, cidx: int, action: str, back_cb: str):
     rows = []
     items = cat.get('items', []) or []
     for i, it in enumerate(items):
         title = it.get('title', f'Товар {i+1}')
-        rows.append([InlineKeyboardButton(title[:64], callback_data=f"{prefix}{cidx}_{i}")])
+        rows.append([InlineKeyboardButton(title[:64], callback_data=cb(action, cidx, i))])
     rows.append([InlineKeyboardButton('⬅️ Назад', callback_data=back_cb)])
     return InlineKeyboardMarkup(rows)
 
@@ -292,7 +506,7 @@ async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         q = update.callback_query
         if q:
             await q.answer()
-            await q.message.reply_html("🛠 <b>Админ-панель</b>\n\nВыберите действие:", reply_markup=kb)
+            await show_screen(update, "🛠 <b>Админ-панель</b>\n\nВыберите действие:", reply_markup=kb)
     return ADMIN_MENU
 
 
@@ -330,7 +544,7 @@ async def admin_price_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text('Категорий нет.')
         return ADMIN_MENU
 
-    await q.message.reply_html('💲 <b>Выберите категорию</b>', reply_markup=_cat_buttons(cats, 'admin_cat_', 'admin'))
+    await show_screen(update, '💲 <b>Выберите категорию</b>', reply_markup=_cat_buttons(cats, A_PRICE_CAT, cb(A_MENU)))
     return ADMIN_SELECT_CAT
 
 
@@ -341,71 +555,37 @@ async def admin_choose_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not _is_admin(uid):
         return ConversationHandler.END
 
-    # Two entry points:
-    # 1) admin_cat_{i} (edit price)
-    # 2) admin_desc_cat_{i} (descriptions)
     data = load_catalog()
     cats = data.get('categories', [])
+    try:
+        cidx = int(context.args[0])
+    except Exception:
+        await q.message.reply_text('Ошибка выбора категории.')
+        return ADMIN_MENU
 
-    if q.data.startswith('admin_cat_'):
-        try:
-            cidx = int(q.data.split('_')[-1])
-        except Exception:
-            await q.message.reply_text('Ошибка выбора категории.')
-            return ADMIN_MENU
+    if cidx < 0 or cidx >= len(cats):
+        await q.message.reply_text('Категория не найдена.')
+        return ADMIN_MENU
 
-        if cidx < 0 or cidx >= len(cats):
-            await q.message.reply_text('Категория не найдена.')
-            return ADMIN_MENU
+    cat = cats[cidx]
+    items = cat.get('items', [])
+    if not items:
+        await q.message.reply_text('В этой категории нет товаров.')
+        return ADMIN_SELECT_CAT
 
-        cat = cats[cidx]
-        items = cat.get('items', [])
-        if not items:
-            await q.message.reply_text('В этой категории нет товаров.')
-            return ADMIN_SELECT_CAT
-
-        context.user_data['admin_edit'] = {'cat_idx': cidx}
-
-        mult = float(data.get('pricing_multiplier', 1.0))
-        unit_default = cat.get('unit', 'per_1000')
-        rows = []
-        for i, it in enumerate(items):
-            base = float(it.get('price', 0) or 0)
-            unit = it.get('unit', unit_default)
-            label = f"{it.get('title','Товар')} — база {base:g} → {price_str(base, unit, mult)}"
-            rows.append([InlineKeyboardButton(label[:64], callback_data=f"admin_item_{cidx}_{i}")])
-        rows.append([InlineKeyboardButton('⬅️ Назад к категориям', callback_data='admin_price')])
-        await q.message.reply_html(f"💲 <b>{cat.get('title','Категория')}</b>\n\nВыберите товар:", reply_markup=InlineKeyboardMarkup(rows))
-        return ADMIN_SELECT_ITEM
-
-    # description flow category select
-    if q.data.startswith('admin_desc_cat_'):
-        try:
-            cidx = int(q.data.split('_')[-1])
-        except Exception:
-            await q.message.reply_text('Ошибка выбора категории.')
-            return ADMIN_DESC_MENU
-        if cidx < 0 or cidx >= len(cats):
-            await q.message.reply_text('Категория не найдена.')
-            return ADMIN_DESC_MENU
-        context.user_data['admin_desc'] = {'target': 'category', 'cat_idx': cidx}
-        cat = cats[cidx]
-        desc = (cat.get('description') or '').strip()
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton('✏️ Изменить описание', callback_data='admin_desc_edit')],
-            [InlineKeyboardButton('🗑 Удалить описание', callback_data='admin_desc_delete')],
-            [InlineKeyboardButton('⬅️ Назад', callback_data='admin_desc_cat')],
-            [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
-        ])
-        msg = ("📝 <b>Описание категории</b>\n\n"
-       f"Категория: <b>{cat.get('title','Категория')}</b>\n\n"
-       "Текущее описание:\n"
-       f"<code>{desc if desc else '— нет —'}</code>\n\n"
-       "Выберите действие:")
-        await q.message.reply_html(msg, reply_markup=kb)
-        return ADMIN_DESC_MENU
+    context.user_data['admin_edit'] = {'cat_idx': cidx}
 
-    return ADMIN_MENU
+    mult = float(data.get('pricing_multiplier', 1.0))
+    unit_default = cat.get('unit', 'per_1000')
+    rows = []
+    for i, it in enumerate(items):
+        base = float(it.get('price', 0) or 0)
+        unit = it.get('unit', unit_default)
+        label = f"{it.get('title','Товар')} — база {base:g} → {price_str(base, unit, mult)}"
+        rows.append([InlineKeyboardButton(label[:64], callback_data=cb(A_PRICE_ITEM, cidx, i))])
+    rows.append([InlineKeyboardButton('⬅️ Назад к категориям', callback_data=cb(A_PRICE))])
+    await show_screen(update, f"💲 <b>{cat.get('title','Категория')}</b>\n\nВыберите товар:", reply_markup=InlineKeyboardMarkup(rows))
+    return ADMIN_SELECT_ITEM
 
 
 async def admin_choose_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -415,86 +595,42 @@ async def admin_choose_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not _is_admin(uid):
         return ConversationHandler.END
 
-    # Two entry points:
-    # 1) admin_item_{cidx}_{iidx} (edit price)
-    # 2) admin_desc_item_{cidx}_{iidx} (item description)
-
     data = load_catalog()
     cats = data.get('categories', [])
+    try:
+        cidx, iidx = (int(a) for a in context.args)
+    except Exception:
+        await q.message.reply_text('Ошибка выбора товара.')
+        return ADMIN_MENU
 
-    if q.data.startswith('admin_item_'):
-        try:
-            _, _, cidx, iidx = q.data.split('_')
-            cidx = int(cidx); iidx = int(iidx)
-        except Exception:
-            await q.message.reply_text('Ошибка выбора товара.')
-            return ADMIN_MENU
-
-        if cidx < 0 or cidx >= len(cats):
-            await q.message.reply_text('Категория не найдена.')
-            return ADMIN_MENU
-        cat = cats[cidx]
-        items = cat.get('items', [])
-        if iidx < 0 or iidx >= len(items):
-            await q.message.reply_text('Товар не найден.')
-            return ADMIN_MENU
-        item = items[iidx]
+    if cidx < 0 or cidx >= len(cats):
+        await q.message.reply_text('Категория не найдена.')
+        return ADMIN_MENU
+    cat = cats[cidx]
+    items = cat.get('items', [])
+    if iidx < 0 or iidx >= len(items):
+        await q.message.reply_text('Товар не найден.')
+        return ADMIN_MENU
+    item = items[iidx]
 
-        context.user_data['admin_edit'] = {'cat_idx': cidx, 'item_idx': iidx}
+    context.user_data['admin_edit'] = {'cat_idx': cidx, 'item_idx': iidx}
 
-        mult = float(data.get('pricing_multiplier', 1.0))
-        unit = item.get('unit', cat.get('unit', 'per_1000'))
-        base = float(item.get('price', 0) or 0)
-        shown = price_str(base, unit, mult)
+    mult = float(data.get('pricing_multiplier', 1.0))
+    unit = item.get('unit', cat.get('unit', 'per_1000'))
+    base = float(item.get('price', 0) or 0)
+    shown = price_str(base, unit, mult)
 
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton('⬅️ Назад к товарам', callback_data=f"admin_cat_{cidx}")],
-            [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
-        ])
-        msg = ("✏️ <b>Изменение цены</b>\n\n"
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton('⬅️ Назад к товарам', callback_data=cb(A_PRICE_CAT, cidx))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
+    ])
+    msg = ("✏️ <b>Изменение цены</b>\n\n"
        f"Товар: <b>{item.get('title','Товар')}</b>\n"
        f"Текущая база: <code>{base:g}</code>\n"
        f"Цена клиенту (x{mult:g}): <code>{shown}</code>\n\n"
        "Введите <b>новую базовую цену</b> одним сообщением (например: <code>50</code> или <code>50.5</code>):")
-        await q.message.reply_html(msg, reply_markup=kb)
-        return ADMIN_PRICE_INPUT
-
-    if q.data.startswith('admin_desc_item_'):
-        try:
-            _, _, _, cidx, iidx = q.data.split('_')
-            cidx = int(cidx); iidx = int(iidx)
-        except Exception:
-            await q.message.reply_text('Ошибка выбора товара.')
-            return ADMIN_DESC_MENU
-
-        if cidx < 0 or cidx >= len(cats):
-            await q.message.reply_text('Категория не найдена.')
-            return ADMIN_DESC_MENU
-        cat = cats[cidx]
-        items = cat.get('items', [])
-        if iidx < 0 or iidx >= len(items):
-            await q.message.reply_text('Товар не найден.')
-            return ADMIN_DESC_MENU
-        item = items[iidx]
-
-        context.user_data['admin_desc'] = {'target': 'item', 'cat_idx': cidx, 'item_idx': iidx}
-        desc = (item.get('description') or '').strip()
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton('✏️ Изменить описание', callback_data='admin_desc_edit')],
-            [InlineKeyboardButton('🗑 Удалить описание', callback_data='admin_desc_delete')],
-            [InlineKeyboardButton('⬅️ Назад', callback_data='admin_desc_item')],
-            [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
-        ])
-        msg = ("📝 <b>Описание товара</b>\n\n"
-       f"Категория: <b>{cat.get('title','Категория')}</b>\n"
-       f"Товар: <b>{item.get('title','Товар')}</b>\n\n"
-       "Текущее описание:\n"
-       f"<code>{desc if desc else '— нет —'}</code>\n\n"
-       "Выберите действие:")
-        await q.message.reply_html(msg, reply_markup=kb)
-        return ADMIN_DESC_MENU
-
-    return ADMIN_MENU
+    await show_screen(update, msg, reply_markup=kb)
+    return ADMIN_PRICE_INPUT
 
 
 async def admin_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -514,7 +650,7 @@ async def admin_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     edit = context.user_data.get('admin_edit') or {}
     cidx = int(edit.get('cat_idx', -1))
     iidx = int(edit.get('item_idx', -1))
-    data = load_catalog()
+    data = load_catalog(for_edit=True)
     cats = data.get('categories', [])
     if cidx < 0 or cidx >= len(cats):
         await update.message.reply_text('Не удалось найти категорию. Откройте /admin заново.')
@@ -525,16 +661,16 @@ async def admin_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     items[iidx]['price'] = float(value)
-    _write_json(CATALOG_PATH, data)
+    save_catalog(data)
 
     mult = float(data.get('pricing_multiplier', 1.0))
     unit = items[iidx].get('unit', cats[cidx].get('unit', 'per_1000'))
     shown = price_str(float(value), unit, mult)
 
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('💲 Изменить другой товар', callback_data='admin_price')],
-        [InlineKeyboardButton('🛠 В админку', callback_data='admin')],
-        [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
+        [InlineKeyboardButton('💲 Изменить другой товар', callback_data=cb(A_PRICE))],
+        [InlineKeyboardButton('🛠 В админку', callback_data=cb(A_MENU))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
     ])
     msg = ("✅ Цена обновлена!\n\n"
        f"Новая база: <code>{float(value):g}</code>\n"
@@ -563,7 +699,7 @@ async def admin_add_cat_title(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text('Название не может быть пустым. Введите ещё раз:')
         return ADMIN_ADD_CAT_TITLE
 
-    data = load_catalog()
+    data = load_catalog(for_edit=True)
     cats = data.get('categories', [])
     # prevent exact duplicate titles
     if any((c.get('title','').strip().lower() == title.lower()) for c in cats):
@@ -577,7 +713,7 @@ async def admin_add_cat_title(update: Update, context: ContextTypes.DEFAULT_TYPE
         'items': [],
     })
     data['categories'] = cats
-    _write_json(CATALOG_PATH, data)
+    save_catalog(data)
 
     await update.message.reply_html('✅ Категория добавлена!')
     return await admin_start(update, context)
@@ -596,7 +732,7 @@ async def admin_add_item_entry(update: Update, context: ContextTypes.DEFAULT_TYP
         await q.message.reply_text('Сначала добавьте категорию.')
         return ADMIN_MENU
 
-    await q.message.reply_html('➕ <b>Выберите категорию</b>, куда добавляем товар:', reply_markup=_cat_buttons(cats, 'admin_add_item_cat_', 'admin'))
+    await show_screen(update, '➕ <b>Выберите категорию</b>, куда добавляем товар:', reply_markup=_cat_buttons(cats, A_ADD_ITEM_CAT, cb(A_MENU)))
     return ADMIN_ADD_ITEM_CAT
 
 
@@ -609,7 +745,7 @@ async def admin_add_item_choose_cat(update: Update, context: ContextTypes.DEFAUL
     data = load_catalog()
     cats = data.get('categories', [])
     try:
-        cidx = int(q.data.split('_')[-1])
+        cidx = int(context.args[0])
     except Exception:
         await q.message.reply_text('Ошибка выбора категории.')
         return ADMIN_MENU
@@ -659,8 +795,8 @@ async def admin_add_item_price(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data['admin_new_item'] = st
 
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('✅ Да, это накрутка (есть service_id)', callback_data='admin_add_item_supplier_yes')],
-        [InlineKeyboardButton('❌ Нет, свой товар/услуга (без service_id)', callback_data='admin_add_item_supplier_no')],
+        [InlineKeyboardButton('✅ Да, это накрутка (есть service_id)', callback_data=cb(A_ADD_ITEM_SUPPLIER, 1))],
+        [InlineKeyboardButton('❌ Нет, свой товар/услуга (без service_id)', callback_data=cb(A_ADD_ITEM_SUPPLIER, 0))],
     ])
     await update.message.reply_html('Товар связан с поставщиком накрутки (нужен <code>service_id</code>)?', reply_markup=kb)
     return ADMIN_ADD_ITEM_SUPPLIER
@@ -674,7 +810,7 @@ async def admin_add_item_supplier_choose(update: Update, context: ContextTypes.D
 
     st = context.user_data.get('admin_new_item') or {}
 
-    if q.data.endswith('_yes'):
+    if context.args and context.args[0]:
         st['use_supplier'] = True
         context.user_data['admin_new_item'] = st
         await q.message.reply_text('Введите <b>ID услуги у поставщика</b> (service_id). Только число:', parse_mode=ParseMode.HTML)
@@ -720,7 +856,7 @@ async def admin_add_item_desc(update: Update, context: ContextTypes.DEFAULT_TYPE
     price = float(st.get('price', 0) or 0)
     service_id = st.get('service_id')
 
-    data = load_catalog()
+    data = load_catalog(for_edit=True)
     cats = data.get('categories', [])
     if cidx < 0 or cidx >= len(cats):
         await update.message.reply_text('Категория не найдена. Откройте /admin заново.')
@@ -737,7 +873,7 @@ async def admin_add_item_desc(update: Update, context: ContextTypes.DEFAULT_TYPE
         'type': 'single',
     })
 
-    _write_json(CATALOG_PATH, data)
+    save_catalog(data)
 
     mult = float(data.get('pricing_multiplier', 1.0))
     unit = cat.get('unit', 'per_1000')
@@ -754,47 +890,15 @@ async def admin_add_item_desc(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # ----- Deletion / Broadcast / Finance -----
 
-def _expense_rows() -> List[dict]:
-    return _read_json(EXPENSES_FILE, [])
-
 def add_expense(amount: float, note: str = "") -> dict:
     row = {"amount": float(amount), "note": note, "created_at": int(time.time())}
-    rows = _expense_rows()
-    rows.append(row)
-    _write_json(EXPENSES_FILE, rows)
-    return row
-
-def _sum_by_period(rows: List[dict], ts_field: str, now_ts: int) -> Dict[str, float]:
-    # periods: day(24h), week(7d), month(30d) rolling windows
-    periods = {"day": 86400, "week": 7*86400, "month": 30*86400}
-    out = {k: 0.0 for k in periods}
-    for r in rows:
-        try:
-            ts = int(r.get(ts_field) or 0)
-        except Exception:
-            continue
-        for k, secs in periods.items():
-            if ts and (now_ts - ts) <= secs:
-                try:
-                    if "amount" in r:
-                        out[k] += float(r.get("amount") or 0)
-                    elif "sum" in r:
-                        out[k] += float(r.get("sum") or 0)
-                except Exception:
-                    pass
-    return out
+    return STORAGE.add_expense(row)
 
 def _finance_snapshot() -> Dict[str, Dict[str, float]]:
-    now_ts = int(time.time())
-    invs = [i for i in (_read_json(INVOICES_FILE, []) or []) if isinstance(i, dict) and i.get("status") == "paid"]
-    # revenue is paid invoices amount by paid_at
-    rev_rows = [{"amount": float(i.get("amount") or 0), "paid_at": int(i.get("paid_at") or 0)} for i in invs]
-    rev = _sum_by_period(rev_rows, "paid_at", now_ts)
-
-    exp_rows = [{"amount": float(e.get("amount") or 0), "created_at": int(e.get("created_at") or 0)} for e in (_expense_rows() or []) if isinstance(e, dict)]
-    exp = _sum_by_period(exp_rows, "created_at", now_ts)
-
-    prof = {k: float(rev.get(k, 0.0)) - float(exp.get(k, 0.0)) for k in ("day", "week", "month")}
+    # revenue = paid invoices by paid_at, expenses by created_at; both come from hourly rollups
+    totals = STORAGE.finance_totals(int(time.time()))
+    rev = totals["revenue"]; exp = totals["expenses"]
+    prof = {k: float(rev.get(k, 0.0)) - float(exp.get(k, 0.0)) for k in rev}
     return {"revenue": rev, "expenses": exp, "profit": prof}
 
 async def admin_delete_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -803,12 +907,12 @@ async def admin_delete_entry(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not _is_admin(q.from_user.id):
         return ConversationHandler.END
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('🗂 Удалить категорию', callback_data='admin_del_cat')],
-        [InlineKeyboardButton('📦 Удалить товар', callback_data='admin_del_item')],
-        [InlineKeyboardButton('⬅️ Назад', callback_data='admin')],
-        [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
+        [InlineKeyboardButton('🗂 Удалить категорию', callback_data=cb(A_DEL_CAT))],
+        [InlineKeyboardButton('📦 Удалить товар', callback_data=cb(A_DEL_ITEM))],
+        [InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_MENU))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
     ])
-    await q.message.reply_html('🗑 <b>Удаление</b>\n\nЧто удаляем?', reply_markup=kb)
+    await show_screen(update, '🗑 <b>Удаление</b>\n\nЧто удаляем?', reply_markup=kb)
     return ADMIN_DELETE_MENU
 
 async def admin_del_cat_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -821,7 +925,7 @@ async def admin_del_cat_entry(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not cats:
         await q.message.reply_text('Категорий пока нет.')
         return ADMIN_MENU
-    await q.message.reply_html('🗂 Выберите категорию для удаления:', reply_markup=_cat_buttons(cats, 'admin_del_cat_', 'admin_delete'))
+    await show_screen(update, '🗂 Выберите категорию для удаления:', reply_markup=_cat_buttons(cats, A_DEL_CAT_PICK, cb(A_DELETE)))
     return ADMIN_DELETE_CAT_SELECT
 
 async def admin_del_cat_choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -832,7 +936,7 @@ async def admin_del_cat_choose(update: Update, context: ContextTypes.DEFAULT_TYP
     data = load_catalog()
     cats = data.get('categories', [])
     try:
-        cidx = int(q.data.split('_')[-1])
+        cidx = int(context.args[0])
     except Exception:
         return ADMIN_MENU
     if not (0 <= cidx < len(cats)):
@@ -841,10 +945,10 @@ async def admin_del_cat_choose(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data['admin_delete'] = {"target": "category", "cat_idx": cidx}
     title = cats[cidx].get("title", "Категория")
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('✅ Да, удалить', callback_data='admin_del_confirm')],
-        [InlineKeyboardButton('❌ Отмена', callback_data='admin_delete')],
+        [InlineKeyboardButton('✅ Да, удалить', callback_data=cb(A_DEL_CONFIRM))],
+        [InlineKeyboardButton('❌ Отмена', callback_data=cb(A_DELETE))],
     ])
-    await q.message.reply_html(f"⚠️ Удалить категорию <b>{title}</b>?\n\nВсе товары внутри тоже удалятся.", reply_markup=kb)
+    await show_screen(update, f"⚠️ Удалить категорию <b>{title}</b>?\n\nВсе товары внутри тоже удалятся.", reply_markup=kb)
     return ADMIN_DELETE_CONFIRM
 
 async def admin_del_item_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -857,7 +961,7 @@ async def admin_del_item_entry(update: Update, context: ContextTypes.DEFAULT_TYP
     if not cats:
         await q.message.reply_text('Категорий пока нет.')
         return ADMIN_MENU
-    await q.message.reply_html('📦 Выберите категорию:', reply_markup=_cat_buttons(cats, 'admin_del_item_cat_', 'admin_delete'))
+    await show_screen(update, '📦 Выберите категорию:', reply_markup=_cat_buttons(cats, A_DEL_ITEM_CAT, cb(A_DELETE)))
     return ADMIN_DELETE_ITEM_CAT
 
 async def admin_del_item_choose_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -868,7 +972,7 @@ async def admin_del_item_choose_cat(update: Update, context: ContextTypes.DEFAUL
     data = load_catalog()
     cats = data.get('categories', [])
     try:
-        cidx = int(q.data.split('_')[-1])
+        cidx = int(context.args[0])
     except Exception:
         return ADMIN_MENU
     if not (0 <= cidx < len(cats)):
@@ -881,9 +985,9 @@ async def admin_del_item_choose_cat(update: Update, context: ContextTypes.DEFAUL
         return ADMIN_DELETE_MENU
     rows = []
     for i, it in enumerate(items):
-        rows.append([InlineKeyboardButton(it.get("title", f"Товар {i+1}"), callback_data=f"admin_del_item_{cidx}_{i}")])
-    rows.append([InlineKeyboardButton('⬅️ Назад', callback_data='admin_delete')])
-    await q.message.reply_html('📦 Выберите товар для удаления:', reply_markup=InlineKeyboardMarkup(rows))
+        rows.append([InlineKeyboardButton(it.get("title", f"Товар {i+1}"), callback_data=cb(A_DEL_ITEM_PICK, cidx, i))])
+    rows.append([InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_DELETE))])
+    await show_screen(update, '📦 Выберите товар для удаления:', reply_markup=InlineKeyboardMarkup(rows))
     return ADMIN_DELETE_ITEM_SELECT
 
 async def admin_del_item_choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -894,8 +998,7 @@ async def admin_del_item_choose(update: Update, context: ContextTypes.DEFAULT_TY
     data = load_catalog()
     cats = data.get('categories', [])
     try:
-        _, _, _, cidx_s, iidx_s = q.data.split('_')
-        cidx = int(cidx_s); iidx = int(iidx_s)
+        cidx, iidx = (int(a) for a in context.args)
     except Exception:
         return ADMIN_MENU
     if not (0 <= cidx < len(cats)):
@@ -906,10 +1009,10 @@ async def admin_del_item_choose(update: Update, context: ContextTypes.DEFAULT_TY
     context.user_data['admin_delete'] = {"target": "item", "cat_idx": cidx, "item_idx": iidx}
     title = items[iidx].get("title", "Товар")
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('✅ Да, удалить', callback_data='admin_del_confirm')],
-        [InlineKeyboardButton('❌ Отмена', callback_data='admin_delete')],
+        [InlineKeyboardButton('✅ Да, удалить', callback_data=cb(A_DEL_CONFIRM))],
+        [InlineKeyboardButton('❌ Отмена', callback_data=cb(A_DELETE))],
     ])
-    await q.message.reply_html(f"⚠️ Удалить товар <b>{title}</b>?", reply_markup=kb)
+    await show_screen(update, f"⚠️ Удалить товар <b>{title}</b>?", reply_markup=kb)
     return ADMIN_DELETE_CONFIRM
 
 async def admin_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -920,7 +1023,7 @@ async def admin_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
 
     st = context.user_data.get("admin_delete") or {}
     tgt = st.get("target")
-    data = load_catalog()
+    data = load_catalog(for_edit=True)
     cats = data.get("categories", [])
 
     if tgt == "category":
@@ -929,7 +1032,7 @@ async def admin_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
             title = cats[cidx].get("title", "Категория")
             del cats[cidx]
             data["categories"] = cats
-            _write_json(CATALOG_PATH, data)
+            save_catalog(data)
             await q.message.reply_html(f"✅ Категория <b>{title}</b> удалена.")
             return ADMIN_MENU
 
@@ -942,7 +1045,7 @@ async def admin_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
                 title = items[iidx].get("title", "Товар")
                 del items[iidx]
                 cats[cidx]["items"] = items
-                _write_json(CATALOG_PATH, data)
+                save_catalog(data)
                 await q.message.reply_html(f"✅ Товар <b>{title}</b> удалён.")
                 return ADMIN_MENU
 
@@ -962,20 +1065,14 @@ async def admin_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYP
     if not _is_admin(uid):
         return ConversationHandler.END
 
-    text = update.message.text or ""
-    user_ids = get_all_user_ids()
-    ok = 0; fail = 0
-    for i, chat_id in enumerate(user_ids):
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-            ok += 1
-        except Exception:
-            fail += 1
-        # gentle rate limit
-        if (i + 1) % 20 == 0:
-            await asyncio.sleep(0.6)
+    if BROADCASTER.active:
+        await update.message.reply_html("⏳ Предыдущая рассылка ещё идёт — дождитесь её завершения.")
+        return ADMIN_MENU
 
-    await update.message.reply_html(f"✅ Рассылка завершена.\n\nОтправлено: <b>{ok}</b>\nОшибки: <b>{fail}</b>")
+    # рассылка идёт в фоне; это сообщение обновляется по мере отправки
+    text = update.message.text or ""
+    status = await update.message.reply_html(f"📣 Рассылка запущена: <b>{len(get_broadcast_user_ids())}</b> получателей.")
+    BROADCASTER.start(context.bot, text, status.chat_id, status.message_id)
     return ADMIN_MENU
 
 async def admin_stats_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -991,15 +1088,18 @@ async def admin_stats_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📊 <b>Финансы (rolling)</b>\n\n"
         f"💰 Выручка:\n• День: <b>{rev['day']:.2f} ₽</b>\n• Неделя: <b>{rev['week']:.2f} ₽</b>\n• Месяц: <b>{rev['month']:.2f} ₽</b>\n\n"
         f"🧾 Расходы:\n• День: <b>{exp['day']:.2f} ₽</b>\n• Неделя: <b>{exp['week']:.2f} ₽</b>\n• Месяц: <b>{exp['month']:.2f} ₽</b>\n\n"
-        f"📈 Чистая прибыль:\n• День: <b>{prof['day']:.2f} ₽</b>\n• Неделя: <b>{prof['week']:.2f} ₽</b>\n• Месяц: <b>{prof['month']:.2f} ₽</b>"
+        f"📈 Чистая прибыль:\n• День: <b>{prof['day']:.2f} ₽</b>\n• Неделя: <b>{prof['week']:.2f} ₽</b>\n• Месяц: <b>{prof['month']:.2f} ₽</b>\n\n"
+        f"🗓 <b>Календарь</b>\n"
+        f"• Сегодня: выручка <b>{rev['today']:.2f} ₽</b>, расходы <b>{exp['today']:.2f} ₽</b>, прибыль <b>{prof['today']:.2f} ₽</b>\n"
+        f"• Этот месяц: выручка <b>{rev['this_month']:.2f} ₽</b>, расходы <b>{exp['this_month']:.2f} ₽</b>, прибыль <b>{prof['this_month']:.2f} ₽</b>"
     )
 
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('➕ Добавить расход', callback_data='admin_exp_add')],
-        [InlineKeyboardButton('⬅️ Назад', callback_data='admin')],
-        [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
+        [InlineKeyboardButton('➕ Добавить расход', callback_data=cb(A_EXP_ADD))],
+        [InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_MENU))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
     ])
-    await q.message.reply_html(msg, reply_markup=kb)
+    await show_screen(update, msg, reply_markup=kb)
     return ADMIN_STATS_MENU
 
 async def admin_expense_add_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1062,8 +1162,8 @@ async def admin_desc_cat_entry(update: Update, context: ContextTypes.DEFAULT_TYP
         await (q.message if q else update.message).reply_text('Категорий пока нет. Добавьте категорию в админке.')
         return ADMIN_MENU
 
-    kb = _cat_buttons(cats, prefix='admin_desc_cat_', back_cb='admin_desc')
-    await (q.message if q else update.message).reply_html('📝 <b>Описания категорий</b>\n\nВыберите категорию:', reply_markup=kb)
+    kb = _cat_buttons(cats, A_DESC_CAT_PICK, cb(A_DESC))
+    await show_screen(update, '📝 <b>Описания категорий</b>\n\nВыберите категорию:', reply_markup=kb)
     return ADMIN_DESC_CAT_SELECT
 
 
@@ -1086,10 +1186,10 @@ async def admin_desc_item_entry(update: Update, context: ContextTypes.DEFAULT_TY
 
     rows = []
     for i, c in enumerate(cats):
-        rows.append([InlineKeyboardButton(c.get('title', f'Категория {i+1}'), callback_data=f"admin_desc_item_list_{i}")])
-    rows.append([InlineKeyboardButton('⬅️ Назад', callback_data='admin_desc')])
+        rows.append([InlineKeyboardButton(c.get('title', f'Категория {i+1}'), callback_data=cb(A_DESC_ITEM_CAT, i))])
+    rows.append([InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_DESC))])
     kb = InlineKeyboardMarkup(rows)
-    await (q.message if q else update.message).reply_html('📝 <b>Описания товаров</b>\n\nСначала выберите категорию:', reply_markup=kb)
+    await show_screen(update, '📝 <b>Описания товаров</b>\n\nСначала выберите категорию:', reply_markup=kb)
     return ADMIN_DESC_ITEM_SELECT
 
 
@@ -1102,7 +1202,7 @@ async def admin_desc_item_list(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
     try:
-        cidx = int(q.data.split('_')[-1])
+        cidx = int(context.args[0])
     except Exception:
         await q.message.reply_text('Ошибка выбора категории.')
         return ADMIN_MENU
@@ -1119,11 +1219,91 @@ async def admin_desc_item_list(update: Update, context: ContextTypes.DEFAULT_TYP
         await q.message.reply_text('В этой категории нет товаров.')
         return ADMIN_DESC_ITEM_SELECT
 
-    kb = _item_buttons(cat, cidx, prefix='admin_desc_item_', back_cb='admin_desc_item')
-    await q.message.reply_html(f"📝 <b>Описания товаров</b>\n\nКатегория: <b>{cat.get('title','Категория')}</b>\nВыберите товар:", reply_markup=kb)
+    kb = _item_buttons(cat, cidx, A_DESC_ITEM_PICK, cb(A_DESC_ITEM))
+    await show_screen(update, f"📝 <b>Описания товаров</b>\n\nКатегория: <b>{cat.get('title','Категория')}</b>\nВыберите товар:", reply_markup=kb)
     return ADMIN_DESC_ITEM_SELECT
 
 
+async def admin_desc_choose_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show one category's description with edit / delete actions."""
+    q = update.callback_query
+    await q.answer()
+    uid = q.from_user.id
+    if not _is_admin(uid):
+        return ConversationHandler.END
+
+    data = load_catalog()
+    cats = data.get('categories', [])
+    try:
+        cidx = int(context.args[0])
+    except Exception:
+        await q.message.reply_text('Ошибка выбора категории.')
+        return ADMIN_DESC_MENU
+    if cidx < 0 or cidx >= len(cats):
+        await q.message.reply_text('Категория не найдена.')
+        return ADMIN_DESC_MENU
+    context.user_data['admin_desc'] = {'target': 'category', 'cat_idx': cidx}
+    cat = cats[cidx]
+    desc = (cat.get('description') or '').strip()
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton('✏️ Изменить описание', callback_data=cb(A_DESC_EDIT))],
+        [InlineKeyboardButton('🗑 Удалить описание', callback_data=cb(A_DESC_DELETE))],
+        [InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_DESC_CAT))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
+    ])
+    msg = ("📝 <b>Описание категории</b>\n\n"
+       f"Категория: <b>{cat.get('title','Категория')}</b>\n\n"
+       "Текущее описание:\n"
+       f"<code>{desc if desc else '— нет —'}</code>\n\n"
+       "Выберите действие:")
+    await show_screen(update, msg, reply_markup=kb)
+    return ADMIN_DESC_MENU
+
+
+async def admin_desc_choose_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show one item's description with edit / delete actions."""
+    q = update.callback_query
+    await q.answer()
+    uid = q.from_user.id
+    if not _is_admin(uid):
+        return ConversationHandler.END
+
+    data = load_catalog()
+    cats = data.get('categories', [])
+    try:
+        cidx, iidx = (int(a) for a in context.args)
+    except Exception:
+        await q.message.reply_text('Ошибка выбора товара.')
+        return ADMIN_DESC_MENU
+
+    if cidx < 0 or cidx >= len(cats):
+        await q.message.reply_text('Категория не найдена.')
+        return ADMIN_DESC_MENU
+    cat = cats[cidx]
+    items = cat.get('items', [])
+    if iidx < 0 or iidx >= len(items):
+        await q.message.reply_text('Товар не найден.')
+        return ADMIN_DESC_MENU
+    item = items[iidx]
+
+    context.user_data['admin_desc'] = {'target': 'item', 'cat_idx': cidx, 'item_idx': iidx}
+    desc = (item.get('description') or '').strip()
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton('✏️ Изменить описание', callback_data=cb(A_DESC_EDIT))],
+        [InlineKeyboardButton('🗑 Удалить описание', callback_data=cb(A_DESC_DELETE))],
+        [InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_DESC_ITEM))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
+    ])
+    msg = ("📝 <b>Описание товара</b>\n\n"
+       f"Категория: <b>{cat.get('title','Категория')}</b>\n"
+       f"Товар: <b>{item.get('title','Товар')}</b>\n\n"
+       "Текущее описание:\n"
+       f"<code>{desc if desc else '— нет —'}</code>\n\n"
+       "Выберите действие:")
+    await show_screen(update, msg, reply_markup=kb)
+    return ADMIN_DESC_MENU
+
+
 async def admin_desc_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -1131,12 +1311,12 @@ async def admin_desc_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not _is_admin(uid):
         return ConversationHandler.END
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('🗂 Описание категории', callback_data='admin_desc_cat')],
-        [InlineKeyboardButton('📦 Описание товара', callback_data='admin_desc_item')],
-        [InlineKeyboardButton('⬅️ Назад', callback_data='admin')],
-        [InlineKeyboardButton('❌ Выйти', callback_data='admin_cancel')],
+        [InlineKeyboardButton('🗂 Описание категории', callback_data=cb(A_DESC_CAT))],
+        [InlineKeyboardButton('📦 Описание товара', callback_data=cb(A_DESC_ITEM))],
+        [InlineKeyboardButton('⬅️ Назад', callback_data=cb(A_MENU))],
+        [InlineKeyboardButton('❌ Выйти', callback_data=cb(A_CANCEL))],
     ])
-    await q.message.reply_html('📝 <b>Описания</b>\n\nЧто редактируем?', reply_markup=kb)
+    await show_screen(update, '📝 <b>Описания</b>\n\nЧто редактируем?', reply_markup=kb)
     return ADMIN_MENU
 
 
@@ -1173,11 +1353,11 @@ async def admin_desc_delete_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     cidx = int(st.get('cat_idx', -1))
     iidx = int(st.get('item_idx', -1))
 
-    data = load_catalog()
+    data = load_catalog(for_edit=True)
     cats = data.get('categories', [])
     if tgt == 'category' and 0 <= cidx < len(cats):
         cats[cidx]['description'] = ''
-        _write_json(CATALOG_PATH, data)
+        save_catalog(data)
         await q.message.reply_text('🗑 Описание категории удалено.')
         return ADMIN_MENU
 
@@ -1185,7 +1365,7 @@ async def admin_desc_delete_cb(update: Update, context: ContextTypes.DEFAULT_TYP
         items = cats[cidx].get('items', []) or []
         if 0 <= iidx < len(items):
             items[iidx]['description'] = ''
-            _write_json(CATALOG_PATH, data)
+            save_catalog(data)
             await q.message.reply_text('🗑 Описание товара удалено.')
             return ADMIN_MENU
 
@@ -1204,12 +1384,12 @@ async def admin_desc_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cidx = int(st.get('cat_idx', -1))
     iidx = int(st.get('item_idx', -1))
 
-    data = load_catalog()
+    data = load_catalog(for_edit=True)
     cats = data.get('categories', [])
 
     if tgt == 'category' and 0 <= cidx < len(cats):
         cats[cidx]['description'] = desc
-        _write_json(CATALOG_PATH, data)
+        save_catalog(data)
         await update.message.reply_text('✅ Описание категории обновлено.')
         return ADMIN_MENU
 
@@ -1217,7 +1397,7 @@ async def admin_desc_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         items = cats[cidx].get('items', []) or []
         if 0 <= iidx < len(items):
             items[iidx]['description'] = desc
-            _write_json(CATALOG_PATH, data)
+            save_catalog(data)
             await update.message.reply_text('✅ Описание товара обновлено.')
             return ADMIN_MENU
 
@@ -1226,31 +1406,15 @@ async def admin_desc_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def append_order(order: dict):
-    rows = _read_json(ORDERS_FILE, [])
     order["created_at"] = int(time.time())
-    rows.append(order); _write_json(ORDERS_FILE, rows)
+    STORAGE.append_order(order)
 
+# Blocking wrappers (worker threads, scripts); handlers await LOOKSMM directly
 def looksmm_services() -> List[dict]:
-    if not LOOKSMM_KEY: raise RuntimeError("LOOKSMM_KEY is not set")
-    url = "https://looksmm.ru/api/v2"
-    r = requests.get(url, params={"action":"services","key":LOOKSMM_KEY}, timeout=30)
-    r.raise_for_status(); return r.json()
+    return LOOKSMM.run_sync(lambda c: c.request({"action": "services"}, timeout=60))
 
 def looksmm_add(service_id: int, link: str, quantity: int) -> Any:
-    if not LOOKSMM_KEY: raise RuntimeError("LOOKSMM_KEY is not set")
-    url = "https://looksmm.ru/api/v2"
-    r = requests.get(url, params={
-        "action": "add",
-        "service": service_id,
-        "link": link,
-        "quantity": quantity,
-        "key": LOOKSMM_KEY
-    }, timeout=30)
-    r.raise_for_status()
-    try:
-        return r.json()
-    except Exception:
-        return r.text
+    return LOOKSMM.run_sync(lambda c: c.request({"action": "add", "service": service_id, "link": link, "quantity": quantity}))
 
 def price_str(price: float, unit: str, mult: float) -> str:
     p = float(price) * float(mult)
@@ -1270,7 +1434,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📋 Каталог", callback_data="catalog"), InlineKeyboardButton("👤 Профиль", callback_data="profile")],
+        [InlineKeyboardButton("📋 Каталог", callback_data=cb(CB_CATALOG)), InlineKeyboardButton("👤 Профиль", callback_data="profile")],
         [
             InlineKeyboardButton("💳 Баланс", callback_data="balance"),
             InlineKeyboardButton("💳 Пополнить", callback_data="topup")
@@ -1281,17 +1445,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     remember_user(update.effective_user.id)
 
-    # 1) отправляем картинку (если файл есть в проекте)
-    image_paths = [
-        "assets/start.png",
-        "assets/welcome.png",
-        "Добро пожаловать.png",
-        "welcome.png",
-    ]
-    for p in image_paths:
+    # 1) отправляем картинку (если файл есть в проекте); загружается один раз, дальше — по file_id
+    for p in START_IMAGE_PATHS:
         try:
-            with open(p, "rb") as f:
-                await context.bot.send_photo(chat_id=chat_id, photo=f)
+            await ASSETS.send_photo(context.bot, chat_id, p)
             break
         except FileNotFoundError:
             continue
@@ -1317,6 +1474,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/topup &lt;сумма&gt; — пополнить баланс\n"
         "/admin — админ-панель (только админ)\n"
         "/confirm_payment &lt;invoice_id&gt; — подтверждение оплаты (админ)\n"
+        "/ledger &lt;user_id&gt; — движения баланса (админ)\n"
     )
     await update.message.reply_html(text)
 
@@ -1337,13 +1495,9 @@ async def promo_profile_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     context.user_data["awaiting_promo_profile"] = False
     code = (update.message.text or "").strip().upper()
-    promos = _load_promo_codes()
-    cfg = promos.get(code)
-    if not cfg or not cfg.get("active", True):
-        await update.message.reply_text("Промокод не найден или не активен.")
-        return
-    if promo_is_used(update.effective_user.id, code):
-        await update.message.reply_text("Этот промокод уже использован вами.")
+    ok, msg, _ = PROMOS.validate(code, update.effective_user.id)
+    if not ok:
+        await update.message.reply_text(msg)
         return
     context.user_data["active_promo"] = code
     await update.message.reply_html(f"✅ Промокод <code>{code}</code> применён. Скидка учтётся при следующем оформлении заказа (от 100 ₽).")
@@ -1371,7 +1525,8 @@ async def promo_order_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # если ранее применяли скидку — пересчитаем от base_cost
     if base_cost <= 0:
         base_cost = float(info.get("cost") or 0)
-    ok, msg, percent = promo_validate(code, base_cost, update.effective_user.id, allow_for_combo=False)
+    ok, msg, percent = promo_validate(code, base_cost, update.effective_user.id, allow_for_combo=False,
+                                      item_id=info.get("item_id"), category=info.get("cat_title"))
     if not ok:
         await update.message.reply_text(msg or "Промокод не подходит.")
         return CONFIRM
@@ -1407,7 +1562,11 @@ async def balance_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     uid = q.from_user.id
-    await q.message.reply_html(f"💳 <b>Ваш баланс:</b> <code>{get_balance(uid):.2f} ₽</code>")
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 Пополнить", callback_data="topup")],
+        [InlineKeyboardButton("👤 Профиль", callback_data="profile")],
+    ])
+    await show_screen(update, f"💳 <b>Ваш баланс:</b> <code>{get_balance(uid):.2f} ₽</code>", reply_markup=kb)
 
 async def profile_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -1416,10 +1575,8 @@ async def profile_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = q.from_user.username or "-"
     bal = get_balance(uid)
 
-    rows = _read_json(ORDERS_FILE, [])
-    user_orders = [o for o in rows if int(o.get("user_id", 0)) == int(uid)]
-    count = len(user_orders)
-    last = max(user_orders, key=lambda o: int(o.get("created_at", 0)), default=None)
+    count = STORAGE.user_order_count(uid)
+    last = STORAGE.last_user_order(uid)
 
     text = (
         "👤 <b>Ваш профиль</b>\n\n"
@@ -1438,9 +1595,12 @@ async def profile_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"• ID: <code>{oid}</code>\n"
             f"• Provider ID: <code>{provider}</code>\n"
         )
+        status = _order_status_text(last)
+        if status:
+            text += f"• Статус: <code>{status}</code>\n"
 
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📋 Каталог", callback_data="catalog")],
+        [InlineKeyboardButton("📋 Каталог", callback_data=cb(CB_CATALOG))],
         [
             InlineKeyboardButton("💳 Баланс", callback_data="balance"),
             InlineKeyboardButton("💳 Пополнить", callback_data="topup"),
@@ -1448,7 +1608,7 @@ async def profile_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🎟 Промокод", callback_data="promo")],
         [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
     ])
-    await q.message.reply_html(text, reply_markup=kb)
+    await show_screen(update, text, reply_markup=kb)
 
 
 async def unknown_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1511,7 +1671,7 @@ async def give_balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Неверные параметры. Пример: /give_balance 123456 50")
         return
 
-    new_bal = add_balance(target_id, amount)
+    new_bal = credit(target_id, amount, "grant", note=f"by admin {update.effective_user.id}")
     await update.message.reply_text(f"✅ Начислено {amount:.2f} ₽ пользователю {target_id}. Новый баланс: {new_bal:.2f} ₽")
 
     try:
@@ -1522,58 +1682,70 @@ async def give_balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         pass
 
+async def ledger_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ: /ledger <user_id> [N] — последние движения баланса пользователя."""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    args = context.args or []
+    try:
+        target_id = int(args[0])
+        limit = max(1, min(int(args[1]) if len(args) > 1 else 20, 50))
+    except Exception:
+        await update.message.reply_text("Использование: /ledger <user_id> [кол-во]")
+        return
+    rows = STORAGE.balance_history(target_id, limit)
+    if not rows:
+        await update.message.reply_text("Движений по балансу нет.")
+        return
+    lines = []
+    for e in rows:
+        ts = time.strftime("%d.%m %H:%M", time.localtime(int(e.get("ts") or 0)))
+        sign = "+" if str(e.get("credit", "")).startswith("user:") else "−"
+        ref = f" <code>{e['ref']}</code>" if e.get("ref") else ""
+        lines.append(f"{ts} {e.get('kind')} {sign}{float(e.get('amount') or 0):.2f} → {float(e.get('balance') or 0):.2f} ₽{ref}")
+    await update.message.reply_html(
+        f"📒 <b>Движения баланса</b> <code>{target_id}</code>\n\n" + "\n".join(lines) +
+        f"\n\nТекущий баланс: <b>{get_balance(target_id):.2f} ₽</b>"
+    )
+
 async def show_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if query:
         await query.answer()
-    # 1️⃣ картинка для кнопки «Каталог»
-    chat_id = update.effective_chat.id
-    await context.bot.send_photo(
-        chat_id=chat_id,
-        photo=open("assets/catalog.png", "rb")
-    )
-
     data = load_catalog()
     cats = data.get("categories", [])
     if not cats:
-        target = query.message if query else update.message
-        await target.reply_text("Каталог временно пуст.")
+        await show_screen(update, "Каталог временно пуст.")
+        return
+    text, kb = "<b>📋 Каталог BoostX</b>\n\nВыберите категорию:", CATALOG.root_keyboard()
+    # переход из другого меню — правим его на месте; новый экран каталога открывается с картинкой
+    if await edit_screen(update, text, kb):
         return
-    buttons = [[InlineKeyboardButton(c.get("title","Категория"), callback_data=f"cat_{i}")] for i,c in enumerate(cats)]
-    kb = InlineKeyboardMarkup(buttons)
-    target = query.message if query else update.message
-    await target.reply_html("<b>📋 Каталог BoostX</b>\n\nВыберите категорию:", reply_markup=kb)
+    try:
+        await ASSETS.send_photo(context.bot, update.effective_chat.id, CATALOG_IMAGE_PATH)
+    except FileNotFoundError:
+        pass
+    await update.effective_message.reply_html(text, reply_markup=kb)
 
 async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    data = load_catalog(); cats = data.get("categories", [])
     try:
-        idx = int(q.data.split("_")[1])
+        idx = int(context.args[0])
     except Exception:
         await q.answer("Ошибка категории"); return
-    if idx < 0 or idx >= len(cats):
+    view = CATALOG.category_view(idx)
+    if view is None:
         await q.answer("Категория не найдена"); return
-    cat = cats[idx]
-    title = cat.get("title","Категория")
-    unit = cat.get("unit","per_1000")
-    mult = float(data.get("pricing_multiplier", 1.0))
-    rows = []
-    for i, item in enumerate(cat.get("items", [])):
-        item_unit = item.get("unit", unit)
-        label = f"{item.get('title','Услуга')} — {price_str(item.get('price',0), item_unit, mult)}"
-        rows.append([InlineKeyboardButton(label[:64], callback_data=f"item_{idx}_{i}")])
-    rows.append([InlineKeyboardButton("⬅️ Назад к категориям", callback_data="catalog")])
-    desc = (cat.get('description') or '').strip()
-    header = f"<b>{title}</b>" + (f"\n\n{desc}" if desc else '')
-    await q.message.reply_html(f"{header}\nВыберите услугу:", reply_markup=InlineKeyboardMarkup(rows))
+    header, kb = view
+    await show_screen(update, f"{header}\nВыберите услугу:", reply_markup=kb)
 
 LINK, QTY, CONFIRM, PROMO = range(4)
 
 async def order_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    _, cidx, iidx = q.data.split("_"); cidx = int(cidx); iidx = int(iidx)
     data = load_catalog()
     try:
+        cidx, iidx = (int(a) for a in context.args)
         cat = data["categories"][cidx]; item = cat["items"][iidx]
     except Exception:
         await q.message.reply_text("Ошибка выбора услуги."); return ConversationHandler.END
@@ -1705,10 +1877,11 @@ def resolve_service_id(cat_title: str, item_title: str, item_id: str | None = No
                 return None
     return None
 
+SERVICES = ServicesCache(looksmm_services, LOOKSMM_SERVICES_FILE, ttl=LOOKSMM_SERVICES_TTL)
+
 def ensure_qty_limits(service_id: int, qty: int) -> Tuple[int,int,int]:
     try:
-        svcs = looksmm_services()
-        svc = next((s for s in svcs if int(s.get("service",0))==int(service_id)), None)
+        svc = SERVICES.get(int(service_id))
         if not svc:
             return qty, None, None
         try:
@@ -1752,7 +1925,8 @@ async def order_get_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Промокод (скидка %), применяется только к обычным услугам (не к комбо)
     promo = context.user_data.get("active_promo")
     if promo and float(cost) >= 100:
-        ok, msg, percent = promo_validate(str(promo), float(cost), int(uid), allow_for_combo=False)
+        ok, msg, percent = promo_validate(str(promo), float(cost), int(uid), allow_for_combo=False,
+                                          item_id=info.get("item_id"), category=info.get("cat_title"))
         if ok and percent:
             info["promo_code"] = str(promo).upper()
             info["promo_percent"] = int(percent)
@@ -1801,191 +1975,346 @@ async def order_get_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_html(text, reply_markup=kb)
     return CONFIRM
 
+async def submit_order(order: dict) -> dict:
+    """Send a stored single order (status submitting/queued) to the supplier and record the outcome.
+
+    placed: accepted; queued: supplier unavailable (circuit open), retried by OrderOutbox;
+    unconfirmed: the call may have gone through (timeout) — stays debited, admin checks by hand;
+    failed: rejected by the supplier, balance refunded.
+    """
+    oid = order["order_id"]
+    try:
+        res = await SUBMITTER.add(int(order["service_id"]), order["link"], int(order["qty"]))
+    except CircuitOpen:
+        changes = {"status": "queued"}
+    except LooksMMError as e:
+        if e.ambiguous:
+            changes = {"status": "unconfirmed", "error": str(e)[:200]}
+        else:
+            credit(order["user_id"], float(order["cost"]), "refund", ref=oid, note=str(e)[:200])
+            if order.get("promo_code"):
+                PROMOS.refund(order["user_id"], order["promo_code"])  # recorded with the debit, returned with the money
+            changes = {"status": "failed", "error": str(e)[:200], "refunded": float(order["cost"])}
+    except Exception as e:
+        changes = {"status": "unconfirmed", "error": f"{type(e).__name__}: {e}"[:200]}
+    else:
+        changes = {"status": "placed", "provider_order_id": res.order}
+    return STORAGE.update_order(oid, changes) or {**order, **changes}
+
+async def dispatch_combo(comps: List[dict], link: str) -> List[dict]:
+    """Submit all components concurrently (at most COMBO_DISPATCH_CONCURRENCY at once).
+
+    Never raises: each row carries state "placed" (with provider_order_id), "failed" (with error,
+    nothing was created), "unconfirmed" (the call may have gone through; not refunded) or "held"
+    (turned away by the circuit breaker without calling the supplier). Components that already
+    have a result from an earlier, held run are returned as they are.
+    """
+    sem = asyncio.Semaphore(COMBO_DISPATCH_CONCURRENCY)
+
+    async def one(c: dict) -> dict:
+        if c.get("state") in ("placed", "failed", "unconfirmed"):
+            return dict(c)
+        row = {"service_id": int(c.get("service_id", 0) or 0), "qty": int(c.get("qty", 0) or 0)}
+        try:
+            if row["service_id"] <= 0 or row["qty"] <= 0:
+                raise RuntimeError(f"Bad component: {c}")
+            async with sem:
+                row["provider_order_id"] = (await SUBMITTER.add(row["service_id"], link, row["qty"])).order
+            row["state"] = "placed"
+        except CircuitOpen:
+            row["state"] = "held"
+        except LooksMMError as e:
+            row["state"] = "unconfirmed" if e.ambiguous else "failed"; row["error"] = str(e)[:200]
+        except Exception as e:
+            row["state"] = "failed"; row["error"] = str(e)[:200]
+        return row
+
+    return list(await asyncio.gather(*(one(c) for c in comps)))
+
+def _combo_shares(comps: List[dict], cost: float) -> List[float]:
+    """Split the package price across components by supplier cost (rate per 1000 × qty); equal split if any is unknown."""
+    weights = []
+    for c in comps:
+        try:
+            svc = SERVICES.by_id.get(int(c.get("service_id", 0)))
+            weights.append(float(svc.get("rate") or 0) * int(c.get("qty", 0)) / 1000 if svc else 0.0)
+        except Exception:
+            weights.append(0.0)
+    if not comps:
+        return []
+    if any(w <= 0 for w in weights):
+        weights = [1.0] * len(comps)
+    total = sum(weights)
+    shares = [round(cost * w / total, 2) for w in weights]
+    shares[-1] = round(cost - sum(shares[:-1]), 2)
+    return shares
+
+def _combo_row_line(r: dict, html: bool = False) -> str:
+    mark = {"placed": "", "cancelled": " (отменён, возврат)", "failed": " (ошибка, возврат)",
+            "unconfirmed": " (ожидает подтверждения)"}.get(r.get("state"), "")
+    pid = r.get("provider_order_id", "—")
+    if html:
+        return f"• <code>{r['service_id']}</code> × <code>{r['qty']}</code> → <code>{pid}</code>{mark}"
+    return f"{r['service_id']} x {r['qty']} -> {pid}{mark}"
+
+async def submit_combo(order: dict) -> dict:
+    """Dispatch a stored combo (status submitting) and record every component's result in one update.
+
+    If the circuit breaker turned any component away, the combo goes back to "queued" with the
+    results so far; OrderOutbox retries the held components and the partial-failure policy is
+    only applied once every component has a result.
+    """
+    oid, uid, cost = order["order_id"], int(order["user_id"]), float(order["cost"])
+    comps = order.get("items") or []
+    rows = await dispatch_combo(comps, order.get("link", ""))
+    if any(r["state"] == "held" for r in rows):
+        changes = {"status": "queued", "items": rows}
+        return STORAGE.update_order(oid, changes) or {**order, **changes}
+    placed = [r for r in rows if r["state"] == "placed"]
+    if placed and any(r["state"] == "failed" for r in rows) and COMBO_PARTIAL_POLICY == "cancel":
+        cancelled = await LOOKSMM.cancel([r["provider_order_id"] for r in placed])
+        for r in placed:
+            if cancelled.get(int(r["provider_order_id"])):
+                r["state"] = "cancelled"
+        placed = [r for r in rows if r["state"] == "placed"]
+    shares = _combo_shares(comps, cost)
+    refund = round(sum(sh for r, sh in zip(rows, shares) if r["state"] in ("failed", "cancelled")), 2)
+    live = [r for r in rows if r["state"] in ("placed", "unconfirmed")]
+    status = "placed" if len(placed) == len(rows) else ("partial" if live else "failed")
+    if refund:
+        errors = "; ".join(r["error"] for r in rows if r.get("error"))
+        credit(uid, refund, "refund", ref=oid, note=f"combo {status}: {errors}"[:200])
+    changes = {"status": status, "cost": round(cost - refund, 2), "refunded": refund, "items": rows}
+    if status == "failed":
+        changes["error"] = next((r["error"] for r in rows if r.get("error")), "no component was placed")
+    return STORAGE.update_order(oid, changes) or {**order, **changes}
+
+
+ORDER_DONE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Профиль", callback_data="profile" + NEW_SCREEN),
+     InlineKeyboardButton("📋 Каталог", callback_data=cb(CB_CATALOG) + NEW_SCREEN)],
+    [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
+])
+
+async def _finish_order(app: Application, order: dict):
+    """Outcome of an outbox job: admin notice and the status screen for the user."""
+    oid, uid, status = order["order_id"], int(order["user_id"]), order.get("status")
+    combo = order.get("type") == "combo"
+    refund = float(order.get("refunded") or 0)
+    if combo:
+        details = (f"Пакет: {order.get('title','КОМБО')}\n"
+                   f"cost: {float(order.get('cost', 0)) + refund:.0f} ₽" + (f" (возврат {refund:.2f} ₽)" if refund else "") + "\n"
+                   f"link: {order.get('link')}\n\n" + "\n".join(_combo_row_line(r) for r in order.get("items") or []) + "\n")
+    else:
+        details = (f"Услуга: {order.get('title','Услуга')}\n"
+                   f"service_id: {order.get('service_id')}\n"
+                   f"qty: {order.get('qty')}\n"
+                   f"cost: {float(order.get('cost', 0)):.2f} ₽\n"
+                   f"link: {order.get('link')}\n"
+                   f"provider_order_id: {order.get('provider_order_id') or '—'}\n")
+    try:
+        await app.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=(
+                (("🆕 Новый КОМБО-заказ" if combo else "🆕 Новый заказ") if status == "placed"
+                 else f"⚠️ {'КОМБО-заказ' if combo else 'Заказ'} {status}: {order.get('error') or '—'}") + "\n\n"
+                f"User: {uid} (@{order.get('username') or '-'})\n"
+                f"{details}"
+                f"order_id: {oid}"
+                + ("\n\nПроверьте у поставщика вручную: заказ мог быть создан." if status == "unconfirmed" else "")
+            )
+        )
+    except Exception:
+        pass
+
+    if status == "failed":
+        text = (f"❌ <b>Заказ не создан</b>: {order.get('error')}\n"
+                f"• ID заказа: <code>{oid}</code>\n"
+                f"• Возвращено: <code>{refund or float(order.get('cost', 0)):.2f} ₽</code>")
+    elif combo:
+        items_txt = "\n".join(_combo_row_line(r, html=True) for r in order.get("items") or [])
+        head = "✅ <b>Комбо-заказ создан</b>" if status == "placed" else "⚠️ <b>Комбо-заказ создан частично</b>"
+        text = (
+            f"{head}\n\n"
+            f"• Пакет: <code>{order.get('title','КОМБО')}</code>\n"
+            f"• Ссылка: <code>{order.get('link')}</code>\n"
+            f"• Списано: <code>{float(order.get('cost', 0)):.0f} ₽</code>\n"
+            + (f"• Возвращено: <code>{refund:.2f} ₽</code>\n" if refund else "")
+            + f"• Order ID: <code>{oid}</code>\n\n"
+            "• Заказы поставщика:\n"
+            f"{items_txt}"
+        )
+    else:
+        head = {
+            "placed": "✅ <b>Заказ создан!</b>",
+            "unconfirmed": "⏳ <b>Заказ принят</b>\nПоставщик не успел подтвердить — проверим и сообщим.",
+        }.get(status, "⏳ <b>Заказ принят</b>")
+        text = (
+            f"{head}\n\n"
+            f"• Услуга: <code>{order.get('title','Услуга')}</code>\n"
+            f"• Кол-во: <code>{order.get('qty')}</code>\n"
+            f"• Списано: <code>{float(order.get('cost', 0)):.2f} ₽</code>\n"
+            f"• ID заказа: <code>{oid}</code>\n"
+            f"• Provider ID: <code>{order.get('provider_order_id') or '—'}</code>\n"
+        )
+    await app.bot.send_message(chat_id=uid, text=text, parse_mode=ParseMode.HTML, reply_markup=ORDER_DONE_KB)
+
+
+class OrderOutbox:
+    """Durable order queue drained by a pool of async workers.
+
+    A job is an order stored with status "queued" (Storage.debit_and_enqueue), so the queue
+    survives restarts: start() re-enqueues every queued order. While the supplier circuit is
+    open (for combos: not closed) jobs stay queued and are retried after `retry_delay` seconds.
+    An order is in the queue or has a retry timer at most once.
+    """
+
+    def __init__(self, workers: int, retry_delay: float):
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.queue: asyncio.Queue | None = None
+        self._tasks: List[asyncio.Task] = []
+        self._queued: set = set()  # order ids waiting in the queue
+        self._retries: Dict[str, asyncio.TimerHandle] = {}  # order id -> pending retry
+
+    def start(self, app: Application) -> int:
+        self._cancel_retries()  # timers from a previous run would feed the old queue
+        self.queue = asyncio.Queue()
+        self._queued = set()
+        resumed = [o["order_id"] for o in STORAGE.pending_orders() if o.get("status") == "queued"]
+        for oid in resumed:
+            self.put(oid)
+        self._tasks = [asyncio.create_task(self._worker(app)) for _ in range(self.workers)]
+        return len(resumed)
+
+    def put(self, order_id: str):
+        if order_id in self._queued or order_id in self._retries:
+            return
+        self._queued.add(order_id)
+        self.queue.put_nowait(order_id)
+
+    def _retry_later(self, order_id: str):
+        if order_id not in self._retries:
+            self._retries[order_id] = asyncio.get_running_loop().call_later(self.retry_delay, self._retry_now, order_id)
+
+    def _retry_now(self, order_id: str):
+        self._retries.pop(order_id, None)
+        self.put(order_id)
+
+    def _cancel_retries(self):
+        for handle in self._retries.values():
+            handle.cancel()
+        self._retries = {}
+
+    async def _worker(self, app: Application):
+        while True:
+            oid = await self.queue.get()
+            self._queued.discard(oid)
+            try:
+                await self._process(app, oid)
+            except Exception as e:
+                print(f"⚠️ Order {oid} worker error: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, app: Application, oid: str):
+        order = STORAGE.get_order(oid)
+        if not order or order.get("status") != "queued":
+            return
+        # a half-open breaker lets a single probe through; a combo would spend it on one component
+        state = SUBMITTER.breaker.state
+        if state == "open" or (state == "half-open" and order.get("type") == "combo"):
+            self._retry_later(oid)
+            return
+        order = STORAGE.update_order(oid, {"status": "submitting"})
+        order = await (submit_combo(order) if order.get("type") == "combo" else submit_order(order))
+        if order.get("status") == "queued":
+            self._retry_later(oid)
+            return
+        await _finish_order(app, order)
+
+    async def stop(self):
+        self._cancel_retries()
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+OUTBOX = OrderOutbox(ORDER_WORKERS, QUEUED_RETRY_INTERVAL)
+
+
 async def order_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
     info = context.user_data.get("order", {})
     uid = q.from_user.id
+    link = info.get("link", "")
+    cost = float(info.get("cost", 0.0))
+    order_id = str(uuid.uuid4())[:8]
+    job = {
+        "order_id": order_id,
+        "user_id": uid,
+        "username": q.from_user.username or "",
+        "title": info.get("title", "Услуга"),
+        "cost": cost,
+        "link": link,
+        "created_at": int(time.time()),
+    }
 
-    # Комбо-набор: создаём несколько заказов поставщику, списание один раз
+    promo_token = None
     if info.get("item_type") == "combo":
-        link = info.get("link", "")
-        cost = float(info.get("cost", 0.0))
+        # Комбо-набор: несколько заказов поставщику, списание один раз
         comps = info.get("components", []) or []
         if not link or not comps or cost <= 0:
             await q.message.reply_text("Данные комбо-заказа не найдены. Откройте каталог и оформите заказ заново.")
             context.user_data.pop("order", None)
             return ConversationHandler.END
-
-        bal = get_balance(uid)
-        if bal < cost:
-            await q.message.reply_html(
-                f"Недостаточно средств. Нужно <code>{cost:.0f} ₽</code>, на балансе <code>{bal:.2f} ₽</code>."
-            )
+        job.update({"title": info.get("title", "КОМБО"), "type": "combo",
+                    "items": [{"service_id": c.get("service_id"), "qty": c.get("qty")} for c in comps]})
+    else:
+        sid = int(info.get("service_id", 0))
+        qty = int(info.get("qty", 0))
+        if not sid or qty <= 0 or not link:
+            await q.message.reply_text("Данные заказа не найдены. Откройте каталог и оформите заказ заново.")
             context.user_data.pop("order", None)
             return ConversationHandler.END
-
-        # списываем перед созданием
-        set_balance(uid, bal - cost)
-
-        provider_rows = []
-        try:
-            for c in comps:
-                sid = int(c.get("service_id", 0))
-                qty = int(c.get("qty", 0))
-                if sid <= 0 or qty <= 0:
-                    raise RuntimeError(f"Bad component: {c}")
-                res = await asyncio.to_thread(looksmm_add, sid, link, qty)
-                if isinstance(res, dict):
-                    provider_order_id = res.get("order")
-                else:
-                    provider_order_id = None
-                if not provider_order_id:
-                    raise RuntimeError(f"LooksMM response: {res}")
-                provider_rows.append({
-                    "service_id": sid,
-                    "qty": qty,
-                    "provider_order_id": provider_order_id,
-                })
-
-            order_id = str(uuid.uuid4())[:8]
-            append_order({
-                "order_id": order_id,
-                "user_id": uid,
-                "username": q.from_user.username or "",
-                "title": info.get("title", "КОМБО"),
-                "type": "combo",
-                "cost": cost,
-                "link": link,
-                "items": provider_rows,
-            })
-
-            # уведомление админу
-            try:
-                lines = "\n".join([f"{r['service_id']} x {r['qty']} -> {r['provider_order_id']}" for r in provider_rows])
-                await context.bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=(
-                        "🆕 Новый КОМБО-заказ\n\n"
-                        f"User: {uid} (@{q.from_user.username or '-'})\n"
-                        f"Пакет: {info.get('title','КОМБО')}\n"
-                        f"cost: {cost:.0f} ₽\n"
-                        f"link: {link}\n\n"
-                        f"{lines}\n"
-                        f"order_id: {order_id}"
-                    )
-                )
-            except Exception:
-                pass
-
-            # статус-экран
-            items_txt = "\n".join([
-                f"• <code>{r['service_id']}</code> × <code>{r['qty']}</code> → <code>{r['provider_order_id']}</code>" for r in provider_rows
-            ])
-            status_text = (
-                "✅ <b>Комбо-заказ создан</b>\n\n"
-                f"• Пакет: <code>{info.get('title','КОМБО')}</code>\n"
-                f"• Ссылка: <code>{link}</code>\n"
-                f"• Списано: <code>{cost:.0f} ₽</code>\n"
-                f"• Order ID: <code>{order_id}</code>\n\n"
-                "• Заказы поставщика:\n"
-                f"{items_txt}"
-            )
-            status_kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("👤 Профиль", callback_data="profile"), InlineKeyboardButton("📋 Каталог", callback_data="catalog")],
-                [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
-            ])
-            await q.message.reply_html(status_text, reply_markup=status_kb)
-        except Exception as e:
-            set_balance(uid, bal)
-            await q.message.reply_text(f"Ошибка создания комбо-заказа: {e}")
-
-        context.user_data.pop("order", None)
-        return ConversationHandler.END
-
-    sid = int(info.get("service_id", 0))
-    qty = int(info.get("qty", 0))
-    cost = float(info.get("cost", 0.0))
-    link = info.get("link", "")
-
-    if not sid or qty <= 0 or not link:
-        await q.message.reply_text("Данные заказа не найдены. Откройте каталог и оформите заказ заново.")
-        context.user_data.pop("order", None)
-        return ConversationHandler.END
-
-    bal = get_balance(uid)
-    if bal < cost:
+        # промокод резервируем до списания: параллельный заказ не сможет использовать его второй раз
+        if info.get("promo_code"):
+            promo_token, msg, _ = PROMOS.reserve(info["promo_code"], uid, base_cost=info.get("base_cost"),
+                                                 item_id=info.get("item_id"), category=info.get("cat_title"))
+            if not promo_token:
+                await q.message.reply_text(f"{msg} Оформите заказ заново.")
+                context.user_data.pop("order", None)
+                context.user_data.pop("active_promo", None)
+                return ConversationHandler.END
+            job.update({"promo_code": info["promo_code"], "promo_percent": info.get("promo_percent")})
+        job.update({"service_id": sid, "qty": qty})
+
+    # списание и постановка в очередь — один шаг; отправку поставщику делают воркеры
+    ok, bal = STORAGE.debit_and_enqueue(job)
+    if not ok:
+        PROMOS.release(promo_token)
         await q.message.reply_html(
             f"Недостаточно средств. Нужно <code>{cost:.2f} ₽</code>, на балансе <code>{bal:.2f} ₽</code>."
         )
         context.user_data.pop("order", None)
         return ConversationHandler.END
-
-    # списываем перед созданием
-    set_balance(uid, bal - cost)
-
-    try:
-        res = await asyncio.to_thread(looksmm_add, sid, link, qty)
-        if isinstance(res, dict):
-            provider_order_id = res.get("order")
-        else:
-            provider_order_id = None
-        if not provider_order_id:
-            raise RuntimeError(f"LooksMM response: {res}")
-
-        order_id = str(uuid.uuid4())[:8]
-        append_order({
-            "order_id": order_id,
-            "user_id": uid,
-            "username": q.from_user.username or "",
-            "title": info.get("title","Услуга"),
-            "service_id": sid,
-            "qty": qty,
-            "cost": cost,
-            "link": link,
-            "provider_order_id": provider_order_id,
-        })
-
-        # уведомление админу о новом заказе
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=(
-                    "🆕 Новый заказ\n\n"
-                    f"User: {uid} (@{q.from_user.username or '-'})\n"
-                    f"Услуга: {info.get('title','Услуга')}\n"
-                    f"service_id: {sid}\n"
-                    f"qty: {qty}\n"
-                    f"cost: {cost:.2f} ₽\n"
-                    f"link: {link}\n"
-                    f"provider_order_id: {provider_order_id}\n"
-                    f"order_id: {order_id}"
-                )
-            )
-        except Exception:
-            pass
-
-        # статус-экран после оформления
-        status_text = (
-            "✅ <b>Заказ создан!</b>\n\n"
-            f"• Услуга: <code>{info.get('title','Услуга')}</code>\n"
-            f"• Кол-во: <code>{qty}</code>\n"
-            f"• Списано: <code>{cost:.2f} ₽</code>\n"
-            f"• ID заказа: <code>{order_id}</code>\n"
-            f"• Provider ID: <code>{provider_order_id}</code>\n"
-        )
-        status_kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("👤 Профиль", callback_data="profile"), InlineKeyboardButton("📋 Каталог", callback_data="catalog")],
-            [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
-        ])
-        await q.message.reply_html(status_text, reply_markup=status_kb)
-
-    except Exception as e:
-        # откат баланса
-        set_balance(uid, bal)
-        await q.message.reply_text(f"Ошибка создания заказа: {e}")
-
+    if promo_token:
+        # the use is recorded with the debit, not when the supplier answers: a job can stay queued
+        # past the reservation TTL or across a restart, and the code must stay spent meanwhile
+        PROMOS.commit(promo_token)
+        context.user_data.pop("active_promo", None)
+    OUTBOX.put(order_id)
+
+    await q.message.reply_html(
+        "⏳ <b>Заказ принят</b>\n\n"
+        f"• Услуга: <code>{job['title']}</code>\n"
+        f"• Списано: <code>{cost:.2f} ₽</code>\n"
+        f"• ID заказа: <code>{order_id}</code>\n\n"
+        "Отправляем заказ поставщику — подтверждение придёт отдельным сообщением."
+    )
     context.user_data.pop("order", None)
     return ConversationHandler.END
 
@@ -2002,31 +2331,159 @@ async def order_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Оформление отменено.")
     return ConversationHandler.END
 
-# Simple health server for Render
-async def _start_http_server(app_obj):
+# HTTP endpoints for Render / UptimeRobot, plus the Telegram webhook in webhook mode.
+# Runs as its own service so the port is open before the bot has finished starting.
+async def serve_http(stop: asyncio.Event):
     async def health(_request):
         return web.Response(text="ok")
+    async def status(_request):
+        return web.json_response({"status": "ok", "mode": BOT_MODE, "bot_running": bool(BOT_APP and BOT_APP.running),
+                                  "restarts": SUPERVISOR.restarts, "json_writer": WRITER.stats(),
+                                  "looksmm_services": SERVICES.stats(), "looksmm_breaker": SUBMITTER.breaker.stats()})
+    async def metrics(_request):
+        return web.Response(body=METRICS.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    async def telegram_webhook(request):
+        # Telegram echoes the secret passed to set_webhook; anything else is not from Telegram
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return web.Response(status=403)
+        app_obj = BOT_APP
+        if app_obj is None or not app_obj.running:
+            return web.Response(status=503)  # starting or restarting; Telegram retries the update
+        try:
+            update = Update.de_json(await request.json(), app_obj.bot)
+        except Exception:
+            return web.Response(status=400)
+        await app_obj.update_queue.put(update)
+        return web.Response()
     http_app = web.Application()
     http_app.router.add_get("/", health)
+    http_app.router.add_get("/health", health)
     http_app.router.add_get("/healthz", health)
+    http_app.router.add_get("/status", status)
+    http_app.router.add_get("/metrics", metrics)
+    if BOT_MODE == "webhook":
+        http_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
     port = int(os.getenv("PORT", "10000"))
     runner = web.AppRunner(http_app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
-    await site.start()
-    print(f"🌐 HTTP server started on 0.0.0.0:{port}")
-    app_obj.bot_data["http_runner"] = runner
+    try:
+        site = web.TCPSite(runner, "0.0.0.0", port)
+        await site.start()
+        print(f"🌐 HTTP server started on 0.0.0.0:{port}")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(STORAGE_FLUSH_INTERVAL)
+        try:
+            STORAGE.flush()
+        except Exception as e:
+            print(f"⚠️ Storage flush error: {e}")
+
+async def _invoice_sweep_loop():
+    while True:
+        try:
+            expired, archived = STORAGE.sweep_invoices(INVOICE_PENDING_TTL)
+            if expired or archived:
+                print(f"🧾 Invoices: {expired} expired, {archived} archived")
+        except Exception as e:
+            print(f"⚠️ Invoice sweep error: {e}")
+        await asyncio.sleep(INVOICE_SWEEP_INTERVAL)
+
+SUPPLIER_STATUS_RU = {"pending": "в очереди", "in progress": "выполняется", "processing": "выполняется",
+                      "completed": "выполнен", "partial": "выполнен частично", "canceled": "отменён", "cancelled": "отменён"}
+
+def _order_status_text(order: dict) -> str:
+    slots = supplier_slots(order)
+    if not slots:
+        return {"submitting": "отправляется", "queued": "в очереди на отправку", "unconfirmed": "ожидает подтверждения",
+                "failed": "не создан, средства возвращены"}.get(order.get("status"), "")
+    parts = []
+    for s in slots:
+        st = str(s.get("supplier_status") or "").lower()
+        parts.append(SUPPLIER_STATUS_RU.get(st, st or "проверяется"))
+        if st in ("in progress", "processing", "partial") and s.get("remains") is not None:
+            parts[-1] += f", осталось {s['remains']}"
+    return "; ".join(parts)
+
+async def _notify_order_finished(app: Application, order: dict):
+    statuses = {str(s.get("supplier_status") or "").lower() for s in supplier_slots(order)}
+    if statuses == {"completed"}:
+        head = "✅ <b>Заказ выполнен</b>"
+    elif statuses & {"completed", "partial"}:
+        head = "⚠️ <b>Заказ выполнен частично</b>"
+    else:
+        return
+    await app.bot.send_message(
+        chat_id=int(order["user_id"]),
+        text=(
+            f"{head}\n\n"
+            f"• Услуга: <code>{order.get('title','Услуга')}</code>\n"
+            f"• ID заказа: <code>{order.get('order_id')}</code>\n"
+            f"• Статус: <code>{_order_status_text(order)}</code>"
+        ),
+        parse_mode=ParseMode.HTML,
+    )
+
+async def _reconcile_submitting(app: Application):
+    """Orders left in "submitting" by a crash/restart: the supplier call may or may not have happened."""
+    for order in STORAGE.pending_orders():
+        if order.get("status") != "submitting":
+            continue
+        STORAGE.update_order(order["order_id"], {"status": "unconfirmed", "error": "restart during submission"})
+        try:
+            await app.bot.send_message(
+                chat_id=ADMIN_ID,
+                text=(f"⚠️ Заказ {order['order_id']} (user {order.get('user_id')}) прерван во время отправки поставщику.\n"
+                      f"link: {order.get('link')}\nПроверьте у поставщика вручную: заказ мог быть создан."),
+            )
+        except Exception:
+            pass
+
+async def _services_refresh_loop():
+    while True:
+        if LOOKSMM_KEY and SERVICES.stale():
+            await asyncio.to_thread(SERVICES.refresh)
+        await asyncio.sleep(max(30.0, LOOKSMM_SERVICES_TTL / 4))
 
 async def _post_init(app: Application):
-    try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        print("✅ Webhook удалён, polling активирован.")
-    except Exception as e:
-        print(f"⚠️ Ошибка удаления webhook: {e}")
-    try:
-        await _start_http_server(app)
-    except Exception as e:
-        print(f"⚠️ HTTP server start error: {e}")
+    LOOKSMM.attach(asyncio.get_running_loop())
+    if BOT_MODE == "webhook":
+        await app.bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES)
+        print(f"✅ Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    else:
+        try:
+            await app.bot.delete_webhook(drop_pending_updates=True)
+            print("✅ Webhook удалён, polling активирован.")
+        except Exception as e:
+            print(f"⚠️ Ошибка удаления webhook: {e}")
+    app.bot_data["flush_task"] = asyncio.create_task(_flush_loop())
+    app.bot_data["invoice_sweep_task"] = asyncio.create_task(_invoice_sweep_loop())
+    app.bot_data["services_task"] = asyncio.create_task(_services_refresh_loop())
+    await _reconcile_submitting(app)
+    resumed = OUTBOX.start(app)
+    if resumed:
+        print(f"📤 Resumed {resumed} queued orders")
+    if BROADCASTER.resume(app.bot):
+        print("📣 Resumed interrupted broadcast")
+    if LOOKSMM_KEY:
+        poller = StatusPoller(LOOKSMM, STORAGE, on_finished=lambda order: _notify_order_finished(app, order))
+        app.bot_data["status_task"] = asyncio.create_task(poller.run(ORDER_STATUS_POLL_INTERVAL))
+
+async def _post_shutdown(app: Application):
+    await OUTBOX.stop()
+    await BROADCASTER.stop()
+    for key in ("flush_task", "invoice_sweep_task", "services_task", "status_task"):
+        task = app.bot_data.pop(key, None)
+        if task:
+            task.cancel()
+    await LOOKSMM.close()
+    STORAGE.flush()
+    WRITER.flush()
 
 
 
@@ -2121,12 +2578,83 @@ async def reply_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Не удалось отправить сообщение пользователю. Возможно, он не писал боту или заблокировал его."
         )
 
+async def run_bot(stop: asyncio.Event):
+    """The Telegram Application as a supervised service: polling through the Updater, or webhook
+    mode where serve_http() puts updates on the queue. A crash here is restarted by SUPERVISOR
+    with a freshly built Application. _post_init/_post_shutdown are called here, not registered
+    with the builder: this function is the only startup and shutdown path."""
+    global BOT_APP
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is not set (required for BOT_MODE=webhook)")
+    application = build_application()
+    await application.initialize()
+    try:
+        await _post_init(application)
+        if BOT_MODE != "webhook":
+            await application.updater.start_polling(drop_pending_updates=True)
+        await application.start()
+        BOT_APP = application
+        print("🚀 Bot is running...")
+        await stop.wait()
+    finally:
+        BOT_APP = None
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()  # processes updates already in the queue
+        await application.shutdown()
+        await _post_shutdown(application)
+
+async def serve():
+    """Single-process entrypoint: HTTP endpoints, the bot and the Gist balance sync."""
+    import sync_gist  # reads its settings from the environment, so only after load_dotenv()
+    SUPERVISOR.add("http", serve_http)
+    SUPERVISOR.add("bot", run_bot)
+    if sync_gist.enabled():
+        SUPERVISOR.add("gist_sync", sync_gist.run)
+    await SUPERVISOR.run()
+
+# callback action -> handler; each state's RouteHandler takes its subset of this table
+ROUTER = Router({
+    CB_CATALOG: show_catalog,
+    CB_CATEGORY: show_category,
+    CB_ITEM: order_entry,
+    A_MENU: admin_menu_cb,
+    A_CANCEL: admin_cancel_cb,
+    A_PRICE: admin_price_entry,
+    A_PRICE_CAT: admin_choose_cat,
+    A_PRICE_ITEM: admin_choose_item,
+    A_ADD_CAT: admin_add_cat_entry,
+    A_ADD_ITEM: admin_add_item_entry,
+    A_ADD_ITEM_CAT: admin_add_item_choose_cat,
+    A_ADD_ITEM_SUPPLIER: admin_add_item_supplier_choose,
+    A_DELETE: admin_delete_entry,
+    A_DEL_CAT: admin_del_cat_entry,
+    A_DEL_CAT_PICK: admin_del_cat_choose,
+    A_DEL_ITEM: admin_del_item_entry,
+    A_DEL_ITEM_CAT: admin_del_item_choose_cat,
+    A_DEL_ITEM_PICK: admin_del_item_choose,
+    A_DEL_CONFIRM: admin_delete_confirm,
+    A_BROADCAST: admin_broadcast_entry,
+    A_STATS: admin_stats_entry,
+    A_EXP_ADD: admin_expense_add_entry,
+    A_DESC: admin_desc_menu_cb,
+    A_DESC_CAT: admin_desc_cat_entry,
+    A_DESC_CAT_PICK: admin_desc_choose_cat,
+    A_DESC_ITEM: admin_desc_item_entry,
+    A_DESC_ITEM_CAT: admin_desc_item_list,
+    A_DESC_ITEM_PICK: admin_desc_choose_item,
+    A_DESC_EDIT: admin_desc_edit_cb,
+    A_DESC_DELETE: admin_desc_delete_cb,
+})
+
 def build_application():
     app = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
         .defaults(Defaults(parse_mode=ParseMode.HTML))
-        .post_init(_post_init)
+        .persistence(PERSISTENCE)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
         .build()
     )
     # Команды
@@ -2136,16 +2664,16 @@ def build_application():
     app.add_handler(CommandHandler("topup", topup_cmd))
     app.add_handler(CommandHandler("confirm_payment", confirm_payment_cmd))
     app.add_handler(CommandHandler("give_balance", give_balance_cmd))
+    app.add_handler(CommandHandler("ledger", ledger_cmd))
     app.add_handler(CommandHandler("reply", reply_cmd))
 
     # Каталог / услуги
     app.add_handler(CommandHandler("catalog", show_catalog))
     app.add_handler(CommandHandler("services", show_catalog))
-    app.add_handler(CallbackQueryHandler(show_catalog, pattern="^catalog"))
-    app.add_handler(CallbackQueryHandler(show_category, pattern="^cat_"))
-    app.add_handler(CallbackQueryHandler(balance_cb, pattern="^balance$"))
+    app.add_handler(ROUTER.handler(CB_CATALOG, CB_CATEGORY))
+    app.add_handler(CallbackQueryHandler(balance_cb, pattern=r"^balance\+?$"))
     app.add_handler(CallbackQueryHandler(topup_cb, pattern="^topup$"))
-    app.add_handler(CallbackQueryHandler(profile_cb, pattern="^profile$"))
+    app.add_handler(CallbackQueryHandler(profile_cb, pattern=r"^profile\+?$"))
     app.add_handler(CallbackQueryHandler(promo_cb, pattern="^promo$"))
     app.add_handler(CallbackQueryHandler(promo_order_cb, pattern="^promo_order$"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, promo_profile_input, block=False), group=1)
@@ -2153,7 +2681,7 @@ def build_application():
 
     # Оформление заказов
     conv_order = ConversationHandler(
-        entry_points=[CallbackQueryHandler(order_entry, pattern="^item_")],
+        entry_points=[ROUTER.handler(CB_ITEM)],
         states={
             0: [MessageHandler(filters.TEXT & ~filters.COMMAND, order_get_link)],
             1: [MessageHandler(filters.TEXT & ~filters.COMMAND, order_get_qty)],
@@ -2163,7 +2691,7 @@ def build_application():
         allow_reentry=True,
         per_message=False,
         name="order_conv",
-        persistent=False,
+        persistent=True,
     )
     app.add_handler(conv_order)
 
@@ -2177,192 +2705,74 @@ def build_application():
         allow_reentry=True,
         per_message=False,
         name="support_conv",
-        persistent=False,
+        persistent=True,
     )
 
     app.add_handler(conv_support)
 
     # Админ-панель (цены / категории / товары / описания)
+    # each state takes one RouteHandler: the actions its buttons can send, plus "back to menu" / "exit"
+    def routes(*actions: str):
+        return ROUTER.handler(*actions, A_MENU, A_CANCEL)
+
+    def text_input(callback):
+        return [MessageHandler(filters.TEXT & ~filters.COMMAND, callback), routes()]
+
     conv_admin = ConversationHandler(
-        entry_points=[CommandHandler("admin", admin_start), CallbackQueryHandler(admin_menu_cb, pattern="^admin$")],
+        entry_points=[CommandHandler("admin", admin_start), ROUTER.handler(A_MENU)],
         states={
-            ADMIN_MENU: [
-                CallbackQueryHandler(admin_price_entry, pattern="^admin_price$"),
-                CallbackQueryHandler(admin_add_cat_entry, pattern="^admin_add_cat$"),
-                CallbackQueryHandler(admin_add_item_entry, pattern="^admin_add_item$"),
-                CallbackQueryHandler(admin_delete_entry, pattern="^admin_delete$"),
-                CallbackQueryHandler(admin_broadcast_entry, pattern="^admin_broadcast$"),
-                CallbackQueryHandler(admin_stats_entry, pattern="^admin_stats$"),
-                CallbackQueryHandler(admin_desc_menu_cb, pattern="^admin_desc$"),
-                CallbackQueryHandler(admin_desc_cat_entry, pattern="^admin_desc_cat$"),
-                CallbackQueryHandler(admin_desc_item_entry, pattern="^admin_desc_item$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-            ],
+            ADMIN_MENU: [routes(A_PRICE, A_ADD_CAT, A_ADD_ITEM, A_DELETE, A_BROADCAST, A_STATS, A_DESC, A_DESC_CAT, A_DESC_ITEM)],
 
             # Price edit
-            ADMIN_SELECT_CAT: [
-                CallbackQueryHandler(admin_choose_cat, pattern=r"^admin_cat_"),
-                CallbackQueryHandler(admin_price_entry, pattern="^admin_price$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_SELECT_ITEM: [
-                CallbackQueryHandler(admin_choose_item, pattern=r"^admin_item_"),
-                CallbackQueryHandler(admin_choose_cat, pattern=r"^admin_cat_"),
-                CallbackQueryHandler(admin_price_entry, pattern="^admin_price$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_PRICE_INPUT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_price_input),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-            ],
+            ADMIN_SELECT_CAT: [routes(A_PRICE_CAT, A_PRICE)],
+            ADMIN_SELECT_ITEM: [routes(A_PRICE_ITEM, A_PRICE_CAT, A_PRICE)],
+            ADMIN_PRICE_INPUT: text_input(admin_price_input),
 
             # Add category
-            ADMIN_ADD_CAT_TITLE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_cat_title),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
+            ADMIN_ADD_CAT_TITLE: text_input(admin_add_cat_title),
 
             # Add item flow
-            ADMIN_ADD_ITEM_CAT: [
-                CallbackQueryHandler(admin_add_item_choose_cat, pattern=r"^admin_add_item_cat_"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_ADD_ITEM_TITLE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_item_title),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_ADD_ITEM_PRICE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_item_price),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-
-            ADMIN_ADD_ITEM_SUPPLIER: [
-                CallbackQueryHandler(admin_add_item_supplier_choose, pattern=r"^admin_add_item_supplier_"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_ADD_ITEM_SID: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_item_sid),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_ADD_ITEM_DESC: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_item_desc),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-
+            ADMIN_ADD_ITEM_CAT: [routes(A_ADD_ITEM_CAT)],
+            ADMIN_ADD_ITEM_TITLE: text_input(admin_add_item_title),
+            ADMIN_ADD_ITEM_PRICE: text_input(admin_add_item_price),
+            ADMIN_ADD_ITEM_SUPPLIER: [routes(A_ADD_ITEM_SUPPLIER)],
+            ADMIN_ADD_ITEM_SID: text_input(admin_add_item_sid),
+            ADMIN_ADD_ITEM_DESC: text_input(admin_add_item_desc),
 
             # Delete / Broadcast / Finance
-            ADMIN_DELETE_MENU: [
-                CallbackQueryHandler(admin_del_cat_entry, pattern="^admin_del_cat$"),
-                CallbackQueryHandler(admin_del_item_entry, pattern="^admin_del_item$"),
-                CallbackQueryHandler(admin_delete_entry, pattern="^admin_delete$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_DELETE_CAT_SELECT: [
-                CallbackQueryHandler(admin_del_cat_choose, pattern=r"^admin_del_cat_"),
-                CallbackQueryHandler(admin_delete_entry, pattern="^admin_delete$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_DELETE_ITEM_CAT: [
-                CallbackQueryHandler(admin_del_item_choose_cat, pattern=r"^admin_del_item_cat_"),
-                CallbackQueryHandler(admin_delete_entry, pattern="^admin_delete$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_DELETE_ITEM_SELECT: [
-                CallbackQueryHandler(admin_del_item_choose, pattern=r"^admin_del_item_\d+_\d+$"),
-                CallbackQueryHandler(admin_delete_entry, pattern="^admin_delete$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_DELETE_CONFIRM: [
-                CallbackQueryHandler(admin_delete_confirm, pattern="^admin_del_confirm$"),
-                CallbackQueryHandler(admin_delete_entry, pattern="^admin_delete$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_BROADCAST_TEXT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_text),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_STATS_MENU: [
-                CallbackQueryHandler(admin_expense_add_entry, pattern="^admin_exp_add$"),
-                CallbackQueryHandler(admin_stats_entry, pattern="^admin_stats$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_EXPENSE_ADD_AMOUNT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_expense_add_amount),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_EXPENSE_ADD_NOTE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_expense_add_note),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
+            ADMIN_DELETE_MENU: [routes(A_DEL_CAT, A_DEL_ITEM, A_DELETE)],
+            ADMIN_DELETE_CAT_SELECT: [routes(A_DEL_CAT_PICK, A_DELETE)],
+            ADMIN_DELETE_ITEM_CAT: [routes(A_DEL_ITEM_CAT, A_DELETE)],
+            ADMIN_DELETE_ITEM_SELECT: [routes(A_DEL_ITEM_PICK, A_DELETE)],
+            ADMIN_DELETE_CONFIRM: [routes(A_DEL_CONFIRM, A_DELETE)],
+            ADMIN_BROADCAST_TEXT: text_input(admin_broadcast_text),
+            ADMIN_STATS_MENU: [routes(A_EXP_ADD, A_STATS)],
+            ADMIN_EXPENSE_ADD_AMOUNT: text_input(admin_expense_add_amount),
+            ADMIN_EXPENSE_ADD_NOTE: text_input(admin_expense_add_note),
+
             # Descriptions
-            ADMIN_DESC_MENU: [
-                CallbackQueryHandler(admin_desc_edit_cb, pattern="^admin_desc_edit$"),
-                CallbackQueryHandler(admin_desc_delete_cb, pattern="^admin_desc_delete$"),
-                CallbackQueryHandler(admin_desc_menu_cb, pattern="^admin_desc$"),
-                CallbackQueryHandler(admin_desc_cat_entry, pattern="^admin_desc_cat$"),
-                CallbackQueryHandler(admin_desc_item_entry, pattern="^admin_desc_item$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-                # selection callbacks are routed through admin_choose_cat/item
-                CallbackQueryHandler(admin_choose_cat, pattern=r"^admin_desc_cat_"),
-                CallbackQueryHandler(admin_choose_item, pattern=r"^admin_desc_item_"),
-                CallbackQueryHandler(admin_desc_item_list, pattern=r"^admin_desc_item_list_"),
-            ],
-            ADMIN_DESC_CAT_SELECT: [
-                CallbackQueryHandler(admin_choose_cat, pattern=r"^admin_desc_cat_"),
-                CallbackQueryHandler(admin_desc_cat_entry, pattern="^admin_desc_cat$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_DESC_ITEM_SELECT: [
-                CallbackQueryHandler(admin_choose_item, pattern=r"^admin_desc_item_"),
-                CallbackQueryHandler(admin_desc_item_list, pattern=r"^admin_desc_item_list_"),
-                CallbackQueryHandler(admin_desc_item_entry, pattern="^admin_desc_item$"),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
-            ADMIN_DESC_INPUT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_desc_input),
-                CallbackQueryHandler(admin_menu_cb, pattern="^admin$"),
-                CallbackQueryHandler(admin_cancel_cb, pattern="^admin_cancel$"),
-            ],
+            ADMIN_DESC_MENU: [routes(A_DESC_EDIT, A_DESC_DELETE, A_DESC, A_DESC_CAT, A_DESC_ITEM,
+                                     A_DESC_CAT_PICK, A_DESC_ITEM_PICK, A_DESC_ITEM_CAT)],
+            ADMIN_DESC_CAT_SELECT: [routes(A_DESC_CAT_PICK, A_DESC_CAT)],
+            ADMIN_DESC_ITEM_SELECT: [routes(A_DESC_ITEM_PICK, A_DESC_ITEM_CAT, A_DESC_ITEM)],
+            ADMIN_DESC_INPUT: text_input(admin_desc_input),
         },
         fallbacks=[CommandHandler("cancel", admin_cancel_cmd)],
         allow_reentry=True,
         per_message=False,
         name="admin_conv",
-        persistent=False,
+        persistent=True,
     )
     app.add_handler(conv_admin)
 
     # Safety net: answer any unexpected callback to stop Telegram "loading" spinner
     app.add_handler(CallbackQueryHandler(unknown_callback))
 
+    # call / error counters and latency histograms for every handler, exported at /metrics
+    instrument_application(app)
     return app
 
 if __name__ == "__main__":
     if not BOT_TOKEN:
         raise SystemExit("BOT_TOKEN is not set")
-    print("🚀 Bot is running...")
-    application = build_application()
-    application.run_polling(drop_pending_updates=True)
+    asyncio.run(serve())
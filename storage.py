@@ -0,0 +1,1707 @@
+# -*- coding: utf-8 -*-
+"""State storage for BoostX.
+
+Two interchangeable backends implement the Storage interface:
+- JsonStorage (default): the json files next to the bot, with in-memory stores on top
+- SqliteStorage: one SQLite database in WAL mode with indexed tables
+"""
+from __future__ import annotations
+import atexit, copy, json, os, sqlite3, threading, time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from collections import deque
+from typing import Any, Dict, List, Set, Tuple
+
+from metrics import STORAGE_LATENCY
+
+
+# --------------------
+# Durable json writes
+# - temp file + fsync + os.replace: a crash leaves either the old or the new file, never half of one
+# - group commit: writes to the same path inside `window` seconds collapse into one commit
+#   of the latest payload; reads see pending payloads, so callers never observe the delay
+# - the disk work (write + fsync) runs outside the lock that write()/read_json take, so the
+#   event loop never waits for an fsync of the writer thread
+# --------------------
+
+_MISSING = object()
+
+class JsonWriter:
+    def __init__(self, window: float = 0.0):
+        self.window = window
+        self._pending: Dict[Path, Any] = {}
+        self._deadlines: Dict[Path, float] = {}
+        self._inflight: Dict[Path, Any] = {}  # taken for a commit, still served by pending()
+        self._cond = threading.Condition(threading.RLock())  # guards the dicts above, never held for I/O
+        self._io = threading.Lock()  # one commit batch at a time, so commits land in write order
+        self._thread: threading.Thread | None = None
+        self.writes_requested = 0
+        self.writes_performed = 0
+        self.bytes_written = 0
+        self.fsync_count = 0
+        self.fsync_seconds = 0.0
+        self.fsync_max = 0.0
+
+    def write(self, path: Path, data):
+        path = Path(path)
+        if self.window <= 0:
+            with self._io:
+                with self._cond:
+                    self.writes_requested += 1
+                    self._pending.pop(path, None); self._deadlines.pop(path, None)
+                    self._inflight[path] = data
+                self._commit_batch({path: data})
+            return
+        with self._cond:
+            self.writes_requested += 1
+            self._pending[path] = data
+            self._deadlines.setdefault(path, time.monotonic() + self.window)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="json-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self, path: Path):
+        path = Path(path)
+        with self._cond:
+            data = self._pending.get(path, _MISSING)
+            if data is _MISSING:
+                data = self._inflight.get(path, _MISSING)
+            return _MISSING if data is _MISSING else copy.deepcopy(data)
+
+    def _commit(self, path: Path, data):
+        with STORAGE_LATENCY.time(op="commit"):
+            self._commit_file(path, data)
+
+    def _commit_file(self, path: Path, data):
+        raw = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(raw)
+            f.flush()
+            t0 = time.perf_counter()
+            os.fsync(f.fileno())
+            dt = time.perf_counter() - t0
+        os.replace(tmp, path)
+        try:
+            dfd = os.open(str(path.parent), os.O_RDONLY)
+            try: os.fsync(dfd)
+            finally: os.close(dfd)
+        except OSError:
+            pass  # directory fsync is not available everywhere (e.g. Windows)
+        self.writes_performed += 1
+        self.bytes_written += len(raw)
+        self.fsync_count += 1
+        self.fsync_seconds += dt
+        self.fsync_max = max(self.fsync_max, dt)
+
+    def _commit_batch(self, batch: Dict[Path, Any]):
+        # runs under _io only: readers and new writes go on while the disk syncs
+        for path, data in batch.items():
+            try:
+                self._commit(path, data)
+            except Exception as e:
+                print(f"⚠️ Write error {path}: {e}", flush=True)
+            finally:
+                with self._cond:
+                    self._inflight.pop(path, None)
+
+    def _commit_due(self, force: bool = False, only: Path | None = None):
+        with self._io:
+            with self._cond:
+                now = time.monotonic()
+                batch = {}
+                for path in [p for p, d in self._deadlines.items() if (force or d <= now) and (only is None or p == only)]:
+                    batch[path] = self._pending.pop(path)
+                    del self._deadlines[path]
+                self._inflight.update(batch)
+            self._commit_batch(batch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._deadlines:
+                        self._cond.wait()
+                        continue
+                    timeout = min(self._deadlines.values()) - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+            self._commit_due()
+
+    def flush(self, path: Path | None = None):
+        """Commit pending writes now (all of them, or only `path`)."""
+        self._commit_due(force=True, only=Path(path) if path is not None else None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "writes_requested": self.writes_requested,
+            "writes_performed": self.writes_performed,
+            "writes_pending": len(self._pending),
+            "bytes_written": self.bytes_written,
+            "fsync_count": self.fsync_count,
+            "fsync_avg_ms": round(self.fsync_seconds / self.fsync_count * 1000, 3) if self.fsync_count else 0.0,
+            "fsync_max_ms": round(self.fsync_max * 1000, 3),
+        }
+
+
+WRITER = JsonWriter()
+atexit.register(WRITER.flush)
+
+
+def read_json(path: Path, default):
+    with STORAGE_LATENCY.time(op="read_json"):
+        pending = WRITER.pending(path)
+        if pending is not _MISSING:
+            return pending
+        try:
+            if not path.exists(): return default
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"⚠️ Can't read {path}: {e}", flush=True)
+            return default
+
+def write_json(path: Path, data):
+    with STORAGE_LATENCY.time(op="write_json"):
+        WRITER.write(path, data)
+
+
+def scan_jsonl(path: Path, start: int, fn) -> int:
+    """Call fn(offset, row) for every complete line from `start`; returns the end offset.
+
+    A torn last line (crash mid-append) is truncated so the next append starts clean.
+    """
+    if not path.exists():
+        return 0
+    with open(path, "r+b") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            if not line.endswith(b"\n"):
+                f.truncate(offset)
+                break
+            try:
+                fn(offset, json.loads(line))
+            except Exception:
+                pass
+            offset += len(line)
+    return offset
+
+
+# --------------------
+# Balances
+# - loaded once into a dict keyed by user_id (O(1) get/set)
+# - changed user_ids are marked dirty and written together by flush()
+# - file format stays [{"user_id": ..., "balance": ...}] so sync_gist.py keeps working
+# --------------------
+
+class BalanceStore:
+    def __init__(self, path: Path, on_external_change=None):
+        self.path = path
+        self.on_external_change = on_external_change
+        self._rows: Dict[int, float] = {}
+        self._dirty: Set[int] = set()
+        self._mtime_ns: int | None = None
+        self._lock = threading.RLock()
+        self.load()
+
+    @staticmethod
+    def _parse(raw: Any) -> Dict[int, float]:
+        out: Dict[int, float] = {}
+        if isinstance(raw, dict):
+            # sync_gist.py seeds an empty file with "{}"; tolerate {"uid": balance} too
+            raw = [{"user_id": k, "balance": v} for k, v in raw.items()]
+        for r in (raw or []):
+            try:
+                out[int(r.get("user_id"))] = float(r.get("balance", 0))
+            except Exception:
+                continue
+        return out
+
+    def _stat_mtime(self) -> int | None:
+        try:
+            return self.path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self):
+        with self._lock:
+            self._rows = self._parse(read_json(self.path, []))
+            self._dirty.clear()
+            self._mtime_ns = self._stat_mtime()
+
+    def reload_if_changed(self):
+        """Pick up external edits (e.g. sync_gist.py pulling from Gist); local unflushed changes win."""
+        with self._lock:
+            mtime = self._stat_mtime()
+            if mtime is None or mtime == self._mtime_ns:
+                return
+            for uid, bal in self._parse(read_json(self.path, [])).items():
+                if uid in self._dirty:
+                    continue
+                old = self._rows.get(uid, 0.0)
+                self._rows[uid] = bal
+                if self.on_external_change and abs(bal - old) > 1e-9:
+                    self.on_external_change(uid, old, bal)
+            self._mtime_ns = mtime
+
+    def get(self, user_id: int) -> float:
+        return self._rows.get(int(user_id), 0.0)
+
+    def set(self, user_id: int, value: float) -> float:
+        uid = int(user_id)
+        with self._lock:
+            self._rows[uid] = float(value)
+            self._dirty.add(uid)
+        return float(value)
+
+    def add(self, user_id: int, delta: float) -> float:
+        uid = int(user_id)
+        with self._lock:
+            value = self._rows.get(uid, 0.0) + float(delta)
+            self._rows[uid] = value
+            self._dirty.add(uid)
+        return value
+
+    def user_ids(self) -> List[int]:
+        return list(self._rows.keys())
+
+    def flush(self) -> int:
+        """Write all pending changes in one file rewrite. Returns the number of flushed entries."""
+        with self._lock:
+            self.reload_if_changed()
+            if not self._dirty:
+                return 0
+            n = len(self._dirty)
+            write_json(self.path, [{"user_id": uid, "balance": bal} for uid, bal in self._rows.items()])
+            self._dirty.clear()
+            self._mtime_ns = self._stat_mtime()
+            return n
+
+
+# --------------------
+# Balance ledger
+# - every balance movement is an append-only double-entry record: `amount` moves from the
+#   `debit` account to the `credit` account; user accounts are "user:<id>", the other side
+#   is an external account per movement kind (payments, sales, grants, adjustments)
+# - the per-user balance is materialized in memory; a compacted snapshot
+#   {seq, offset, balances} is written every `snapshot_every` entries, so startup only
+#   replays the log tail after the snapshot offset
+# --------------------
+
+LEDGER_CONTRA = {
+    "topup": "ext:payments",
+    "debit": "ext:sales",
+    "refund": "ext:sales",
+    "grant": "ext:grants",
+    "opening": "ext:adjustments",
+    "adjust": "ext:adjustments",
+}
+
+
+def ledger_entry(seq: int, user_id: int, delta: float, kind: str, ref: str | None, note: str, balance: float) -> dict:
+    user_acc = f"user:{int(user_id)}"
+    contra = LEDGER_CONTRA.get(kind, "ext:adjustments")
+    debit, credit = (contra, user_acc) if delta >= 0 else (user_acc, contra)
+    return {
+        "seq": seq, "ts": int(time.time()), "kind": kind, "ref": ref, "note": note,
+        "debit": debit, "credit": credit, "amount": round(abs(float(delta)), 6),
+        "user_id": int(user_id), "balance": balance,
+    }
+
+
+def ledger_delta(entry: dict) -> float:
+    """Signed effect of an entry on its user's balance."""
+    amount = float(entry.get("amount") or 0)
+    return amount if str(entry.get("credit", "")).startswith("user:") else -amount
+
+
+class Ledger:
+    def __init__(self, path: Path, snapshot_path: Path, snapshot_every: int = 500):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.balances: Dict[int, float] = {}
+        self.seq = 0
+        self._size = 0
+        self._snapshot_seq = 0
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        with self._lock:
+            snap = read_json(self.snapshot_path, {})
+            log_size = self.path.stat().st_size if self.path.exists() else 0
+            try:
+                offset = int(snap.get("offset") or 0)
+                balances = {int(k): float(v) for k, v in (snap.get("balances") or {}).items()}
+                seq = int(snap.get("seq") or 0)
+            except Exception:
+                offset, balances, seq = 0, {}, 0
+            if offset > log_size:
+                offset, balances, seq = 0, {}, 0
+            self.balances, self.seq, self._snapshot_seq = balances, seq, seq
+
+            def replay(_offset: int, e: dict):
+                uid = int(e["user_id"])
+                self.balances[uid] = self.balances.get(uid, 0.0) + ledger_delta(e)
+                self.seq = max(self.seq, int(e.get("seq") or 0))
+            self._size = scan_jsonl(self.path, offset, replay)
+
+    def balance(self, user_id: int) -> float:
+        return self.balances.get(int(user_id), 0.0)
+
+    def post(self, user_id: int, delta: float, kind: str, ref: str | None = None, note: str = "",
+             min_balance: float | None = None) -> float | None:
+        """Append one movement and return the user's new balance.
+
+        With min_balance set, the check and the append are one atomic step: nothing is
+        written and None is returned if the result would drop below it.
+        """
+        uid = int(user_id)
+        with self._lock:
+            new = self.balances.get(uid, 0.0) + float(delta)
+            if min_balance is not None and new < min_balance - 1e-9:
+                return None
+            self.seq += 1
+            line = (json.dumps(ledger_entry(self.seq, uid, delta, kind, ref, note, new), ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.path, "ab") as f:
+                f.write(line)
+            self._size += len(line)
+            self.balances[uid] = new
+            if self.seq - self._snapshot_seq >= self.snapshot_every:
+                self.snapshot()
+        return new
+
+    def snapshot(self):
+        with self._lock:
+            if self.seq == self._snapshot_seq:
+                return
+            write_json(self.snapshot_path, {
+                "seq": self.seq, "offset": self._size, "ts": int(time.time()),
+                "balances": {str(k): v for k, v in self.balances.items()},
+            })
+            self._snapshot_seq = self.seq
+
+    def history(self, user_id: int, limit: int = 20) -> List[dict]:
+        """Last `limit` entries of one user (admin audit; scans the log)."""
+        uid = int(user_id)
+        out: deque = deque(maxlen=limit)
+        scan_jsonl(self.path, 0, lambda _o, e: out.append(e) if int(e.get("user_id", 0)) == uid else None)
+        return list(out)
+
+    def posted_refs(self, refs: Set[str], kind: str) -> Set[str]:
+        """Which of `refs` have an entry of `kind` (startup recovery; scans the log)."""
+        found: Set[str] = set()
+        if refs:
+            scan_jsonl(self.path, 0, lambda _o, e: found.add(e["ref"]) if e.get("kind") == kind and e.get("ref") in refs else None)
+        return found
+
+
+# --------------------
+# Users
+# - the set of known user ids lives in memory; new ids are appended to a small log
+# - users who blocked the bot are logged as "-<id>" and skipped by broadcasts until they
+#   come back (a plain "<id>" line after that clears the mark)
+# - users.json ({"users": [...], "blocked": [...]}) is the compacted snapshot, rewritten once the log grows
+# --------------------
+
+class UserRegistry:
+    def __init__(self, path: Path, log_path: Path, compact_every: int = 500):
+        self.path = path
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self.ids: Set[int] = set()
+        self.blocked: Set[int] = set()
+        self._log_lines = 0
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self.ids, self.blocked = set(), set()
+            snap = read_json(self.path, {"users": []})
+            for uid in (snap.get("users") or []):
+                try: self.ids.add(int(uid))
+                except Exception: pass
+            for uid in (snap.get("blocked") or []):
+                try: self.blocked.add(int(uid))
+                except Exception: pass
+            self._log_lines = 0
+            if self.log_path.exists():
+                for line in self.log_path.read_text(encoding="utf-8").splitlines():
+                    try:
+                        uid = int(line)
+                    except ValueError:
+                        continue
+                    if uid < 0:
+                        self.ids.add(-uid)
+                        self.blocked.add(-uid)
+                    else:
+                        self.ids.add(uid)
+                        self.blocked.discard(uid)
+                    self._log_lines += 1
+
+    def add(self, user_id: int) -> bool:
+        """Register one id; only ids not seen before (or coming back after a block) touch the disk."""
+        uid = int(user_id)
+        if uid in self.blocked:
+            with self._lock:
+                self.blocked.discard(uid)
+                self._append([uid])
+        return self.update((uid,)) > 0
+
+    def mark_blocked(self, user_id: int) -> bool:
+        uid = int(user_id)
+        with self._lock:
+            if uid in self.blocked:
+                return False
+            self.ids.add(uid)
+            self.blocked.add(uid)
+            self._append([-uid])
+            return True
+
+    def _append(self, lines):
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write("".join(f"{x}\n" for x in lines))
+        self._log_lines += len(lines)
+
+    def update(self, user_ids) -> int:
+        with self._lock:
+            new = []
+            for uid in user_ids:
+                try: uid = int(uid)
+                except Exception: continue
+                if uid and uid not in self.ids:
+                    self.ids.add(uid)
+                    new.append(uid)
+            if new:
+                self._append(new)
+            return len(new)
+
+    def flush(self, force: bool = False):
+        with self._lock:
+            if self._log_lines and (force or self._log_lines >= self.compact_every):
+                self.compact()
+
+    def compact(self):
+        with self._lock:
+            write_json(self.path, {"users": sorted(self.ids), "blocked": sorted(self.blocked)})
+            WRITER.flush(self.path)  # snapshot must be on disk before the log goes away
+            self.log_path.write_text("", encoding="utf-8")
+            self._log_lines = 0
+
+
+# --------------------
+# Promo uses
+# - per-user sets of used codes and per-code global counts live in memory
+# - each use is appended to promo_uses.log (jsonl); promo_uses.json ({"users": {uid: [codes]}})
+#   is the compacted snapshot, rewritten once the log grows
+# --------------------
+
+class PromoUses:
+    def __init__(self, path: Path, log_path: Path, compact_every: int = 500):
+        self.path = path
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self.used: Dict[int, Set[str]] = {}
+        self.counts: Dict[str, int] = {}
+        self._log_lines = 0
+        self._lock = threading.RLock()
+        self.load()
+
+    def _remember(self, user_id, code) -> bool:
+        try: uid = int(user_id)
+        except Exception: return False
+        code = str(code or "").upper()
+        codes = self.used.setdefault(uid, set())
+        if not code or code in codes:
+            return False
+        codes.add(code)
+        self.counts[code] = self.counts.get(code, 0) + 1
+        return True
+
+    def _forget(self, user_id, code) -> bool:
+        try: uid = int(user_id)
+        except Exception: return False
+        code = str(code or "").upper()
+        codes = self.used.get(uid)
+        if not codes or code not in codes:
+            return False
+        codes.discard(code)
+        self.counts[code] = max(0, self.counts.get(code, 0) - 1)
+        return True
+
+    def load(self):
+        with self._lock:
+            self.used, self.counts = {}, {}
+            for uid, codes in (read_json(self.path, {"users": {}}).get("users") or {}).items():
+                for code in codes or []:
+                    self._remember(uid, code)
+            def replay(offset: int, row: dict):
+                if row.get("undo"):
+                    self._forget(row.get("user_id"), row.get("code"))
+                else:
+                    self._remember(row.get("user_id"), row.get("code"))
+                self._log_lines += 1
+            self._log_lines = 0
+            scan_jsonl(self.log_path, 0, replay)
+
+    def is_used(self, user_id: int, code: str) -> bool:
+        return str(code).upper() in self.used.get(int(user_id), ())
+
+    def count(self, code: str) -> int:
+        return self.counts.get(str(code).upper(), 0)
+
+    def _append(self, row: dict):
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._log_lines += 1
+
+    def mark(self, user_id: int, code: str) -> bool:
+        """Record one use; False if this user had already used the code."""
+        with self._lock:
+            if not self._remember(user_id, code):
+                return False
+            self._append({"user_id": int(user_id), "code": str(code).upper(), "ts": int(time.time())})
+            return True
+
+    def unmark(self, user_id: int, code: str) -> bool:
+        """Give a recorded use back (the order it paid for was refunded); False if there was none."""
+        with self._lock:
+            if not self._forget(user_id, code):
+                return False
+            self._append({"user_id": int(user_id), "code": str(code).upper(), "ts": int(time.time()), "undo": True})
+            return True
+
+    def flush(self, force: bool = False):
+        with self._lock:
+            if self._log_lines and (force or self._log_lines >= self.compact_every):
+                write_json(self.path, {"users": {str(uid): sorted(codes) for uid, codes in self.used.items() if codes}})
+                WRITER.flush(self.path)
+                self.log_path.write_text("", encoding="utf-8")
+                self._log_lines = 0
+
+
+# --------------------
+# Invoices
+# - hot file (invoices.json) holds only open invoices: indexed in memory by invoice_id,
+#   by user_id, plus the set of pending ids, so /confirm_payment is a dict lookup
+# - sweep() expires pending invoices older than the TTL and moves settled ones
+#   (paid / expired) to an append-only archive segment; a later line for the same
+#   invoice_id supersedes an earlier one
+# - an expired invoice can still be confirmed (the user may have paid late)
+# --------------------
+
+class InvoiceStore:
+    def __init__(self, path: Path, archive_path: Path):
+        self.path = path
+        self.archive_path = archive_path
+        self.hot: Dict[str, dict] = {}
+        self.pending: Set[str] = set()
+        self.archived: Dict[str, int] = {}  # invoice_id -> offset of its latest archive line
+        self.by_user: Dict[int, List[str]] = {}
+        self._archive_size = 0
+        self._dirty = False
+        self._lock = threading.RLock()
+        self.load()
+
+    def _index_user(self, inv: dict):
+        ids = self.by_user.setdefault(int(inv.get("user_id", 0) or 0), [])
+        if inv["invoice_id"] not in ids:
+            ids.append(inv["invoice_id"])
+
+    def load(self):
+        with self._lock:
+            def index(offset: int, inv: dict):
+                self.archived[inv["invoice_id"]] = offset
+                self._index_user(inv)
+            self._archive_size = scan_jsonl(self.archive_path, 0, index)
+            for inv in (read_json(self.path, []) or []):
+                if not isinstance(inv, dict) or not inv.get("invoice_id"):
+                    continue
+                self.hot[inv["invoice_id"]] = inv
+                self._index_user(inv)
+                if inv.get("status") == "pending":
+                    self.pending.add(inv["invoice_id"])
+
+    def _read_archived(self, invoice_id: str) -> dict | None:
+        offset = self.archived.get(invoice_id)
+        if offset is None:
+            return None
+        with open(self.archive_path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def _append_archive(self, rows: List[dict]):
+        if not rows:
+            return
+        with open(self.archive_path, "ab") as f:
+            offset = f.seek(0, 2)
+            for inv in rows:
+                line = (json.dumps(inv, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                self.archived[inv["invoice_id"]] = offset
+                offset += len(line)
+        self._archive_size = offset
+
+    def get(self, invoice_id: str) -> dict | None:
+        with self._lock:
+            return self.hot.get(invoice_id) or self._read_archived(invoice_id)
+
+    def create(self, inv: dict) -> dict:
+        with self._lock:
+            self.hot[inv["invoice_id"]] = inv
+            self.pending.add(inv["invoice_id"])
+            self._index_user(inv)
+            self._dirty = True
+        return inv
+
+    def mark_paid(self, invoice_id: str, paid_at: int) -> dict | None:
+        """pending/expired -> paid. Returns the invoice, or None if unknown or already paid."""
+        with self._lock:
+            inv = self.hot.get(invoice_id)
+            if inv is not None:
+                if inv.get("status") == "paid":
+                    return None
+                inv["status"] = "paid"; inv["paid_at"] = paid_at
+                self.pending.discard(invoice_id)
+                self._dirty = True
+                return inv
+            inv = self._read_archived(invoice_id)
+            if inv is None or inv.get("status") == "paid":
+                return None
+            inv["status"] = "paid"; inv["paid_at"] = paid_at
+            self._append_archive([inv])
+            return inv
+
+    def user_invoices(self, user_id: int) -> List[dict]:
+        with self._lock:
+            return [inv for inv in (self.get(i) for i in self.by_user.get(int(user_id), [])) if inv]
+
+    def paid(self) -> List[dict]:
+        """All paid invoices, hot and archived (startup backfills / migrations only)."""
+        with self._lock:
+            out = [inv for inv in self.hot.values() if inv.get("status") == "paid"]
+            for iid in self.archived:
+                if iid not in self.hot:
+                    inv = self._read_archived(iid)
+                    if inv and inv.get("status") == "paid":
+                        out.append(inv)
+            return out
+
+    def sweep(self, pending_ttl: int, now_ts: int | None = None) -> Tuple[int, int]:
+        """Expire stale pending invoices and archive settled ones. Returns (expired, archived)."""
+        now_ts = int(now_ts or time.time())
+        with self._lock:
+            expired = 0
+            for iid in list(self.pending):
+                inv = self.hot[iid]
+                if now_ts - int(inv.get("created_at") or 0) >= pending_ttl:
+                    inv["status"] = "expired"; inv["expired_at"] = now_ts
+                    self.pending.discard(iid)
+                    expired += 1
+            settled = [inv for iid, inv in self.hot.items() if iid not in self.pending]
+            # archive first: a crash in between leaves a duplicate, never a loss
+            self._append_archive(settled)
+            for inv in settled:
+                del self.hot[inv["invoice_id"]]
+            if settled:
+                self._dirty = True
+            self.flush()
+            return expired, len(settled)
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                write_json(self.path, list(self.hot.values()))
+                self._dirty = False
+
+
+# --------------------
+# Finance rollups
+# - revenue (paid invoices, by paid_at) and expenses (by created_at) are added to hourly
+#   buckets as they happen; buckets older than FINANCE_KEEP_HOURS are dropped
+# - rolling day/week/month windows and calendar today/this-month totals are sums over
+#   at most ~770 buckets instead of the full invoice/expense history
+# - granularity is one hour: the oldest bucket of a rolling window is counted whole
+# --------------------
+
+HOUR = 3600
+FINANCE_KEEP_HOURS = 32 * 24
+FINANCE_WINDOWS = {"day": 86400, "week": 7*86400, "month": 30*86400}
+
+
+def _local_midnight(ts: int) -> int:
+    t = time.localtime(ts)
+    return int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+def _local_month_start(ts: int) -> int:
+    t = time.localtime(ts)
+    return int(time.mktime((t.tm_year, t.tm_mon, 1, 0, 0, 0, 0, 0, -1)))
+
+
+def rollup_totals(buckets: Dict[int, List[float]], now_ts: int) -> Dict[str, Dict[str, float]]:
+    """{"revenue": {...}, "expenses": {...}} for every rolling window plus "today" and "this_month"."""
+    starts = {k: (now_ts - secs) // HOUR * HOUR for k, secs in FINANCE_WINDOWS.items()}
+    starts["today"] = _local_midnight(now_ts)
+    starts["this_month"] = _local_month_start(now_ts)
+    rev = {k: 0.0 for k in starts}
+    exp = {k: 0.0 for k in starts}
+    for hour, (r, e) in buckets.items():
+        if hour > now_ts:
+            continue
+        for k, start in starts.items():
+            if hour >= start:
+                rev[k] += r
+                exp[k] += e
+    return {"revenue": rev, "expenses": exp}
+
+
+class FinanceRollup:
+    """Hourly buckets {hour_ts: [revenue, expenses]} persisted to one small json file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.buckets: Dict[int, List[float]] = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+        raw = read_json(path, None)
+        self.exists = raw is not None
+        for k, v in ((raw or {}).get("hours") or {}).items():
+            try: self.buckets[int(k)] = [float(v[0]), float(v[1])]
+            except Exception: pass
+
+    def add(self, field: str, amount: float, ts: int | None = None):
+        hour = int(ts or time.time()) // HOUR * HOUR
+        col = 0 if field == "revenue" else 1
+        cutoff = int(time.time()) // HOUR * HOUR - FINANCE_KEEP_HOURS * HOUR
+        if hour < cutoff:
+            return  # older than any window we report
+        with self._lock:
+            if hour not in self.buckets:
+                for h in [h for h in self.buckets if h < cutoff]:
+                    del self.buckets[h]
+                self.buckets[hour] = [0.0, 0.0]
+            self.buckets[hour][col] += float(amount)
+            self._dirty = True
+
+    def totals(self, now_ts: int | None = None) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return rollup_totals(self.buckets, int(now_ts or time.time()))
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                write_json(self.path, {"hours": {str(h): v for h, v in sorted(self.buckets.items())}})
+                self._dirty = False
+
+
+# --------------------
+# Orders
+# - append-only JSONL log: one order version per line, appending is a single write()
+# - an update appends the whole order again; the latest line for an order_id wins
+# - side index {user_id: [order keys]} + {order key: offset of latest version} so per-user
+#   history is a few seeks; the sets of orders still running at the supplier and of orders
+#   not yet submitted (ORDER_PENDING_STATUSES) are kept too
+# - the index is a checkpoint of the log: on open the tail past the indexed size is re-scanned,
+#   so it is only rewritten once that tail has grown by a fraction of the log (and at close);
+#   a rewrite is O(all orders), this keeps its cost per appended order constant
+# --------------------
+
+# supplier statuses after which an order is not polled any more; "expired" is ours, set by
+# StatusPoller when an order outlived its max_age without reaching a final status
+ORDER_FINAL_STATUSES = {"completed", "partial", "canceled", "cancelled", "refunded", "failed", "expired"}
+# our own order statuses that still need a supplier call: the record is written before the call
+# ("submitting") or the supplier was unavailable ("queued")
+ORDER_PENDING_STATUSES = {"submitting", "queued"}
+
+def supplier_slots(order: dict) -> List[dict]:
+    """Parts of an order that have a supplier order: the order itself, or the placed items of a combo."""
+    if order.get("type") == "combo":
+        return [it for it in (order.get("items") or [])
+                if isinstance(it, dict) and it.get("provider_order_id") and it.get("state", "placed") == "placed"]
+    return [order] if order.get("provider_order_id") else []
+
+def order_is_open(order: dict) -> bool:
+    return any(str(s.get("supplier_status") or "").lower() not in ORDER_FINAL_STATUSES for s in supplier_slots(order))
+
+
+class OrderLog:
+    INDEX_VERSION = 2
+    CHECKPOINT_MIN_BYTES = 1 << 20  # unindexed tail that is always fine to re-scan on open
+    CHECKPOINT_RATIO = 0.25  # ... or this share of the indexed log, whichever is larger
+
+    def __init__(self, path: Path, index_path: Path, legacy_path: Path | None = None):
+        self.path = path
+        self.index_path = index_path
+        self._users: Dict[int, List[str]] = {}
+        self._latest: Dict[str, int] = {}
+        self._open: Set[str] = set()
+        self._pending: Set[str] = set()
+        self._size = 0
+        self._indexed_size = 0  # log size covered by the index file
+        self._lock = threading.RLock()
+        if legacy_path is not None:
+            self.migrate_legacy(legacy_path)
+        self.load()
+
+    def migrate_legacy(self, legacy_path: Path) -> int:
+        """One-shot import of the old orders.json array. The legacy file is renamed to *.migrated."""
+        if self.path.exists() or not legacy_path.exists():
+            return 0
+        rows = read_json(legacy_path, [])
+        if not isinstance(rows, list):
+            return 0
+        with open(self.path, "ab") as f:
+            for o in rows:
+                if isinstance(o, dict):
+                    f.write((json.dumps(o, ensure_ascii=False) + "\n").encode("utf-8"))
+        legacy_path.rename(legacy_path.with_name(legacy_path.name + ".migrated"))
+        print(f"📦 Migrated {len(rows)} orders from {legacy_path} to {self.path}", flush=True)
+        return len(rows)
+
+    def load(self):
+        with self._lock:
+            idx = read_json(self.index_path, {})
+            try:
+                if idx.get("v") != self.INDEX_VERSION:
+                    raise ValueError("old index format")
+                self._users = {int(k): [str(x) for x in v] for k, v in (idx.get("users") or {}).items()}
+                self._latest = {str(k): int(v) for k, v in (idx.get("latest") or {}).items()}
+                self._open = set(idx.get("open") or [])
+                self._pending = set(idx.get("pending") or [])
+                self._size = int(idx.get("size") or 0)
+            except Exception:
+                self._users, self._latest, self._open, self._pending, self._size = {}, {}, set(), set(), 0
+            log_size = self.path.stat().st_size if self.path.exists() else 0
+            if self._size > log_size:
+                # log was replaced/truncated — index is useless
+                self._users, self._latest, self._open, self._pending, self._size = {}, {}, set(), set(), 0
+            self._indexed_size = self._size
+            if self._size < log_size:
+                self._scan_from(self._size)
+
+    @staticmethod
+    def _key(order: dict, offset: int) -> str:
+        return str(order.get("order_id") or f"@{offset}")
+
+    def _index(self, offset: int, order: dict):
+        key = self._key(order, offset)
+        if key not in self._latest:
+            self._users.setdefault(int(order.get("user_id", 0) or 0), []).append(key)
+        self._latest[key] = offset
+        for keys, member in ((self._open, order_is_open(order)), (self._pending, order.get("status") in ORDER_PENDING_STATUSES)):
+            if member:
+                keys.add(key)
+            else:
+                keys.discard(key)
+
+    def _scan_from(self, start: int):
+        self._size = scan_jsonl(self.path, start, self._index)
+
+    def append(self, order: dict) -> int:
+        line = (json.dumps(order, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.seek(0, 2)
+                f.write(line)
+            self._index(offset, order)
+            self._size = offset + len(line)
+        return offset
+
+    def _read_at(self, f, offset: int) -> dict | None:
+        f.seek(offset)
+        try:
+            return json.loads(f.readline())
+        except Exception:
+            return None
+
+    def _read_keys(self, keys) -> List[dict]:
+        offsets = [self._latest[k] for k in keys if k in self._latest]
+        if not offsets:
+            return []
+        with open(self.path, "rb") as f:
+            return [o for o in (self._read_at(f, off) for off in offsets) if o]
+
+    def get(self, order_id: str) -> dict | None:
+        with self._lock:
+            found = self._read_keys([str(order_id)])
+        return found[0] if found else None
+
+    def update(self, order_id: str, changes: dict) -> dict | None:
+        """Merge `changes` into the latest version and append it; None if the order is unknown."""
+        with self._lock:
+            order = self.get(order_id)
+            if order is None:
+                return None
+            order.update(changes)
+            self.append(order)
+            return order
+
+    def open_orders(self) -> List[dict]:
+        with self._lock:
+            return self._read_keys(list(self._open))
+
+    def pending_orders(self) -> List[dict]:
+        with self._lock:
+            return self._read_keys(list(self._pending))
+
+    def user_orders(self, user_id: int) -> List[dict]:
+        with self._lock:
+            return self._read_keys(self._users.get(int(user_id)) or [])
+
+    def user_count(self, user_id: int) -> int:
+        return len(self._users.get(int(user_id)) or [])
+
+    def last_user_order(self, user_id: int) -> dict | None:
+        keys = self._users.get(int(user_id)) or []
+        if not keys:
+            return None
+        with self._lock:
+            found = self._read_keys(keys[-1:])
+        return found[0] if found else None
+
+    def user_ids(self) -> List[int]:
+        return list(self._users.keys())
+
+    def flush(self, force: bool = False) -> bool:
+        """Checkpoint the index if the unindexed log tail is big enough (any tail with force)."""
+        with self._lock:
+            tail = self._size - self._indexed_size
+            if tail <= 0 or (not force and tail < max(self.CHECKPOINT_MIN_BYTES, self._indexed_size * self.CHECKPOINT_RATIO)):
+                return False
+            write_json(self.index_path, {"v": self.INDEX_VERSION, "size": self._size,
+                                         "users": {str(k): v for k, v in self._users.items()},
+                                         "latest": self._latest, "open": sorted(self._open),
+                                         "pending": sorted(self._pending)})
+            self._indexed_size = self._size
+            return True
+
+
+# --------------------
+# Storage interface
+# --------------------
+
+class Storage(ABC):
+    """Repository interface used by shop_bot.py helpers. All methods are synchronous and cheap.
+
+    A backend that misses one of the abstract methods can't be instantiated.
+    """
+
+    # balances
+    @abstractmethod
+    def get_balance(self, user_id: int) -> float: ...
+    @abstractmethod
+    def set_balance(self, user_id: int, value: float) -> float: ...
+    @abstractmethod
+    def add_balance(self, user_id: int, delta: float, kind: str = "adjust", ref: str | None = None, note: str = "") -> float:
+        ...
+    @abstractmethod
+    def balance_history(self, user_id: int, limit: int = 20) -> List[dict]: ...
+
+    # atomic primitives for the order path: check-and-debit / credit can't interleave with other updates
+    @abstractmethod
+    def debit_if_sufficient(self, user_id: int, amount: float, ref: str | None = None, note: str = "") -> Tuple[bool, float]:
+        """Debit `amount` only if the balance covers it. Returns (ok, balance after the call)."""
+    def credit(self, user_id: int, amount: float, kind: str = "refund", ref: str | None = None, note: str = "") -> float:
+        return self.add_balance(user_id, float(amount), kind, ref, note)
+
+    # orders
+    @abstractmethod
+    def append_order(self, order: dict): ...
+    @abstractmethod
+    def debit_and_enqueue(self, order: dict) -> Tuple[bool, float]:
+        """Order outbox: debit order["cost"] and store the order with status "queued" as one step.
+
+        Returns (ok, balance); nothing is stored when the balance doesn't cover the cost.
+        """
+    @abstractmethod
+    def user_orders(self, user_id: int) -> List[dict]: ...
+    @abstractmethod
+    def user_order_count(self, user_id: int) -> int: ...
+    @abstractmethod
+    def last_user_order(self, user_id: int) -> dict | None: ...
+    @abstractmethod
+    def get_order(self, order_id: str) -> dict | None: ...
+    @abstractmethod
+    def update_order(self, order_id: str, changes: dict) -> dict | None:
+        """Merge `changes` into the stored order; returns the new version or None if unknown."""
+    @abstractmethod
+    def open_orders(self) -> List[dict]:
+        """Orders with a supplier order that hasn't reached a final status (see order_is_open)."""
+    @abstractmethod
+    def pending_orders(self) -> List[dict]:
+        """Orders whose status is in ORDER_PENDING_STATUSES (not yet accepted by the supplier)."""
+
+    # invoices
+    @abstractmethod
+    def create_invoice(self, inv: dict) -> dict: ...
+    @abstractmethod
+    def confirm_invoice(self, invoice_id: str) -> dict | None: ...
+    @abstractmethod
+    def paid_invoices(self) -> List[dict]: ...
+    @abstractmethod
+    def get_invoice(self, invoice_id: str) -> dict | None: ...
+    @abstractmethod
+    def user_invoices(self, user_id: int) -> List[dict]: ...
+    @abstractmethod
+    def sweep_invoices(self, pending_ttl: int) -> Tuple[int, int]:
+        """Expire pending invoices older than pending_ttl seconds, archive settled ones. Returns (expired, archived)."""
+
+    # users
+    @abstractmethod
+    def remember_user(self, user_id: int): ...
+    @abstractmethod
+    def user_ids(self) -> Set[int]:
+        """Live set of every user seen in users/balances/orders/invoices. Do not mutate."""
+    @abstractmethod
+    def mark_blocked(self, user_id: int) -> bool:
+        """Exclude a user who blocked the bot from broadcasts; remember_user() clears it."""
+    @abstractmethod
+    def broadcast_user_ids(self) -> List[int]:
+        """Sorted ids of known users that have not blocked the bot."""
+
+    # expenses
+    @abstractmethod
+    def add_expense(self, row: dict) -> dict: ...
+    @abstractmethod
+    def expenses(self) -> List[dict]: ...
+
+    # finance
+    @abstractmethod
+    def finance_totals(self, now_ts: int | None = None) -> Dict[str, Dict[str, float]]:
+        """Revenue/expenses per window from the hourly rollups (see rollup_totals)."""
+
+    # promo uses
+    @abstractmethod
+    def promo_is_used(self, user_id: int, code: str) -> bool: ...
+    @abstractmethod
+    def promo_mark_used(self, user_id: int, code: str) -> bool:
+        """Record a use; False if this user had already used the code."""
+    @abstractmethod
+    def promo_unmark_used(self, user_id: int, code: str) -> bool:
+        """Undo promo_mark_used for a refunded order; False if no use was recorded."""
+    @abstractmethod
+    def promo_use_count(self, code: str) -> int: ...
+
+    def flush(self): pass
+    def close(self): self.flush()
+
+
+class JsonStorage(Storage):
+    def __init__(self, balances_path: Path, ledger_path: Path, ledger_snapshot_path: Path,
+                 orders_log_path: Path, orders_index_path: Path, orders_legacy_path: Path | None,
+                 invoices_path: Path, invoices_archive_path: Path, users_path: Path, users_log_path: Path, expenses_path: Path, promo_uses_path: Path,
+                 promo_uses_log_path: Path,
+                 finance_path: Path, ledger_snapshot_every: int = 500):
+        self.ledger = Ledger(ledger_path, ledger_snapshot_path, snapshot_every=ledger_snapshot_every)
+        self.balances = BalanceStore(balances_path, on_external_change=self._external_balance_change)
+        self._reconcile_balances()
+        self.orders = OrderLog(orders_log_path, orders_index_path, legacy_path=orders_legacy_path)
+        self._recover_outbox()
+        self.invoices = InvoiceStore(invoices_path, invoices_archive_path)
+        self._recover_invoices()
+        self.expenses_path = expenses_path
+        self.promo_uses = PromoUses(promo_uses_path, promo_uses_log_path)
+        # registry is kept up to date by every write below; the startup backfill catches
+        # ids written before it existed (or by older versions of the bot)
+        self.users = UserRegistry(users_path, users_log_path)
+        self.users.update(self.ledger.balances.keys())
+        self.users.update(self.orders.user_ids())
+        self.users.update(self.invoices.by_user.keys())
+        self.finance = FinanceRollup(finance_path)
+        if not self.finance.exists:
+            # one-time build from history; afterwards buckets are updated on write
+            for inv in self.paid_invoices():
+                self.finance.add("revenue", float(inv.get("amount") or 0), int(inv.get("paid_at") or 0))
+            for e in (self.expenses() or []):
+                if isinstance(e, dict):
+                    self.finance.add("expenses", float(e.get("amount") or 0), int(e.get("created_at") or 0))
+            self.finance._dirty = True
+
+    def _reconcile_balances(self):
+        # The ledger is the source of truth. An empty ledger (first run, or a fresh Render disk
+        # where sync_gist.py restored balances.json) is opened from the file. A file written after
+        # the last ledger entry was edited while the bot was stopped: the difference is posted as
+        # an adjustment, as for an edit at runtime. An older file only missed the last flush and
+        # is brought back in line with the ledger.
+        if self.ledger.seq == 0:
+            for uid in self.balances.user_ids():
+                bal = self.balances.get(uid)
+                if bal:
+                    self.ledger.post(uid, bal, "opening", note=str(self.balances.path))
+            return
+        try:
+            edited = self.balances.path.stat().st_mtime_ns > self.ledger.path.stat().st_mtime_ns
+        except OSError:
+            edited = False
+        in_file = set(self.balances.user_ids())
+        for uid in in_file | set(self.ledger.balances):
+            bal = self.balances.get(uid)
+            if abs(bal - self.ledger.balance(uid)) <= 1e-9:
+                continue
+            if edited and uid in in_file:  # as at runtime, rows missing from the file are not edits
+                self.ledger.post(uid, bal - self.ledger.balance(uid), "adjust",
+                                 note=f"external edit of {self.balances.path} (while stopped)")
+            else:
+                self.balances.set(uid, self.ledger.balance(uid))
+
+    def _external_balance_change(self, user_id: int, old: float, new: float):
+        self.ledger.post(user_id, new - self.ledger.balance(user_id), "adjust", note=f"external edit of {self.balances.path}")
+
+    def get_balance(self, user_id: int) -> float:
+        return self.ledger.balance(user_id)
+
+    def set_balance(self, user_id: int, value: float) -> float:
+        return self.add_balance(user_id, float(value) - self.ledger.balance(user_id), "adjust")
+
+    def add_balance(self, user_id: int, delta: float, kind: str = "adjust", ref: str | None = None, note: str = "") -> float:
+        new = self.ledger.post(user_id, delta, kind, ref, note)
+        self.balances.set(user_id, new)
+        self.users.add(user_id)
+        return new
+
+    def balance_history(self, user_id: int, limit: int = 20) -> List[dict]:
+        return self.ledger.history(user_id, limit)
+
+    def debit_if_sufficient(self, user_id: int, amount: float, ref: str | None = None, note: str = "") -> Tuple[bool, float]:
+        new = self.ledger.post(user_id, -float(amount), "debit", ref, note, min_balance=0.0)
+        if new is None:
+            return False, self.ledger.balance(user_id)
+        self.balances.set(user_id, new)
+        return True, new
+
+    def append_order(self, order: dict):
+        self.orders.append(order)
+        self.users.add(order.get("user_id", 0))
+
+    def debit_and_enqueue(self, order: dict) -> Tuple[bool, float]:
+        # the job line goes first and the ledger debit is the commit point: a crash in between leaves
+        # a queued job without its debit, which _recover_outbox() drops on the next start
+        uid, cost = int(order["user_id"]), float(order["cost"])
+        if self.ledger.balance(uid) < cost - 1e-9:
+            return False, self.ledger.balance(uid)
+        self.append_order({**order, "status": "queued"})
+        ok, bal = self.debit_if_sufficient(uid, cost, ref=order["order_id"])
+        if not ok:
+            self.orders.update(order["order_id"], {"status": "rejected", "error": "insufficient funds"})
+        return ok, bal
+
+    def _recover_invoices(self):
+        # the ledger topup is the commit point of a payment; invoices.json is written on the next
+        # flush, so a crash in between must not leave the invoice pending and payable a second time
+        unpaid = {iid for iid, inv in self.invoices.hot.items() if inv.get("status") != "paid"}
+        for iid in self.ledger.posted_refs(unpaid, "topup"):
+            self.invoices.mark_paid(iid, int(time.time()))
+
+    def _recover_outbox(self):
+        queued = {o["order_id"]: o for o in self.orders.pending_orders() if o.get("status") == "queued"}
+        paid = self.ledger.posted_refs(set(queued), "debit")
+        for oid in set(queued) - paid:
+            self.orders.update(oid, {"status": "rejected", "error": "not charged (interrupted before debit)"})
+
+    def user_orders(self, user_id: int) -> List[dict]:
+        return self.orders.user_orders(user_id)
+
+    def user_order_count(self, user_id: int) -> int:
+        return self.orders.user_count(user_id)
+
+    def last_user_order(self, user_id: int) -> dict | None:
+        return self.orders.last_user_order(user_id)
+
+    def get_order(self, order_id: str) -> dict | None:
+        return self.orders.get(order_id)
+
+    def update_order(self, order_id: str, changes: dict) -> dict | None:
+        return self.orders.update(order_id, changes)
+
+    def open_orders(self) -> List[dict]:
+        return self.orders.open_orders()
+
+    def pending_orders(self) -> List[dict]:
+        return self.orders.pending_orders()
+
+    def create_invoice(self, inv: dict) -> dict:
+        self.invoices.create(inv)
+        self.users.add(inv["user_id"])
+        return inv
+
+    def confirm_invoice(self, invoice_id: str) -> dict | None:
+        inv = self.invoices.mark_paid(invoice_id, int(time.time()))
+        if inv is None:
+            return None
+        self.credit(inv["user_id"], inv["amount"], "topup", ref=invoice_id)
+        self.finance.add("revenue", inv["amount"], inv["paid_at"])
+        return inv
+
+    def paid_invoices(self) -> List[dict]:
+        return self.invoices.paid()
+
+    def get_invoice(self, invoice_id: str) -> dict | None:
+        return self.invoices.get(invoice_id)
+
+    def user_invoices(self, user_id: int) -> List[dict]:
+        return self.invoices.user_invoices(user_id)
+
+    def sweep_invoices(self, pending_ttl: int) -> Tuple[int, int]:
+        return self.invoices.sweep(pending_ttl)
+
+    def remember_user(self, user_id: int):
+        self.users.add(user_id)
+
+    def user_ids(self) -> Set[int]:
+        return self.users.ids
+
+    def mark_blocked(self, user_id: int) -> bool:
+        return self.users.mark_blocked(user_id)
+
+    def broadcast_user_ids(self) -> List[int]:
+        return sorted(uid for uid in self.users.ids if uid and uid not in self.users.blocked)
+
+    def add_expense(self, row: dict) -> dict:
+        rows = self.expenses(); rows.append(row); write_json(self.expenses_path, rows)
+        self.finance.add("expenses", row["amount"], row["created_at"])
+        return row
+
+    def expenses(self) -> List[dict]:
+        return read_json(self.expenses_path, [])
+
+    def finance_totals(self, now_ts: int | None = None) -> Dict[str, Dict[str, float]]:
+        return self.finance.totals(now_ts)
+
+    def promo_is_used(self, user_id: int, code: str) -> bool:
+        return self.promo_uses.is_used(user_id, code)
+
+    def promo_mark_used(self, user_id: int, code: str) -> bool:
+        return self.promo_uses.mark(user_id, code)
+
+    def promo_unmark_used(self, user_id: int, code: str) -> bool:
+        return self.promo_uses.unmark(user_id, code)
+
+    def promo_use_count(self, code: str) -> int:
+        return self.promo_uses.count(code)
+
+    def flush(self):
+        self.balances.flush()
+        self.orders.flush()
+        self.invoices.flush()
+        self.users.flush()
+        self.promo_uses.flush()
+        self.finance.flush()
+
+    def close(self):
+        self.ledger.snapshot()
+        self.flush()
+        self.orders.flush(force=True)
+        self.users.flush(force=True)
+        self.promo_uses.flush(force=True)
+
+
+# --------------------
+# SQLite backend
+# - WAL journal: readers never block the writer, commits are a sequential log append
+# - every lookup goes through an index; statements are parameterized constants so
+#   sqlite3's statement cache reuses the prepared plans
+# --------------------
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS balances (user_id INTEGER PRIMARY KEY, balance REAL NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS ledger (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, kind TEXT NOT NULL, ref TEXT, note TEXT,
+    debit TEXT NOT NULL, credit TEXT NOT NULL, amount REAL NOT NULL, user_id INTEGER NOT NULL, balance REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, seq);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT, user_id INTEGER NOT NULL, created_at INTEGER, data TEXT NOT NULL,
+    open INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, id);
+CREATE INDEX IF NOT EXISTS orders_order_id ON orders (order_id);
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL, note TEXT,
+    status TEXT NOT NULL, created_at INTEGER, paid_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS invoices_user ON invoices (user_id);
+CREATE INDEX IF NOT EXISTS invoices_status_paid ON invoices (status, paid_at);
+CREATE INDEX IF NOT EXISTS invoices_pending ON invoices (created_at) WHERE status='pending';
+CREATE TABLE IF NOT EXISTS invoices_archive (
+    invoice_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL, note TEXT,
+    status TEXT NOT NULL, created_at INTEGER, paid_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS invoices_archive_user ON invoices_archive (user_id);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS blocked_users (user_id INTEGER PRIMARY KEY, blocked_at INTEGER);
+CREATE TABLE IF NOT EXISTS expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, amount REAL NOT NULL, note TEXT, created_at INTEGER);
+CREATE INDEX IF NOT EXISTS expenses_created ON expenses (created_at);
+CREATE TABLE IF NOT EXISTS finance_hourly (hour INTEGER PRIMARY KEY, revenue REAL NOT NULL DEFAULT 0, expenses REAL NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS promo_uses (user_id INTEGER NOT NULL, code TEXT NOT NULL, PRIMARY KEY (user_id, code));
+CREATE INDEX IF NOT EXISTS promo_uses_code ON promo_uses (code);
+"""
+
+_SQL_GET_BALANCE = "SELECT balance FROM balances WHERE user_id=?"
+_SQL_ADD_BALANCE = ("INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET balance=balance+excluded.balance RETURNING balance")
+_SQL_DEBIT_IF_SUFFICIENT = "UPDATE balances SET balance=balance-? WHERE user_id=? AND balance>=? RETURNING balance"
+_SQL_INSERT_LEDGER = ("INSERT INTO ledger (ts, kind, ref, note, debit, credit, amount, user_id, balance) "
+                      "VALUES (:ts, :kind, :ref, :note, :debit, :credit, :amount, :user_id, :balance)")
+_SQL_LEDGER_HISTORY = ("SELECT seq, ts, kind, ref, note, debit, credit, amount, user_id, balance FROM ledger "
+                       "WHERE user_id=? ORDER BY seq DESC LIMIT ?")
+_SQL_INSERT_ORDER = "INSERT INTO orders (order_id, user_id, created_at, data, open) VALUES (?, ?, ?, ?, ?)"
+_SQL_GET_ORDER = "SELECT id, data FROM orders WHERE order_id=? ORDER BY id DESC LIMIT 1"
+_SQL_UPDATE_ORDER = "UPDATE orders SET data=?, open=? WHERE id=?"
+_SQL_OPEN_ORDERS = "SELECT data FROM orders WHERE open=1 ORDER BY id"
+_SQL_PENDING_ORDERS = ("SELECT data FROM orders WHERE json_extract(data, '$.status') IN ('submitting', 'queued') "
+                       "ORDER BY id")
+_SQL_USER_ORDERS = "SELECT data FROM orders WHERE user_id=? ORDER BY id"
+_SQL_USER_ORDER_COUNT = "SELECT COUNT(*) FROM orders WHERE user_id=?"
+_SQL_LAST_USER_ORDER = "SELECT data FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 1"
+_SQL_INSERT_INVOICE = ("INSERT INTO invoices (invoice_id, user_id, amount, note, status, created_at, paid_at) "
+                       "VALUES (:invoice_id, :user_id, :amount, :note, :status, :created_at, :paid_at)")
+_SQL_INSERT_ARCHIVED_INVOICE = ("INSERT OR REPLACE INTO invoices_archive (invoice_id, user_id, amount, note, status, created_at, paid_at) "
+                                "VALUES (:invoice_id, :user_id, :amount, :note, :status, :created_at, :paid_at)")
+_SQL_PAY_INVOICE = ("UPDATE invoices SET status='paid', paid_at=? WHERE invoice_id=? AND status!='paid' "
+                    "RETURNING invoice_id, user_id, amount, note, status, created_at, paid_at")
+_SQL_PAY_ARCHIVED_INVOICE = ("UPDATE invoices_archive SET status='paid', paid_at=? WHERE invoice_id=? AND status!='paid' "
+                             "RETURNING invoice_id, user_id, amount, note, status, created_at, paid_at")
+_SQL_PAID_INVOICES = ("SELECT invoice_id, user_id, amount, note, status, created_at, paid_at FROM invoices WHERE status='paid' "
+                      "UNION ALL SELECT invoice_id, user_id, amount, note, status, created_at, paid_at FROM invoices_archive WHERE status='paid'")
+_SQL_GET_INVOICE = "SELECT invoice_id, user_id, amount, note, status, created_at, paid_at FROM invoices WHERE invoice_id=?"
+_SQL_GET_ARCHIVED_INVOICE = "SELECT invoice_id, user_id, amount, note, status, created_at, paid_at FROM invoices_archive WHERE invoice_id=?"
+_SQL_USER_INVOICES = ("SELECT invoice_id, user_id, amount, note, status, created_at, paid_at FROM invoices_archive WHERE user_id=? "
+                      "UNION ALL SELECT invoice_id, user_id, amount, note, status, created_at, paid_at FROM invoices WHERE user_id=?")
+_SQL_EXPIRE_INVOICES = "UPDATE invoices SET status='expired' WHERE status='pending' AND created_at<?"
+_SQL_ARCHIVE_INVOICES = "INSERT OR REPLACE INTO invoices_archive SELECT * FROM invoices WHERE status!='pending'"
+_SQL_DROP_SETTLED_INVOICES = "DELETE FROM invoices WHERE status!='pending'"
+_SQL_INSERT_USER = "INSERT OR IGNORE INTO users (user_id) VALUES (?)"
+_SQL_BLOCK_USER = "INSERT OR IGNORE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)"
+_SQL_UNBLOCK_USER = "DELETE FROM blocked_users WHERE user_id=?"
+_SQL_USER_IDS = ("SELECT user_id FROM users UNION SELECT user_id FROM balances UNION SELECT user_id FROM invoices "
+                 "UNION SELECT user_id FROM invoices_archive UNION SELECT user_id FROM orders")
+_SQL_INSERT_EXPENSE = "INSERT INTO expenses (amount, note, created_at) VALUES (:amount, :note, :created_at)"
+_SQL_EXPENSES = "SELECT amount, note, created_at FROM expenses ORDER BY id"
+_SQL_FINANCE_ADD_REVENUE = ("INSERT INTO finance_hourly (hour, revenue) VALUES (?, ?) "
+                            "ON CONFLICT(hour) DO UPDATE SET revenue=revenue+excluded.revenue")
+_SQL_FINANCE_ADD_EXPENSES = ("INSERT INTO finance_hourly (hour, expenses) VALUES (?, ?) "
+                             "ON CONFLICT(hour) DO UPDATE SET expenses=expenses+excluded.expenses")
+_SQL_FINANCE_BUCKETS = "SELECT hour, revenue, expenses FROM finance_hourly WHERE hour>=?"
+_SQL_FINANCE_PRUNE = "DELETE FROM finance_hourly WHERE hour<?"
+_SQL_FINANCE_BACKFILL = """
+INSERT INTO finance_hourly (hour, revenue, expenses)
+SELECT hour, SUM(r), SUM(e) FROM (
+    SELECT paid_at / 3600 * 3600 AS hour, amount AS r, 0 AS e FROM invoices WHERE status='paid' AND paid_at>=?
+    UNION ALL
+    SELECT paid_at / 3600 * 3600, amount, 0 FROM invoices_archive WHERE status='paid' AND paid_at>=?
+    UNION ALL
+    SELECT created_at / 3600 * 3600, 0, amount FROM expenses WHERE created_at>=?
+) GROUP BY hour
+"""
+_SQL_PROMO_USED = "SELECT 1 FROM promo_uses WHERE user_id=? AND code=?"
+_SQL_PROMO_MARK = "INSERT OR IGNORE INTO promo_uses (user_id, code) VALUES (?, ?)"
+_SQL_PROMO_UNMARK = "DELETE FROM promo_uses WHERE user_id=? AND code=?"
+_SQL_PROMO_COUNT = "SELECT COUNT(*) FROM promo_uses WHERE code=?"
+
+_LEDGER_COLS = ("seq", "ts", "kind", "ref", "note", "debit", "credit", "amount", "user_id", "balance")
+_INVOICE_COLS = ("invoice_id", "user_id", "amount", "note", "status", "created_at", "paid_at")
+
+
+class SqliteStorage(Storage):
+    def __init__(self, path: Path):
+        self.path = path
+        # one connection shared by the event loop and to_thread workers, serialized by _lock
+        self._db = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False, cached_statements=64)
+        self._lock = threading.RLock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SQLITE_SCHEMA)
+        if "open" not in {r[1] for r in self._db.execute("PRAGMA table_info(orders)")}:
+            self._migrate_orders_open()
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_open ON orders (id) WHERE open=1")
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_pending ON orders (id) "
+                         "WHERE json_extract(data, '$.status') IN ('submitting', 'queued')")
+        if self._db.execute("SELECT 1 FROM finance_hourly LIMIT 1").fetchone() is None:
+            since = int(time.time()) // HOUR * HOUR - FINANCE_KEEP_HOURS * HOUR
+            self._db.execute(_SQL_FINANCE_BACKFILL, (since, since, since))
+        # in-memory copy of the users table, filled once from every table that carries a user_id
+        self._users: Set[int] = {int(r[0]) for r in self._db.execute(_SQL_USER_IDS).fetchall()}
+        self._blocked: Set[int] = {int(r[0]) for r in self._db.execute("SELECT user_id FROM blocked_users").fetchall()}
+
+    def _migrate_orders_open(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("ALTER TABLE orders ADD COLUMN open INTEGER NOT NULL DEFAULT 0")
+                for rid, data in self._db.execute("SELECT id, data FROM orders").fetchall():
+                    if order_is_open(json.loads(data)):
+                        self._db.execute("UPDATE orders SET open=1 WHERE id=?", (rid,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _seen(self, user_id: int):
+        uid = int(user_id)
+        if uid not in self._users:
+            self._write(_SQL_INSERT_USER, (uid,))
+            self._users.add(uid)
+
+    def _one(self, sql: str, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchone()
+
+    def _all(self, sql: str, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _write(self, sql: str, args=()):
+        with self._lock:
+            return self._db.execute(sql, args)
+
+    def get_balance(self, user_id: int) -> float:
+        row = self._one(_SQL_GET_BALANCE, (int(user_id),))
+        return float(row[0]) if row else 0.0
+
+    def set_balance(self, user_id: int, value: float) -> float:
+        with self._lock:
+            return self.add_balance(user_id, float(value) - self.get_balance(user_id), "adjust")
+
+    def _post(self, user_id: int, delta: float, kind: str, ref: str | None, note: str) -> float:
+        # caller holds the transaction; fetchall because RETURNING only completes once fully stepped
+        new = float(self._db.execute(_SQL_ADD_BALANCE, (int(user_id), float(delta))).fetchall()[0][0])
+        self._db.execute(_SQL_INSERT_LEDGER, ledger_entry(0, user_id, delta, kind, ref, note, new))
+        return new
+
+    def add_balance(self, user_id: int, delta: float, kind: str = "adjust", ref: str | None = None, note: str = "") -> float:
+        # balance row and ledger row change in one transaction; the balances table is the materialized view
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                new = self._post(user_id, delta, kind, ref, note)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        self._seen(user_id)
+        return new
+
+    def debit_if_sufficient(self, user_id: int, amount: float, ref: str | None = None, note: str = "") -> Tuple[bool, float]:
+        uid, amount = int(user_id), float(amount)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(_SQL_DEBIT_IF_SUFFICIENT, (amount, uid, amount - 1e-9)).fetchall()
+                if rows:
+                    new = float(rows[0][0])
+                    self._db.execute(_SQL_INSERT_LEDGER, ledger_entry(0, uid, -amount, "debit", ref, note, new))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return (True, new) if rows else (False, self.get_balance(uid))
+
+    def balance_history(self, user_id: int, limit: int = 20) -> List[dict]:
+        return [dict(zip(_LEDGER_COLS, r)) for r in reversed(self._all(_SQL_LEDGER_HISTORY, (int(user_id), int(limit))))]
+
+    def append_order(self, order: dict):
+        self._write(_SQL_INSERT_ORDER, (order.get("order_id"), int(order.get("user_id", 0) or 0), order.get("created_at"),
+                                        json.dumps(order, ensure_ascii=False), int(order_is_open(order))))
+        self._seen(order.get("user_id", 0) or 0)
+
+    def debit_and_enqueue(self, order: dict) -> Tuple[bool, float]:
+        uid, amount = int(order["user_id"]), float(order["cost"])
+        job = {**order, "status": "queued"}
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(_SQL_DEBIT_IF_SUFFICIENT, (amount, uid, amount - 1e-9)).fetchall()
+                if rows:
+                    new = float(rows[0][0])
+                    self._db.execute(_SQL_INSERT_LEDGER, ledger_entry(0, uid, -amount, "debit", order["order_id"], "", new))
+                    self._db.execute(_SQL_INSERT_ORDER, (order["order_id"], uid, order.get("created_at"),
+                                                         json.dumps(job, ensure_ascii=False), 0))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if not rows:
+            return False, self.get_balance(uid)
+        self._seen(uid)
+        return True, new
+
+    def user_orders(self, user_id: int) -> List[dict]:
+        return [json.loads(r[0]) for r in self._all(_SQL_USER_ORDERS, (int(user_id),))]
+
+    def user_order_count(self, user_id: int) -> int:
+        return int(self._one(_SQL_USER_ORDER_COUNT, (int(user_id),))[0])
+
+    def last_user_order(self, user_id: int) -> dict | None:
+        row = self._one(_SQL_LAST_USER_ORDER, (int(user_id),))
+        return json.loads(row[0]) if row else None
+
+    def get_order(self, order_id: str) -> dict | None:
+        row = self._one(_SQL_GET_ORDER, (str(order_id),))
+        return json.loads(row[1]) if row else None
+
+    def update_order(self, order_id: str, changes: dict) -> dict | None:
+        with self._lock:
+            row = self._one(_SQL_GET_ORDER, (str(order_id),))
+            if row is None:
+                return None
+            order = json.loads(row[1])
+            order.update(changes)
+            self._write(_SQL_UPDATE_ORDER, (json.dumps(order, ensure_ascii=False), int(order_is_open(order)), row[0]))
+            return order
+
+    def open_orders(self) -> List[dict]:
+        return [json.loads(r[0]) for r in self._all(_SQL_OPEN_ORDERS)]
+
+    def pending_orders(self) -> List[dict]:
+        return [json.loads(r[0]) for r in self._all(_SQL_PENDING_ORDERS)]
+
+    def create_invoice(self, inv: dict) -> dict:
+        self._write(_SQL_INSERT_INVOICE, inv)
+        self._seen(inv["user_id"])
+        return inv
+
+    def confirm_invoice(self, invoice_id: str) -> dict | None:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now_ts = int(time.time())
+                rows = (self._db.execute(_SQL_PAY_INVOICE, (now_ts, invoice_id)).fetchall()
+                        or self._db.execute(_SQL_PAY_ARCHIVED_INVOICE, (now_ts, invoice_id)).fetchall())
+                row = rows[0] if rows else None
+                if row:
+                    self._post(row[1], row[2], "topup", invoice_id, "")
+                    self._db.execute(_SQL_FINANCE_ADD_REVENUE, (row[6] // HOUR * HOUR, row[2]))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return dict(zip(_INVOICE_COLS, row)) if row else None
+
+    def paid_invoices(self) -> List[dict]:
+        return [dict(zip(_INVOICE_COLS, r)) for r in self._all(_SQL_PAID_INVOICES)]
+
+    def get_invoice(self, invoice_id: str) -> dict | None:
+        row = self._one(_SQL_GET_INVOICE, (invoice_id,)) or self._one(_SQL_GET_ARCHIVED_INVOICE, (invoice_id,))
+        return dict(zip(_INVOICE_COLS, row)) if row else None
+
+    def user_invoices(self, user_id: int) -> List[dict]:
+        return [dict(zip(_INVOICE_COLS, r)) for r in self._all(_SQL_USER_INVOICES, (int(user_id), int(user_id)))]
+
+    def sweep_invoices(self, pending_ttl: int) -> Tuple[int, int]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                expired = self._db.execute(_SQL_EXPIRE_INVOICES, (int(time.time()) - int(pending_ttl),)).rowcount
+                self._db.execute(_SQL_ARCHIVE_INVOICES)
+                archived = self._db.execute(_SQL_DROP_SETTLED_INVOICES).rowcount
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return expired, archived
+
+    def remember_user(self, user_id: int):
+        uid = int(user_id)
+        if uid in self._blocked:
+            self._write(_SQL_UNBLOCK_USER, (uid,))
+            self._blocked.discard(uid)
+        self._seen(uid)
+
+    def user_ids(self) -> Set[int]:
+        return self._users
+
+    def mark_blocked(self, user_id: int) -> bool:
+        uid = int(user_id)
+        if uid in self._blocked:
+            return False
+        self._seen(uid)
+        self._write(_SQL_BLOCK_USER, (uid, int(time.time())))
+        self._blocked.add(uid)
+        return True
+
+    def broadcast_user_ids(self) -> List[int]:
+        return sorted(uid for uid in self._users if uid and uid not in self._blocked)
+
+    def add_expense(self, row: dict) -> dict:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(_SQL_INSERT_EXPENSE, row)
+                self._db.execute(_SQL_FINANCE_ADD_EXPENSES, (int(row["created_at"]) // HOUR * HOUR, float(row["amount"])))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return row
+
+    def expenses(self) -> List[dict]:
+        return [{"amount": r[0], "note": r[1], "created_at": r[2]} for r in self._all(_SQL_EXPENSES)]
+
+    def finance_totals(self, now_ts: int | None = None) -> Dict[str, Dict[str, float]]:
+        now_ts = int(now_ts or time.time())
+        since = now_ts // HOUR * HOUR - FINANCE_KEEP_HOURS * HOUR
+        self._write(_SQL_FINANCE_PRUNE, (since,))
+        buckets = {int(h): [float(r), float(e)] for h, r, e in self._all(_SQL_FINANCE_BUCKETS, (since,))}
+        return rollup_totals(buckets, now_ts)
+
+    def promo_is_used(self, user_id: int, code: str) -> bool:
+        return self._one(_SQL_PROMO_USED, (int(user_id), code.upper())) is not None
+
+    def promo_mark_used(self, user_id: int, code: str) -> bool:
+        return self._write(_SQL_PROMO_MARK, (int(user_id), code.upper())).rowcount > 0
+
+    def promo_unmark_used(self, user_id: int, code: str) -> bool:
+        return self._write(_SQL_PROMO_UNMARK, (int(user_id), code.upper())).rowcount > 0
+
+    def promo_use_count(self, code: str) -> int:
+        return int(self._one(_SQL_PROMO_COUNT, (code.upper(),))[0])
+
+    def import_from(self, src: JsonStorage):
+        """Copy everything from the json files into a freshly created database (one transaction)."""
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN")
+            try:
+                for uid, bal in src.ledger.balances.items():
+                    if bal:
+                        self._post(uid, bal, "opening", None, "imported from json storage")
+                for uid in src.orders.user_ids():
+                    for o in src.user_orders(uid):
+                        db.execute(_SQL_INSERT_ORDER, (o.get("order_id"), uid, o.get("created_at"),
+                                                       json.dumps(o, ensure_ascii=False), int(order_is_open(o))))
+                for inv in src.invoices.hot.values():
+                    db.execute(_SQL_INSERT_INVOICE, {k: inv.get(k) for k in _INVOICE_COLS})
+                for iid in src.invoices.archived:
+                    if iid not in src.invoices.hot:
+                        inv = src.invoices.get(iid)
+                        db.execute(_SQL_INSERT_ARCHIVED_INVOICE, {k: inv.get(k) for k in _INVOICE_COLS})
+                for uid in src.user_ids():
+                    db.execute(_SQL_INSERT_USER, (uid,))
+                self._users.update(src.user_ids())
+                now = int(time.time())
+                for uid in src.users.blocked:
+                    db.execute(_SQL_BLOCK_USER, (uid, now))
+                self._blocked.update(src.users.blocked)
+                for e in (src.expenses() or []):
+                    if isinstance(e, dict):
+                        db.execute(_SQL_INSERT_EXPENSE, {"amount": float(e.get("amount") or 0), "note": e.get("note", ""),
+                                                         "created_at": e.get("created_at")})
+                for uid, codes in src.promo_uses.used.items():
+                    for code in codes:
+                        db.execute(_SQL_PROMO_MARK, (uid, code))
+                since = int(time.time()) // HOUR * HOUR - FINANCE_KEEP_HOURS * HOUR
+                db.execute("DELETE FROM finance_hourly")
+                db.execute(_SQL_FINANCE_BACKFILL, (since, since, since))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Runs the bot's long-lived services as asyncio tasks in one process.
+
+A service is `async def service(stop: asyncio.Event)` that runs until `stop` is set.
+- a service that raises is restarted after a backoff (1 s doubling to `max_backoff`,
+  reset once it has stayed up for `healthy_after` seconds)
+- a service that returns on its own is finished and not restarted
+- SIGINT / SIGTERM start a graceful shutdown: services are stopped one by one in reverse
+  order of registration, each given `stop_timeout` seconds before it is cancelled
+"""
+from __future__ import annotations
+import asyncio, signal, time, traceback
+from typing import Awaitable, Callable, List, Tuple
+
+Service = Callable[[asyncio.Event], Awaitable[None]]
+
+
+class Supervisor:
+    def __init__(self, max_backoff: float = 60, healthy_after: float = 60, stop_timeout: float = 30):
+        self.max_backoff = max_backoff
+        self.healthy_after = healthy_after
+        self.stop_timeout = stop_timeout
+        self._services: List[Tuple[str, Service]] = []
+        self._stops: List[asyncio.Event] = []
+        self._tasks: List[asyncio.Task] = []
+        self.restarts: dict = {}
+
+    def add(self, name: str, service: Service):
+        self._services.append((name, service))
+
+    async def _keep_running(self, name: str, service: Service, stop: asyncio.Event):
+        backoff = 1.0
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                await service(stop)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"⚠️ Service {name} crashed:", flush=True)
+                traceback.print_exc()
+            if time.monotonic() - started >= self.healthy_after:
+                backoff = 1.0
+            self.restarts[name] = self.restarts.get(name, 0) + 1
+            print(f"🔁 Restarting {name} in {backoff:.0f}s", flush=True)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def run(self):
+        """Start every service and block until a shutdown signal (or all services finished)."""
+        shutdown = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, shutdown.set)
+            except NotImplementedError:
+                pass
+        self._stops = [asyncio.Event() for _ in self._services]
+        self._tasks = [asyncio.create_task(self._keep_running(name, svc, stop), name=name)
+                       for (name, svc), stop in zip(self._services, self._stops)]
+        all_done = asyncio.create_task(asyncio.wait(self._tasks))
+        waiter = asyncio.create_task(shutdown.wait())
+        await asyncio.wait({all_done, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        all_done.cancel()
+        await self.shutdown()
+
+    async def shutdown(self):
+        for (name, _), stop, task in reversed(list(zip(self._services, self._stops, self._tasks))):
+            stop.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=self.stop_timeout)
+            except asyncio.TimeoutError:
+                print(f"⚠️ Service {name} did not stop in {self.stop_timeout:.0f}s, cancelling", flush=True)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            except Exception:
+                pass
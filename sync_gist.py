@@ -1,5 +1,6 @@
+import os, asyncio, hashlib, sys, traceback
 
-import os, time, json, requests, hashlib, sys, traceback
+import aiohttp
 
 GIST_ID = os.getenv("GIST_ID", "").strip()
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN", "").strip()
@@ -8,9 +9,9 @@ INTERVAL = int(os.getenv("GIST_SYNC_INTERVAL", "20"))  # seconds
 
 API_URL = f"https://api.github.com/gists/{GIST_ID}" if GIST_ID else None
 HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
+TIMEOUT = aiohttp.ClientTimeout(total=30)
 
 def sha1(s: str) -> str:
-    import hashlib
     return hashlib.sha1(s.encode("utf-8")).hexdigest()
 
 def load_local() -> str:
@@ -21,87 +22,110 @@ def load_local() -> str:
         return f.read()
 
 def save_local(content: str):
-    with open(FILE_PATH, "w", encoding="utf-8") as f:
+    # temp file + os.replace so the bot never reads a half-written balances file
+    tmp = FILE_PATH + ".gist.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         f.write(content if content.endswith("\n") else content + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, FILE_PATH)
 
-def get_remote() -> str | None:
+async def get_remote(session: aiohttp.ClientSession) -> str | None:
     try:
-        r = requests.get(API_URL, headers=HEADERS, timeout=30)
-        if r.status_code == 200:
-            data = r.json()
-            files = data.get("files", {})
-            if "balances.json" in files and files["balances.json"] and files["balances.json"].get("content") is not None:
-                return files["balances.json"]["content"]
-        elif r.status_code == 404:
-            return None
-        else:
-            print(f"[gist] GET failed {r.status_code}: {r.text[:200]}", flush=True)
+        async with session.get(API_URL, headers=HEADERS) as r:
+            if r.status == 200:
+                data = await r.json()
+                files = data.get("files", {})
+                if "balances.json" in files and files["balances.json"] and files["balances.json"].get("content") is not None:
+                    return files["balances.json"]["content"]
+            elif r.status == 404:
+                return None
+            else:
+                print(f"[gist] GET failed {r.status}: {(await r.text())[:200]}", flush=True)
     except Exception as e:
         print("[gist] GET error:", e, flush=True)
     return None
 
-def patch_remote(content: str) -> bool:
+async def patch_remote(session: aiohttp.ClientSession, content: str) -> bool:
     payload = {"files": {"balances.json": {"content": content}}}
     try:
-        r = requests.patch(API_URL, headers=HEADERS, json=payload, timeout=30)
-        if r.status_code in (200, 201):
-            return True
-        print(f"[gist] PATCH failed {r.status_code}: {r.text[:200]}", flush=True)
+        async with session.patch(API_URL, headers=HEADERS, json=payload) as r:
+            if r.status in (200, 201):
+                return True
+            print(f"[gist] PATCH failed {r.status}: {(await r.text())[:200]}", flush=True)
     except Exception as e:
         print("[gist] PATCH error:", e, flush=True)
     return False
 
-def ensure_creds():
-    if not GIST_ID or not GITHUB_TOKEN:
-        print("⚠️  GIST balance sync disabled (GIST_ID or GITHUB_TOKEN not set).", flush=True)
-        sys.exit(0)
+def enabled() -> bool:
+    return bool(GIST_ID and GITHUB_TOKEN)
 
-def main():
-    ensure_creds()
+async def _sleep(stop: asyncio.Event, seconds: float) -> bool:
+    """Wait `seconds` or until stop is set; True if stopping."""
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def run(stop: asyncio.Event):
+    """Sync loop; returns once `stop` is set. Runs as a task inside shop_bot.py's supervisor."""
+    if not enabled():
+        print("⚠️  GIST balance sync disabled (GIST_ID or GITHUB_TOKEN not set).", flush=True)
+        return
     print("🧩 Gist sync starting…", flush=True)
 
-    remote = get_remote()
-    if remote is None:
-        print("ℹ️  Remote balances.json not found — creating.", flush=True)
-        patch_remote("{}\n")
-        remote = "{}\n"
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
+        remote = await get_remote(session)
+        if remote is None:
+            print("ℹ️  Remote balances.json not found — creating.", flush=True)
+            await patch_remote(session, "{}\n")
+            remote = "{}\n"
 
-    local = load_local()
+        local = load_local()
 
-    try:
-        if local.strip() in ("", "{}") and remote.strip() not in ("", "{}"):
-            save_local(remote)
-            local = remote
-            print("⬇️  Pulled balances from Gist.", flush=True)
-    except Exception:
-        import traceback; traceback.print_exc()
-
-    last_local_hash = sha1(local)
-    last_remote_hash = sha1(remote)
-
-    while True:
-        time.sleep(INTERVAL)
-        # push local updates
         try:
-            current = load_local()
-            if sha1(current) != last_local_hash:
-                if patch_remote(current):
-                    last_local_hash = sha1(current)
-                    last_remote_hash = last_local_hash
-                    print("⬆️  Pushed balances.json to Gist.", flush=True)
+            if local.strip() in ("", "{}") and remote.strip() not in ("", "{}"):
+                save_local(remote)
+                local = remote
+                print("⬇️  Pulled balances from Gist.", flush=True)
         except Exception:
-            import traceback; traceback.print_exc()
+            traceback.print_exc()
+
+        last_local_hash = sha1(local)
+        last_remote_hash = sha1(remote)
+
+        while not await _sleep(stop, INTERVAL):
+            # push local updates
+            try:
+                current = load_local()
+                if sha1(current) != last_local_hash:
+                    if await patch_remote(session, current):
+                        last_local_hash = sha1(current)
+                        last_remote_hash = last_local_hash
+                        print("⬆️  Pushed balances.json to Gist.", flush=True)
+            except Exception:
+                traceback.print_exc()
+
+            # pull remote changes (manual edits)
+            try:
+                new_remote = await get_remote(session)
+                if new_remote is not None and sha1(new_remote) != last_remote_hash:
+                    save_local(new_remote)
+                    last_remote_hash = sha1(new_remote)
+                    last_local_hash  = last_remote_hash
+                    print("⬇️  Pulled remote balances.json from Gist.", flush=True)
+            except Exception:
+                traceback.print_exc()
 
-        # pull remote changes (manual edits)
-        try:
-            new_remote = get_remote()
-            if new_remote is not None and sha1(new_remote) != last_remote_hash:
-                save_local(new_remote)
-                last_remote_hash = sha1(new_remote)
-                last_local_hash  = last_remote_hash
-                print("⬇️  Pulled remote balances.json from Gist.", flush=True)
-        except Exception:
-            import traceback; traceback.print_exc()
+def main():
+    if not enabled():
+        print("⚠️  GIST balance sync disabled (GIST_ID or GITHUB_TOKEN not set).", flush=True)
+        sys.exit(0)
+    try:
+        asyncio.run(run(asyncio.Event()))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,102 @@
+import asyncio
+import atexit
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from looksmm import AddResult, CircuitBreaker, LooksMMError, Submitter  # noqa: E402
+from storage import WRITER, JsonStorage, SqliteStorage  # noqa: E402
+
+
+def open_json_storage(root: Path) -> JsonStorage:
+    return JsonStorage(
+        balances_path=root / "balances.json", ledger_path=root / "ledger.jsonl",
+        ledger_snapshot_path=root / "ledger_snapshot.json",
+        orders_log_path=root / "orders.jsonl", orders_index_path=root / "orders_index.json",
+        orders_legacy_path=None,
+        invoices_path=root / "invoices.json", invoices_archive_path=root / "invoices_archive.jsonl",
+        users_path=root / "users.json", users_log_path=root / "users.jsonl",
+        expenses_path=root / "expenses.json",
+        promo_uses_path=root / "promo_uses.json", promo_uses_log_path=root / "promo_uses.jsonl",
+        finance_path=root / "finance.json",
+    )
+
+
+@pytest.fixture
+def json_storage(tmp_path):
+    """JsonStorage in tmp_path, closed after the test; tests that reopen it call open_json_storage."""
+    st = open_json_storage(tmp_path)
+    yield st
+    st.close()
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path):
+    st = open_json_storage(tmp_path) if request.param == "json" else SqliteStorage(tmp_path / "shop.db")
+    yield st
+    st.close()
+
+
+class FakeSupplier:
+    """Stands in for LooksMMClient: `errors` maps service_id -> exception raised by add()."""
+
+    def __init__(self):
+        self.errors = {}
+        self.added = []
+        self.cancelled = []
+        self._next_id = 1000
+
+    async def add(self, service_id, link, quantity):
+        await asyncio.sleep(0)  # a real call yields; concurrent submissions interleave here
+        err = self.errors.get(service_id)
+        if err is not None:
+            raise err
+        self._next_id += 1
+        self.added.append((service_id, link, quantity, self._next_id))
+        return AddResult(order=self._next_id, raw={"order": self._next_id})
+
+    async def cancel(self, order_ids, timeout=None):
+        self.cancelled.extend(int(i) for i in order_ids)
+        return {int(i): True for i in order_ids}
+
+
+def rejected(message="bad link"):
+    return LooksMMError(message)
+
+
+@pytest.fixture(scope="session")
+def _shop_bot(tmp_path_factory):
+    # shop_bot opens its stores from relative paths at import: keep them out of the repo
+    cwd, window = os.getcwd(), WRITER.window
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    try:
+        import shop_bot
+        atexit.unregister(shop_bot.STORAGE.close)
+        shop_bot.STORAGE.close()
+        WRITER.flush()
+    finally:
+        WRITER.window = window  # tests read files right after writing them
+        os.chdir(cwd)
+    return shop_bot
+
+
+@pytest.fixture
+def supplier():
+    return FakeSupplier()
+
+
+@pytest.fixture
+def bot(_shop_bot, json_storage, supplier, tmp_path, monkeypatch):
+    """shop_bot with fresh storage and `supplier` behind a real Submitter."""
+    from promo import PromoEngine
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(_shop_bot, "STORAGE", json_storage)
+    monkeypatch.setattr(_shop_bot, "PROMOS", PromoEngine(tmp_path / "promo_codes.json", json_storage))
+    monkeypatch.setattr(_shop_bot, "LOOKSMM", supplier)
+    monkeypatch.setattr(_shop_bot, "SUBMITTER", Submitter(supplier, CircuitBreaker(threshold=2, cooldown=60), retries=0))
+    return _shop_bot
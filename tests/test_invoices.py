@@ -0,0 +1,73 @@
+import time
+
+from conftest import open_json_storage
+
+
+def _invoice(invoice_id, user_id=1, amount=100.0, age=0):
+    return {"invoice_id": invoice_id, "user_id": user_id, "amount": float(amount), "note": "",
+            "status": "pending", "created_at": int(time.time()) - age, "paid_at": None}
+
+
+def test_confirm_credits_once(storage):
+    storage.create_invoice(_invoice("i1"))
+    inv = storage.confirm_invoice("i1")
+    assert (inv["status"], inv["amount"]) == ("paid", 100.0)
+    assert inv["paid_at"]
+    assert storage.confirm_invoice("i1") is None
+    assert storage.confirm_invoice("nope") is None
+    assert storage.get_balance(1) == 100.0
+
+
+def test_sweep_expires_stale_pending_and_archives_settled(storage):
+    storage.create_invoice(_invoice("old", age=7200))
+    storage.create_invoice(_invoice("fresh"))
+    storage.create_invoice(_invoice("paid"))
+    storage.confirm_invoice("paid")
+
+    expired, _ = storage.sweep_invoices(3600)
+    assert expired == 1
+    assert storage.get_invoice("old")["status"] == "expired"
+    assert storage.get_invoice("fresh")["status"] == "pending"
+    assert storage.get_invoice("paid")["status"] == "paid"
+    assert {i["invoice_id"] for i in storage.user_invoices(1)} == {"old", "fresh", "paid"}
+    assert storage.sweep_invoices(3600) == (0, 0)  # nothing new to expire or archive
+
+
+def test_expired_invoice_can_still_be_paid_once(storage):
+    storage.create_invoice(_invoice("late", age=7200))
+    storage.sweep_invoices(3600)
+    storage.sweep_invoices(3600)
+    assert storage.confirm_invoice("late")["status"] == "paid"
+    assert storage.confirm_invoice("late") is None
+    assert storage.get_invoice("late")["status"] == "paid"
+    assert storage.get_balance(1) == 100.0
+    assert [i["invoice_id"] for i in storage.paid_invoices()] == ["late"]
+
+
+def test_archive_survives_reopen(tmp_path):
+    st = open_json_storage(tmp_path)
+    st.create_invoice(_invoice("old", age=7200))
+    st.create_invoice(_invoice("paid"))
+    st.confirm_invoice("paid")
+    assert st.sweep_invoices(3600) == (1, 2)
+    st.close()
+
+    st = open_json_storage(tmp_path)
+    assert st.invoices.hot == {}
+    assert st.get_invoice("old")["status"] == "expired"
+    assert st.get_invoice("paid")["status"] == "paid"
+    assert st.confirm_invoice("paid") is None
+    st.close()
+
+
+def test_paid_status_lost_in_crash_is_recovered_from_ledger(tmp_path):
+    st = open_json_storage(tmp_path)
+    st.create_invoice(_invoice("i1"))
+    st.flush()
+    st.confirm_invoice("i1")  # the topup is on disk, invoices.json still says pending
+
+    st = open_json_storage(tmp_path)
+    assert st.get_invoice("i1")["status"] == "paid"
+    assert st.confirm_invoice("i1") is None
+    assert st.get_balance(1) == 100.0
+    st.close()
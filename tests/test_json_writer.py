@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+import time
+
+from storage import JsonWriter, _MISSING
+
+
+def test_group_commit_writes_latest_payload_once(tmp_path):
+    w = JsonWriter(window=60)
+    path = tmp_path / "a.json"
+    for i in range(5):
+        w.write(path, {"n": i})
+    assert w.pending(path) == {"n": 4}
+    assert not path.exists()
+    w.flush(path)
+    assert json.loads(path.read_text()) == {"n": 4}
+    assert w.pending(path) is _MISSING
+    assert (w.writes_requested, w.writes_performed) == (5, 1)
+
+
+def test_slow_fsync_does_not_block_readers_or_writers(tmp_path, monkeypatch):
+    w = JsonWriter(window=60)
+    path = tmp_path / "a.json"
+    in_fsync, release = threading.Event(), threading.Event()
+    real_fsync = os.fsync
+
+    def slow_fsync(fd):
+        in_fsync.set()
+        release.wait(5)
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    w.write(path, {"n": 1})
+    flusher = threading.Thread(target=w.flush)
+    flusher.start()
+    assert in_fsync.wait(5)
+
+    t0 = time.monotonic()
+    assert w.pending(path) == {"n": 1}  # in flight: still served from memory
+    w.write(path, {"n": 2})
+    assert w.pending(path) == {"n": 2}
+    assert time.monotonic() - t0 < 1
+
+    release.set()
+    flusher.join(5)
+    monkeypatch.setattr(os, "fsync", real_fsync)
+    assert json.loads(path.read_text()) == {"n": 1}
+    w.flush()
+    assert json.loads(path.read_text()) == {"n": 2}
+
+
+def test_unbuffered_write_commits_at_once(tmp_path):
+    w = JsonWriter(window=0)
+    path = tmp_path / "a.json"
+    w.write(path, [1, 2])
+    assert json.loads(path.read_text()) == [1, 2]
+    assert w.pending(path) is _MISSING
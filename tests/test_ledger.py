@@ -0,0 +1,56 @@
+import json
+import os
+
+from conftest import open_json_storage
+
+
+def test_ledger_survives_reopen(tmp_path):
+    st = open_json_storage(tmp_path)
+    st.add_balance(1, 100, "topup")
+    assert st.debit_if_sufficient(1, 30) == (True, 70.0)
+    assert st.debit_if_sufficient(1, 80) == (False, 70.0)
+    st.close()
+
+    st = open_json_storage(tmp_path)
+    assert st.get_balance(1) == 70.0
+    assert [e["kind"] for e in st.balance_history(1)] == ["topup", "debit"]
+    st.close()
+
+
+def test_balances_file_edited_while_stopped_is_posted_as_adjust(tmp_path):
+    st = open_json_storage(tmp_path)
+    st.add_balance(1, 100, "topup")
+    st.add_balance(2, 50, "topup")
+    st.close()
+
+    path = tmp_path / "balances.json"
+    rows = json.loads(path.read_text())
+    for r in rows:
+        if r["user_id"] == 2:
+            r["balance"] = 80.0
+    path.write_text(json.dumps(rows))
+    ledger_mtime = (tmp_path / "ledger.jsonl").stat().st_mtime_ns
+    os.utime(path, ns=(ledger_mtime + 10**9, ledger_mtime + 10**9))
+
+    st = open_json_storage(tmp_path)
+    assert st.get_balance(1) == 100.0
+    assert st.get_balance(2) == 80.0
+    last = st.balance_history(2)[-1]
+    assert (last["kind"], last["amount"], last["balance"]) == ("adjust", 30.0, 80.0)
+    st.close()
+
+
+def test_stale_balances_file_is_repaired_from_ledger(tmp_path):
+    st = open_json_storage(tmp_path)
+    st.add_balance(1, 100, "topup")
+    st.close()
+    st = open_json_storage(tmp_path)
+    st.debit_if_sufficient(1, 30)
+    st.ledger.snapshot()  # stopped without flushing balances.json
+    os.utime(tmp_path / "balances.json", ns=(0, 0))
+
+    st = open_json_storage(tmp_path)
+    assert st.get_balance(1) == 70.0
+    assert st.balances.get(1) == 70.0
+    assert [e["kind"] for e in st.balance_history(1)] == ["topup", "debit"]
+    st.close()
@@ -0,0 +1,71 @@
+import json
+
+from storage import OrderLog
+
+
+def _order(order_id, user_id=1, status="queued", **extra):
+    return {"order_id": order_id, "user_id": user_id, "status": status, "cost": 10.0, **extra}
+
+
+def _open_log(tmp_path, **attrs):
+    log = OrderLog(tmp_path / "orders.jsonl", tmp_path / "orders.idx.json")
+    for k, v in attrs.items():
+        setattr(log, k, v)
+    return log
+
+
+def test_updates_and_indexes(tmp_path):
+    log = _open_log(tmp_path)
+    log.append(_order("a"))
+    log.append(_order("b", user_id=2))
+    log.update("a", {"status": "placed", "provider_order_id": 7})
+    assert log.get("a")["status"] == "placed"
+    assert [o["order_id"] for o in log.pending_orders()] == ["b"]
+    assert [o["order_id"] for o in log.open_orders()] == ["a"]
+    assert [o["order_id"] for o in log.user_orders(1)] == ["a"]
+    assert log.last_user_order(2)["order_id"] == "b"
+    assert log.update("nope", {"status": "x"}) is None
+
+
+def test_index_is_only_checkpointed_when_the_tail_is_large(tmp_path):
+    log = _open_log(tmp_path, CHECKPOINT_MIN_BYTES=10**6)
+    log.append(_order("a"))
+    assert not log.flush()
+    assert not (tmp_path / "orders.idx.json").exists()
+
+    log.CHECKPOINT_MIN_BYTES = 0
+    assert log.flush()
+    indexed = json.loads((tmp_path / "orders.idx.json").read_text())["size"]
+    log.append(_order("b"))
+    # the tail is below CHECKPOINT_RATIO of the indexed log: no rewrite
+    log.CHECKPOINT_RATIO = 10
+    assert not log.flush()
+    assert json.loads((tmp_path / "orders.idx.json").read_text())["size"] == indexed
+    assert log.flush(force=True)
+    assert not log.flush(force=True)  # nothing new
+
+
+def test_reopen_rescans_the_unindexed_tail(tmp_path):
+    log = _open_log(tmp_path)
+    log.append(_order("a"))
+    log.flush(force=True)
+    log.append(_order("b", user_id=2))
+    log.update("a", {"status": "placed", "provider_order_id": 7})
+
+    log = _open_log(tmp_path)
+    assert log.get("a")["status"] == "placed"
+    assert [o["order_id"] for o in log.pending_orders()] == ["b"]
+    assert [o["order_id"] for o in log.open_orders()] == ["a"]
+    assert log.user_ids() == [1, 2]
+
+
+def test_truncated_log_drops_the_index(tmp_path):
+    log = _open_log(tmp_path)
+    log.append(_order("a"))
+    log.append(_order("b"))
+    log.flush(force=True)
+    (tmp_path / "orders.jsonl").write_text(json.dumps(_order("c")) + "\n")
+
+    log = _open_log(tmp_path)
+    assert [o["order_id"] for o in log.pending_orders()] == ["c"]
+    assert log.get("a") is None
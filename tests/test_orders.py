@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+from conftest import rejected
+from looksmm import CircuitOpen, LooksMMError
+
+
+def _combo(bot, order_id="c1", user_id=1, services=(11, 12, 13)):
+    bot.STORAGE.add_balance(user_id, 300, "topup")
+    job = {"order_id": order_id, "user_id": user_id, "username": "", "title": "КОМБО", "cost": 300.0,
+           "link": "https://t.me/x", "created_at": int(time.time()), "type": "combo",
+           "items": [{"service_id": sid, "qty": 100} for sid in services]}
+    assert bot.STORAGE.debit_and_enqueue(job)[0]
+    return bot.STORAGE.update_order(order_id, {"status": "submitting"})
+
+
+def _half_open(breaker):
+    breaker.failures, breaker.opened_at = breaker.threshold, time.monotonic() - breaker.cooldown - 1
+
+
+def test_combo_held_by_half_open_breaker_is_requeued(bot, supplier):
+    _half_open(bot.SUBMITTER.breaker)
+    order = asyncio.run(bot.submit_combo(_combo(bot)))
+
+    # one component got the probe, the others were turned away: nothing is cancelled or refunded
+    assert order["status"] == "queued"
+    assert [r["state"] for r in order["items"]] == ["placed", "held", "held"]
+    assert supplier.cancelled == []
+    assert bot.STORAGE.get_balance(1) == 0.0
+
+    # the probe closed the breaker; the retry only submits the held components
+    order = asyncio.run(bot.submit_combo(bot.STORAGE.update_order("c1", {"status": "submitting"})))
+    assert order["status"] == "placed"
+    assert [r["state"] for r in order["items"]] == ["placed"] * 3
+    assert sorted(sid for sid, *_ in supplier.added) == [11, 12, 13]
+
+
+def test_outbox_keeps_combos_queued_while_breaker_is_half_open(bot, supplier):
+    _combo(bot)
+    bot.STORAGE.update_order("c1", {"status": "queued"})
+    _half_open(bot.SUBMITTER.breaker)
+    outbox = bot.OrderOutbox(workers=1, retry_delay=60)
+
+    async def run():
+        await outbox._process(None, "c1")
+        assert set(outbox._retries) == {"c1"}
+        outbox._cancel_retries()
+
+    asyncio.run(run())
+    assert bot.STORAGE.get_order("c1")["status"] == "queued"
+    assert supplier.added == []
+
+
+def test_single_order_is_requeued_when_circuit_is_open(bot, supplier):
+    bot.STORAGE.add_balance(1, 100, "topup")
+    job = {"order_id": "o1", "user_id": 1, "username": "", "title": "Услуга", "cost": 100.0,
+           "link": "https://t.me/x", "created_at": int(time.time()), "service_id": 11, "qty": 100}
+    assert bot.STORAGE.debit_and_enqueue(job)[0]
+    supplier.errors[11] = CircuitOpen("open", transient=True)
+    order = asyncio.run(bot.submit_order(bot.STORAGE.get_order("o1")))
+    assert order["status"] == "queued"
+    assert bot.STORAGE.get_balance(1) == 0.0
+
+
+def test_combo_with_rejected_component_cancels_the_rest_and_refunds(bot, supplier, monkeypatch):
+    monkeypatch.setattr(bot, "COMBO_PARTIAL_POLICY", "cancel")
+    supplier.errors[12] = rejected("bad link")
+    order = asyncio.run(bot.submit_combo(_combo(bot)))
+
+    assert order["status"] == "failed"
+    assert order["error"] == "bad link"
+    assert [r["state"] for r in order["items"]] == ["cancelled", "failed", "cancelled"]
+    assert sorted(supplier.cancelled) == sorted(r["provider_order_id"] for r in order["items"] if "provider_order_id" in r)
+    assert (order["refunded"], order["cost"]) == (300.0, 0.0)
+    assert bot.STORAGE.get_balance(1) == 300.0
+
+
+def test_combo_refund_failed_policy_keeps_placed_components(bot, supplier, monkeypatch):
+    monkeypatch.setattr(bot, "COMBO_PARTIAL_POLICY", "refund_failed")
+    supplier.errors[12] = rejected()
+    order = asyncio.run(bot.submit_combo(_combo(bot)))
+
+    assert order["status"] == "partial"
+    assert [r["state"] for r in order["items"]] == ["placed", "failed", "placed"]
+    assert supplier.cancelled == []
+    assert (order["refunded"], order["cost"]) == (100.0, 200.0)
+    assert bot.STORAGE.get_balance(1) == 100.0
+
+
+def test_combo_refund_is_split_by_supplier_cost(bot, supplier, monkeypatch):
+    monkeypatch.setattr(bot, "COMBO_PARTIAL_POLICY", "refund_failed")
+    monkeypatch.setattr(bot.SERVICES, "by_id", {11: {"rate": 1}, 12: {"rate": 4}, 13: {"rate": 1}})
+    supplier.errors[12] = rejected()
+    order = asyncio.run(bot.submit_combo(_combo(bot)))
+    assert order["refunded"] == 200.0
+
+
+def test_combo_keeps_components_the_supplier_would_not_cancel(bot, supplier, monkeypatch):
+    monkeypatch.setattr(bot, "COMBO_PARTIAL_POLICY", "cancel")
+    supplier.errors[12] = rejected()
+
+    async def cancel_first_only(order_ids, timeout=None):
+        return {int(i): n == 0 for n, i in enumerate(order_ids)}
+
+    monkeypatch.setattr(supplier, "cancel", cancel_first_only)
+    order = asyncio.run(bot.submit_combo(_combo(bot)))
+    assert order["status"] == "partial"
+    assert [r["state"] for r in order["items"]] == ["cancelled", "failed", "placed"]
+    assert order["refunded"] == 200.0
+
+
+def test_combo_ambiguous_component_is_not_refunded(bot, supplier, monkeypatch):
+    monkeypatch.setattr(bot, "COMBO_PARTIAL_POLICY", "cancel")
+    supplier.errors[12] = LooksMMError("timeout", transient=True, ambiguous=True)
+    order = asyncio.run(bot.submit_combo(_combo(bot)))
+
+    assert order["status"] == "partial"
+    assert [r["state"] for r in order["items"]] == ["placed", "unconfirmed", "placed"]
+    assert supplier.cancelled == []
+    assert order["refunded"] == 0
+    assert bot.STORAGE.get_balance(1) == 0.0
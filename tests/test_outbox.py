@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+
+def _queue_order(bot, order_id, user_id=1, service_id=11):
+    bot.STORAGE.add_balance(user_id, 100, "topup")
+    job = {"order_id": order_id, "user_id": user_id, "username": "", "title": "Услуга", "cost": 100.0,
+           "link": "https://t.me/x", "created_at": int(time.time()), "service_id": service_id, "qty": 100}
+    assert bot.STORAGE.debit_and_enqueue(job)[0]
+
+
+@pytest.fixture
+def finished(bot, monkeypatch):
+    done = []
+
+    async def finish(app, order):
+        done.append(order)
+
+    monkeypatch.setattr(bot, "_finish_order", finish)
+    return done
+
+
+def test_order_is_queued_once(bot):
+    outbox = bot.OrderOutbox(workers=1, retry_delay=60)
+
+    async def run():
+        outbox.queue = asyncio.Queue()
+        for _ in range(3):
+            outbox.put("o1")
+        assert outbox.queue.qsize() == 1
+        outbox._retry_later("o2")
+        outbox._retry_later("o2")
+        assert list(outbox._retries) == ["o2"]
+        outbox.put("o2")  # already waiting for its retry
+        assert outbox.queue.qsize() == 1
+        outbox._retries["o2"].cancel()
+        outbox._retry_now("o2")
+        assert outbox.queue.qsize() == 2 and not outbox._retries
+        await outbox.stop()
+
+    asyncio.run(run())
+
+
+def test_workers_submit_each_order_once(bot, supplier, finished):
+    for oid in ("o1", "o2"):
+        _queue_order(bot, oid)
+    outbox = bot.OrderOutbox(workers=4, retry_delay=60)
+
+    async def run():
+        assert outbox.start(app=None) == 2  # queued orders are resumed from storage
+        for _ in range(5):
+            outbox.put("o1")
+        await outbox.queue.join()
+        await outbox.stop()
+
+    asyncio.run(run())
+    assert sorted(o["order_id"] for o in finished) == ["o1", "o2"]
+    assert len(supplier.added) == 2
+    assert {bot.STORAGE.get_order(oid)["status"] for oid in ("o1", "o2")} == {"placed"}
+
+
+def test_open_circuit_keeps_the_order_queued_with_one_retry(bot, supplier, finished):
+    _queue_order(bot, "o1")
+    bot.SUBMITTER.breaker.failures, bot.SUBMITTER.breaker.opened_at = 2, time.monotonic()
+    outbox = bot.OrderOutbox(workers=2, retry_delay=60)
+
+    async def run():
+        outbox.start(app=None)
+        outbox.put("o1")
+        await outbox.queue.join()
+        outbox.put("o1")
+        await outbox.queue.join()
+        assert list(outbox._retries) == ["o1"]
+        handle = outbox._retries["o1"]
+        await outbox.stop()
+        assert handle.cancelled() and not outbox._retries
+
+    asyncio.run(run())
+    assert finished == [] and supplier.added == []
+    assert bot.STORAGE.get_order("o1")["status"] == "queued"
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from persistence import SqlitePersistence
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "state.db"
+
+
+def _rows(p):
+    return sorted(p._db.execute("SELECT user_id, key, value FROM user_data").fetchall())
+
+
+def test_only_changed_keys_are_written(db_path):
+    p = SqlitePersistence(db_path)
+
+    async def run():
+        await p.refresh_user_data(1, {})
+        await p.update_user_data(1, {"order": {"qty": 100}, "promo": "ONCE"})
+        await p.flush()
+        assert _rows(p) == [(1, "order", '{"qty":100}'), (1, "promo", '"ONCE"')]
+
+        await p.update_user_data(1, {"order": {"qty": 100}, "promo": "ONCE"})
+        assert p._pending_users == {}
+        await p.update_user_data(1, {"order": {"qty": 200}, "promo": "ONCE"})
+        assert p._pending_users == {(1, "order"): '{"qty":200}'}
+        await p.update_user_data(1, {"order": {"qty": 200}})
+        assert p._pending_users == {(1, "order"): '{"qty":200}', (1, "promo"): None}
+        await p.flush()
+
+    asyncio.run(run())
+    assert _rows(p) == [(1, "order", '{"qty":200}')]
+    p.close()
+
+
+def test_values_that_are_not_json_stay_in_memory(db_path):
+    p = SqlitePersistence(db_path)
+
+    async def run():
+        await p.refresh_user_data(1, {})
+        await p.update_user_data(1, {"task": object(), "n": 1, 5: "int key"})
+        await p.flush()
+
+    asyncio.run(run())
+    assert _rows(p) == [(1, "n", "1")]
+    p.close()
+
+
+def test_user_data_is_reloaded_lazily_after_restart(db_path):
+    p = SqlitePersistence(db_path)
+
+    async def write():
+        await p.refresh_user_data(1, {})
+        await p.update_user_data(1, {"order": {"qty": 100}, "promo": "ONCE"})
+
+    asyncio.run(write())
+    p.close()  # commits what is still pending
+
+    p = SqlitePersistence(db_path)
+
+    async def read():
+        assert await p.get_user_data() == {}
+        data = {"promo": "NEWER"}
+        await p.refresh_user_data(1, data)
+        assert data == {"order": {"qty": 100}, "promo": "NEWER"}  # in-memory values win
+        await p.refresh_user_data(1, {})  # loaded only once
+        await p.update_user_data(1, data)
+        await p.flush()
+
+    asyncio.run(read())
+    assert _rows(p) == [(1, "order", '{"qty":100}'), (1, "promo", '"NEWER"')]
+    p.close()
+
+
+def test_unloaded_user_keeps_stored_keys(db_path):
+    p = SqlitePersistence(db_path)
+
+    async def run():
+        await p.refresh_user_data(1, {})
+        await p.update_user_data(1, {"a": 1, "b": 2})
+        await p.flush()
+        await p.get_user_data()  # new Application: nothing loaded
+        await p.update_user_data(1, {"a": 3})
+        await p.flush()
+
+    asyncio.run(run())
+    assert _rows(p) == [(1, "a", "3"), (1, "b", "2")]
+    p.close()
+
+
+def test_drop_user_data(db_path):
+    p = SqlitePersistence(db_path)
+
+    async def run():
+        await p.refresh_user_data(1, {})
+        await p.update_user_data(1, {"a": 1, "b": 2})
+        await p.update_user_data(2, {"a": 1})
+        await p.flush()
+        await p.drop_user_data(1)
+        await p.flush()
+
+    asyncio.run(run())
+    assert _rows(p) == [(2, "a", "1")]
+    p.close()
+
+
+def test_conversation_states_survive_restart(db_path):
+    p = SqlitePersistence(db_path)
+
+    async def write():
+        await p.update_conversation("order_conv", (1, 1), 2)
+        await p.update_conversation("order_conv", (2, 2), 3)
+        await p.update_conversation("admin_conv", (1, 1), 7)
+        await p.update_conversation("order_conv", (2, 2), None)  # ended
+
+    asyncio.run(write())
+    p.close()
+
+    p = SqlitePersistence(db_path)
+    assert asyncio.run(p.get_conversations("order_conv")) == {(1, 1): 2}
+    assert asyncio.run(p.get_conversations("admin_conv")) == {(1, 1): 7}
+    p.close()
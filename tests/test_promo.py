@@ -0,0 +1,64 @@
+import json
+import time
+
+import pytest
+
+from conftest import open_json_storage
+from promo import PromoEngine
+
+
+@pytest.fixture
+def promos(tmp_path, storage):
+    path = tmp_path / "promo_codes.json"
+    path.write_text(json.dumps({"ONCE": {"percent": 10, "max_uses": 1}}))
+    return PromoEngine(path, storage, reservation_ttl=0.05)
+
+
+def _place(storage, promos, order_id, user_id):
+    """What order_confirm does: reserve, debit + enqueue, then commit the use."""
+    storage.add_balance(user_id, 100, "topup")
+    token, msg, _ = promos.reserve("once", user_id)
+    if token is None:
+        return msg
+    ok, _ = storage.debit_and_enqueue({"order_id": order_id, "user_id": user_id, "cost": 90.0, "title": "Услуга",
+                                       "link": "https://t.me/x", "created_at": int(time.time()),
+                                       "service_id": 1, "qty": 100, "promo_code": "ONCE"})
+    assert ok
+    assert promos.commit(token)
+    return ""
+
+
+def test_max_uses_hold_while_order_is_queued(storage, promos):
+    assert _place(storage, promos, "o1", 1) == ""
+    time.sleep(0.1)  # past the reservation TTL; the job is still in the outbox
+    assert storage.get_order("o1")["status"] == "queued"
+    assert _place(storage, promos, "o2", 2) == "Лимит использований промокода исчерпан."
+    assert promos.validate("ONCE", 1)[1] == "Этот промокод уже использован вами."
+
+
+def test_reservation_counts_against_max_uses(storage, promos):
+    token, _, _ = promos.reserve("ONCE", 1)
+    assert token
+    assert promos.reserve("ONCE", 2)[0] is None
+    promos.release(token)
+    assert promos.reserve("ONCE", 2)[0]
+
+
+def test_refund_gives_the_use_back(storage, promos):
+    assert _place(storage, promos, "o1", 1) == ""
+    assert promos.refund(1, "once")
+    assert storage.promo_use_count("ONCE") == 0
+    assert _place(storage, promos, "o2", 2) == ""
+
+
+def test_refund_survives_reopen(tmp_path):
+    st = open_json_storage(tmp_path)
+    st.promo_mark_used(1, "ONCE")
+    st.promo_mark_used(2, "ONCE")
+    st.promo_unmark_used(1, "ONCE")
+    st.close()
+    st = open_json_storage(tmp_path)
+    assert not st.promo_is_used(1, "ONCE")
+    assert st.promo_is_used(2, "ONCE")
+    assert st.promo_use_count("ONCE") == 1
+    st.close()
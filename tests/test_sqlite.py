@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from conftest import open_json_storage
+from storage import JsonStorage, SqliteStorage, Storage
+
+
+def _invoice(user_id, amount):
+    return {"invoice_id": f"inv-{user_id}-{amount}", "user_id": user_id, "amount": float(amount), "note": "",
+            "status": "pending", "created_at": int(time.time()), "paid_at": None}
+
+
+def _order(order_id, user_id, cost):
+    return {"order_id": order_id, "user_id": user_id, "username": "", "title": "Услуга", "cost": float(cost),
+            "link": "https://t.me/x", "created_at": int(time.time()), "service_id": 1, "qty": 100}
+
+
+def test_import_from_json_storage(tmp_path):
+    src = open_json_storage(tmp_path)
+    for inv in (_invoice(1, 100), _invoice(2, 40), _invoice(2, 15)):
+        src.create_invoice(inv)
+    src.confirm_invoice("inv-1-100")
+    src.confirm_invoice("inv-2-40")
+    assert src.sweep_invoices(3600) == (0, 2)  # both paid invoices move to the archive
+    src.add_expense({"amount": 25.0, "note": "proxy", "created_at": int(time.time())})
+    assert src.debit_and_enqueue(_order("o1", 1, 30)) == (True, 70.0)
+    src.close()
+
+    src = open_json_storage(tmp_path)
+    dst = SqliteStorage(tmp_path / "shop.db")
+    dst.import_from(src)
+
+    for uid in (1, 2):
+        assert dst.get_balance(uid) == src.get_balance(uid)
+    assert dst.get_balance(1) == 70.0
+    assert dst.finance_totals()["revenue"]["today"] == 140.0
+    assert dst.finance_totals() == src.finance_totals()
+    assert {i["invoice_id"]: i["status"] for i in dst.user_invoices(2)} == {"inv-2-40": "paid", "inv-2-15": "pending"}
+    assert dst.get_order("o1")["status"] == "queued"
+    assert dst.user_ids() >= {1, 2}
+    dst.close()
+    src.close()
+
+
+def test_backends_implement_the_whole_interface():
+    assert not JsonStorage.__abstractmethods__
+    assert not SqliteStorage.__abstractmethods__
+
+    class Partial(Storage):
+        def get_balance(self, user_id):
+            return 0.0
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_concurrent_debits_never_overdraw(storage):
+    from concurrent.futures import ThreadPoolExecutor
+
+    storage.add_balance(1, 100, "topup")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: storage.debit_if_sufficient(1, 30, ref=f"d{i}")[0], range(20)))
+    assert results.count(True) == 3
+    assert storage.get_balance(1) == 10.0
+    assert sum(e["amount"] for e in storage.balance_history(1, limit=50) if e["kind"] == "debit") == 90.0
+
+
+def test_debit_and_enqueue_stores_nothing_without_funds(storage):
+    storage.add_balance(1, 20, "topup")
+    order = {"order_id": "o1", "user_id": 1, "cost": 30.0, "created_at": int(time.time())}
+    assert storage.debit_and_enqueue(order) == (False, 20.0)
+    assert storage.get_order("o1") is None
+    assert storage.pending_orders() == []
+    assert storage.debit_and_enqueue({**order, "cost": 20.0}) == (True, 0.0)
+    assert [o["status"] for o in storage.pending_orders()] == ["queued"]
+
+
+def test_sqlite_state_survives_reopen(tmp_path):
+    db = SqliteStorage(tmp_path / "shop.db")
+    db.add_balance(1, 50, "topup")
+    db.debit_and_enqueue({"order_id": "o1", "user_id": 1, "cost": 20.0, "created_at": int(time.time())})
+    db.update_order("o1", {"status": "placed", "provider_order_id": 5})
+    db.promo_mark_used(1, "ONCE")
+    db.close()
+
+    db = SqliteStorage(tmp_path / "shop.db")
+    assert db.get_balance(1) == 30.0
+    assert [o["order_id"] for o in db.open_orders()] == ["o1"]
+    assert db.pending_orders() == []
+    assert db.promo_is_used(1, "ONCE")
+    assert 1 in db.user_ids()
+    db.close()
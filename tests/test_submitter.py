@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeSupplier, rejected
+from looksmm import CircuitBreaker, CircuitOpen, LooksMMError, Submitter
+
+
+def _submitter(supplier, threshold=2, cooldown=60, retries=0):
+    return Submitter(supplier, CircuitBreaker(threshold=threshold, cooldown=cooldown), retries=retries, base_delay=0)
+
+
+def _add(sub, service_id=1):
+    return asyncio.run(sub.add(service_id, "https://t.me/x", 100))
+
+
+def _down():
+    return LooksMMError("503", transient=True)
+
+
+def test_breaker_opens_after_threshold_and_stops_calling():
+    supplier = FakeSupplier()
+    supplier.errors[1] = _down()
+    sub = _submitter(supplier)
+    for _ in range(2):
+        with pytest.raises(LooksMMError):
+            _add(sub)
+    assert sub.breaker.state == "open"
+    supplier.errors.clear()
+    with pytest.raises(CircuitOpen):
+        _add(sub)
+    assert supplier.added == []
+
+
+def test_rejected_order_does_not_count_as_a_supplier_failure():
+    supplier = FakeSupplier()
+    supplier.errors[1] = rejected()
+    sub = _submitter(supplier)
+    for _ in range(3):
+        with pytest.raises(LooksMMError):
+            _add(sub)
+    assert sub.breaker.state == "closed"
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    breaker.failure()
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_the_breaker():
+    supplier = FakeSupplier()
+    sub = _submitter(supplier, threshold=1, cooldown=0)
+    sub.breaker.failure()
+    supplier.errors[1] = _down()
+    with pytest.raises(LooksMMError):
+        _add(sub)
+    assert sub.breaker.opened_at is not None
+    assert not sub.breaker._probing
+
+
+@pytest.mark.parametrize("error", [KeyError("order"), asyncio.CancelledError()])
+def test_probe_slot_is_freed_whatever_the_probe_raises(error):
+    supplier = FakeSupplier()
+    sub = _submitter(supplier, threshold=1, cooldown=0)
+    sub.breaker.failure()
+    supplier.errors[1] = error
+    with pytest.raises(type(error)):
+        _add(sub)
+    assert not sub.breaker._probing
+    supplier.errors.clear()
+    assert _add(sub).order
+    assert sub.breaker.state == "closed"
+
+
+def test_only_unambiguous_transient_failures_are_retried():
+    supplier = FakeSupplier()
+    calls = []
+
+    async def flaky(service_id, link, quantity):
+        calls.append(service_id)
+        if len(calls) < 3:
+            raise _down()
+        return await FakeSupplier.add(supplier, service_id, link, quantity)
+
+    supplier.add = flaky
+    sub = _submitter(supplier, threshold=10, retries=3)
+    assert _add(sub).order
+    assert len(calls) == 3
+
+
+def test_ambiguous_failure_is_not_retried():
+    supplier = FakeSupplier()
+    supplier.errors[1] = LooksMMError("timeout", transient=True, ambiguous=True)
+    calls = []
+    add = supplier.add
+
+    async def counted(*args):
+        calls.append(args)
+        return await add(*args)
+
+    supplier.add = counted
+    sub = _submitter(supplier, threshold=10, retries=3)
+    with pytest.raises(LooksMMError):
+        _add(sub)
+    assert len(calls) == 1
@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def _update(user_id):
+    return SimpleNamespace(effective_user=None if user_id is None else SimpleNamespace(id=user_id))
+
+
+def test_updates_of_one_user_run_one_at_a_time(_shop_bot):
+    processor = _shop_bot.PerUserUpdateProcessor(16)
+    log = []
+
+    async def handle(name):
+        log.append(f"{name}+")
+        await asyncio.sleep(0.01)
+        log.append(f"{name}-")
+
+    async def run():
+        await asyncio.gather(processor.do_process_update(_update(1), handle("a")),
+                             processor.do_process_update(_update(1), handle("b")))
+
+    asyncio.run(run())
+    assert log == ["a+", "a-", "b+", "b-"]
+
+
+def test_updates_of_different_users_interleave(_shop_bot):
+    processor = _shop_bot.PerUserUpdateProcessor(16)
+    log = []
+
+    async def handle(name):
+        log.append(f"{name}+")
+        await asyncio.sleep(0.01)
+        log.append(f"{name}-")
+
+    async def run():
+        await asyncio.gather(processor.do_process_update(_update(1), handle("a")),
+                             processor.do_process_update(_update(2), handle("b")),
+                             processor.do_process_update(_update(None), handle("c")))
+
+    asyncio.run(run())
+    assert log[:3] == ["a+", "b+", "c+"]
+
+
+def test_lock_is_dropped_when_nobody_holds_it(_shop_bot):
+    locks = _shop_bot.UserLocks()
+
+    async def run():
+        async with locks.hold(1):
+            assert len(locks) == 1
+        assert len(locks) == 0
+        try:
+            async with locks.hold(2):
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert len(locks) == 0
+
+    asyncio.run(run())
+
+
+def test_waiting_user_keeps_the_lock_alive(_shop_bot):
+    locks = _shop_bot.UserLocks()
+    order = []
+
+    async def task(name, delay):
+        async with locks.hold(1):
+            order.append(name)
+            await asyncio.sleep(delay)
+
+    async def run():
+        first = asyncio.create_task(task("a", 0.02))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(task("b", 0))
+        await asyncio.sleep(0.005)
+        assert len(locks) == 1  # "a" holds, "b" waits on the same lock
+        await asyncio.gather(first, second)
+
+    asyncio.run(run())
+    assert order == ["a", "b"]
+    assert len(locks) == 0